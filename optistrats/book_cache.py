@@ -0,0 +1,117 @@
+import numpy as np
+
+from optistrats.utils import TICK_SIZE, to_ticks, from_ticks
+
+
+BID = 0
+ASK = 1
+
+
+class OrderBookCache:
+    """
+    Local copy of the top <depth> price levels of every instrument in <instrument_ids>, kept in dense arrays indexed
+    by instrument and side, with prices as integer numbers of ticks of <tick_size>. Each new order book is compared
+    against the previous one, and only when the touch (the price or volume of the best bid or ask) moved is its
+    version bumped and a change event published to the subscribers, so downstream pricing can skip instruments whose
+    touch did not move.
+
+    The cache answers the same `best_bid_ask` and `check_and_get_best_bid_ask` queries as a MarketDataSnapshot, and
+    can be handed to any consumer of one.
+
+    Example usage:
+        book_cache = OrderBookCache(['NVDA', 'NVDA_DUAL'], depth=5)
+        book_cache.subscribe(lambda instrument_id, bid, ask: print(instrument_id, bid.price, ask.price))
+        changed = book_cache.refresh(exchange)
+        bid, ask = book_cache.best_bid_ask('NVDA')
+    """
+    def __init__(self, instrument_ids, depth=5, tick_size=TICK_SIZE):
+        self.instrument_ids = list(instrument_ids)
+        self.index = {instrument_id: i for i, instrument_id in enumerate(self.instrument_ids)}
+        self.depth = depth
+        self.tick_size = tick_size
+        n = len(self.instrument_ids)
+        self.ticks = np.zeros((n, 2, depth), dtype=np.int64)
+        self.volumes = np.zeros((n, 2, depth), dtype=np.int64)
+        self.n_levels = np.zeros((n, 2), dtype=np.int64)
+        # bumped every time the touch of an instrument moves
+        self.versions = np.zeros(n, dtype=np.int64)
+        # the exchange's own best levels, handed out as is to consumers expecting order book levels
+        self._touch = [None] * n
+        self._subscribers = []
+
+    def __contains__(self, instrument_id):
+        return instrument_id in self.index
+
+    def subscribe(self, callback):
+        """
+        Calls callback(instrument_id, best_bid, best_ask) whenever the touch of an instrument moves. The best bid
+        and ask are None while that side of the book is empty.
+        """
+        self._subscribers.append(callback)
+
+    def apply(self, instrument_id, order_book):
+        """
+        Stores the top levels of <order_book> and returns whether the touch of <instrument_id> moved.
+        """
+        i = self.index[instrument_id]
+        old_touch = self._touch_key(i)
+        for side, levels in ((BID, order_book.bids if order_book else []), (ASK, order_book.asks if order_book else [])):
+            n_levels = min(len(levels), self.depth)
+            self.n_levels[i, side] = n_levels
+            self.ticks[i, side, n_levels:] = 0
+            self.volumes[i, side, n_levels:] = 0
+            for level in range(n_levels):
+                self.ticks[i, side, level] = to_ticks(levels[level].price, self.tick_size)
+                self.volumes[i, side, level] = levels[level].volume
+        if self._touch_key(i) == old_touch:
+            return False
+
+        best_bid = order_book.bids[0] if self.n_levels[i, BID] else None
+        best_ask = order_book.asks[0] if self.n_levels[i, ASK] else None
+        self._touch[i] = (best_bid, best_ask)
+        self.versions[i] += 1
+        for callback in self._subscribers:
+            callback(instrument_id, best_bid, best_ask)
+        return True
+
+    def _touch_key(self, i):
+        return tuple(
+            (int(self.ticks[i, side, 0]), int(self.volumes[i, side, 0])) if self.n_levels[i, side] else None
+            for side in (BID, ASK)
+            )
+
+    def refresh(self, exchange, instrument_ids=None):
+        """
+        Fetches the order book of every instrument (or of <instrument_ids>) and returns the ids whose touch moved.
+        """
+        if instrument_ids is None:
+            instrument_ids = self.instrument_ids
+        return [
+            instrument_id for instrument_id in instrument_ids
+            if self.apply(instrument_id, exchange.get_last_price_book(instrument_id=instrument_id))
+            ]
+
+    def version(self, instrument_id):
+        return int(self.versions[self.index[instrument_id]])
+
+    def best_bid_ask(self, instrument_id):
+        """
+        Returns the best bid and ask of <instrument_id>, or None if either side of the book is empty.
+        """
+        touch = self._touch[self.index[instrument_id]]
+        if touch is None or touch[0] is None or touch[1] is None:
+            return None
+        return touch
+
+    def check_and_get_best_bid_ask(self, instrument_id):
+        quotes = self.best_bid_ask(instrument_id)
+        if quotes is None:
+            return False, None, None
+        return (True,) + quotes
+
+    def midpoint(self, instrument_id):
+        i = self.index[instrument_id]
+        if not (self.n_levels[i, BID] and self.n_levels[i, ASK]):
+            return None
+        # the sum of the ticks counts half ticks
+        return from_ticks(int(self.ticks[i, BID, 0] + self.ticks[i, ASK, 0]), self.tick_size / 2)
@@ -0,0 +1,127 @@
+import time
+import datetime as dt
+
+from optistrats.book_cache import OrderBookCache
+from optistrats.metrics import CycleMeter
+
+
+class MarketDataSnapshot:
+    """
+    The order books and our new trades of one engine tick, fetched once and shared by every strategy, together with
+    the instruments whose touch moved since the previous tick.
+    """
+    def __init__(self, books, trades, timestamp=None, changed=None):
+        self.books = books
+        self.trades = trades
+        self.timestamp = timestamp or dt.datetime.now()
+        # None when unknown, every instrument then counts as changed
+        self.changed = changed
+        
+    def touch_changed(self, instrument_id):
+        return self.changed is None or instrument_id in self.changed
+
+    def best_bid_ask(self, instrument_id):
+        """
+        Returns the best bid and ask of <instrument_id>, or None if either side of the book is empty.
+        """
+        order_book = self.books.get(instrument_id)
+        if not (order_book and order_book.bids and order_book.asks):
+            return None
+        return order_book.bids[0], order_book.asks[0]
+
+    def check_and_get_best_bid_ask(self, instrument_id):
+        quotes = self.best_bid_ask(instrument_id)
+        if quotes is None:
+            return False, None, None
+        return (True,) + quotes
+
+
+class TradingEngine:
+    """
+    Runs several strategies on one market data and order pipeline. Every tick the engine fetches each order book
+    any strategy needs once, polls our new trades once per traded instrument and books them with the shared
+    PreTradeRiskEngine, compares the books against its OrderBookCache to find the touches that moved, hands the
+    snapshot to every strategy and finally flushes all orders the strategies queued on the shared OrderGateway
+    together. With a MetricsRegistry, every tick is counted and the positions are published as gauges. With a
+    <market_data> source such as a MarketDataBus, the books are read from it instead of from the exchange. With a
+    PnLEngine, every trade is booked with it and our positions are marked to the books of the snapshot.
+
+    A strategy is any object with
+        book_ids: instruments whose order books it reads
+        traded_ids: instruments it trades
+        on_tick(engine, snapshot): called once per tick
+
+    Example usage:
+        engine = TradingEngine(exchange, risk, gateway)
+        engine.add_strategy(MarketMakingStrategy(market_makers_dict, underlying_dict, 'slippery', 'linear-deprecate'))
+        engine.add_strategy(ArbitrageStrategy(arbitrageurs))
+        engine.run(wait_time=.2)
+    """
+    def __init__(self, exchange, risk, gateway, metrics=None, market_data=None, pnl=None):
+        self.exchange = exchange
+        self.market_data = market_data if market_data is not None else exchange
+        self.risk = risk
+        self.gateway = gateway
+        self.metrics = metrics
+        self.pnl = pnl
+        self.cycle_meter = CycleMeter(metrics) if metrics is not None else None
+        self.strategies = []
+        self._book_ids = []
+        self._traded_ids = []
+        self.book_cache = OrderBookCache([])
+
+    def add_strategy(self, strategy):
+        self.strategies.append(strategy)
+        self._book_ids = sorted(set(self._book_ids) | set(strategy.book_ids))
+        self._traded_ids = sorted(set(self._traded_ids) | set(strategy.traded_ids))
+        self.book_cache = OrderBookCache(self._book_ids)
+
+    def take_snapshot(self):
+        books = {instrument_id: self.market_data.get_last_price_book(instrument_id) for instrument_id in self._book_ids}
+        changed = frozenset(
+            instrument_id for instrument_id, order_book in books.items() if self.book_cache.apply(instrument_id, order_book)
+            )
+        trades = {}
+        for instrument_id in self._traded_ids:
+            new_trades = self.exchange.poll_new_trades(instrument_id=instrument_id)
+            for trade in new_trades:
+                print(f'- Last period, traded {trade.volume} lots in {instrument_id} at price {trade.price:.2f}, side {trade.side}.')
+                self.risk.on_trade(instrument_id, trade.order_id, trade.side, trade.volume)
+                if self.pnl is not None:
+                    self.pnl.on_trade(instrument_id, trade)
+            if new_trades:
+                trades[instrument_id] = new_trades
+        return MarketDataSnapshot(books, trades, changed=changed)
+
+    def run_once(self):
+        print(f'')
+        print(f'-----------------------------------------------------------------')
+        print(f'ENGINE TICK ENTERED AT {str(dt.datetime.now()):18s} UTC.')
+        print(f'-----------------------------------------------------------------')
+
+        snapshot = self.take_snapshot()
+        if self.pnl is not None:
+            self.pnl.mark_books(snapshot)
+        for strategy in self.strategies:
+            strategy.on_tick(self, snapshot)
+        self.gateway.flush()
+        if self.metrics is not None:
+            self.cycle_meter.tick()
+            for instrument_id, position in self.risk.positions.items():
+                self.metrics.set('position', position, instrument_id=instrument_id)
+            if self.pnl is not None:
+                self.metrics.set('pnl', self.pnl.total())
+                for strategy, row in self.pnl.by_strategy().items():
+                    self.metrics.set('strategy_pnl', row['total'], strategy=strategy)
+        return snapshot
+
+    def run(self, wait_time=.2, profiler=None):
+        """
+        Ticks forever, polling <profiler> (a ProfilingController) for profiling requests before every tick.
+        """
+        while True:
+            if profiler is not None:
+                profiler.poll()
+            self.run_once()
+            print(f'\nSleeping for {wait_time} seconds.')
+            time.sleep(wait_time)
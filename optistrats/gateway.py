@@ -0,0 +1,192 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from optistrats.metrics import InstrumentedExchange
+
+
+_MAX_ORDER_TAGS = 100000
+
+
+def _remember(mapping, key, value):
+    mapping[key] = value
+    if len(mapping) > _MAX_ORDER_TAGS:
+        # oldest first, long done with by now
+        del mapping[next(iter(mapping))]
+
+
+def ioc_filled_volume(exchange, instrument_id, order_id):
+    """
+    Returns the volume traded by the ioc order <order_id>. The exchange reports the trades of an order on the
+    connection that sent it before answering the insert, so this has to be called on that same connection.
+    """
+    return sum(trade.volume for trade in exchange.get_trade_history(instrument_id) if trade.order_id == order_id)
+
+
+def _connected_exchange():
+    from optibook.synchronous_client import Exchange
+
+    exchange = Exchange()
+    exchange.connect()
+    return exchange
+
+
+class OrderGateway:
+    """
+    Queues order inserts and deletes for any number of instruments and sends them together on `flush`. Requests
+    are pipelined over a small pool of threads, each with its own exchange connection, so a full requote costs
+    about one round-trip instead of one per order.
+
+    Every queued request immediately returns a Future, which resolves to the exchange response once flushed.
+    Within a flush, the inserts of an instrument are only sent once its deletes have been answered, so a requote
+    never has the old and the new orders working at the same time. When a PreTradeRiskEngine is given, deletes are
+    booked when queued, and the volume of an insert is reserved when queued and released once it is rejected or,
+    for an ioc order, answered; an acknowledged limit order takes over its reservation. When a MetricsRegistry is given, every connection is an
+    InstrumentedExchange recording its calls. The volume an ioc order traded is read on the connection that sent
+    it and kept in `ioc_fills` until popped. An order that cannot wait for the next flush, e.g. the ioc leg of an
+    arbitrage, is sent with `insert_now`, which leaves the queue untouched.
+
+    Example usage:
+        gateway = OrderGateway(pool_size=4)
+        gateway.delete('NVDA', order_id)
+        response = gateway.insert('NVDA', price=25.1, volume=10, side='bid')
+        gateway.flush()
+        print(response.result().success)
+    """
+    def __init__(self, exchange_factory=_connected_exchange, pool_size=4, risk=None, metrics=None):
+        self.risk = risk
+        self.metrics = metrics
+        self._exchange_factory = exchange_factory
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='order-gateway')
+        self._lock = threading.Lock()
+        self._queue = []
+        # order_id -> tag of the acknowledged inserts that were tagged, e.g. with the strategy that sent them
+        self.order_tags = {}
+        # order_id -> traded volume of the acknowledged ioc orders
+        self.ioc_fills = {}
+
+    def _exchange(self):
+        exchange = getattr(self._local, 'exchange', None)
+        if exchange is None:
+            exchange = self._exchange_factory()
+            if self.metrics is not None:
+                exchange = InstrumentedExchange(exchange, self.metrics)
+            self._local.exchange = exchange
+        return exchange
+
+    def _enqueue(self, instrument_id, request, on_result=None, delete=False):
+        future = Future()
+        with self._lock:
+            self._queue.append((future, request, on_result, instrument_id, delete))
+        return future
+
+    def insert(self, instrument_id, price, volume, side, order_type='limit', tag=None):
+        return self._enqueue(instrument_id, *self._insert_request(instrument_id, price, volume, side, order_type, tag))
+
+    def insert_now(self, instrument_id, price, volume, side, order_type='ioc', tag=None):
+        """
+        Sends an insert right away, bypassing the queue, and returns its Future. Whatever is queued stays queued
+        until the next flush.
+        """
+        future = Future()
+        self._pool.submit(self._run, future, *self._insert_request(instrument_id, price, volume, side, order_type, tag))
+        return future
+
+    def _insert_request(self, instrument_id, price, volume, side, order_type, tag):
+        filled = []
+        reservation = self.risk.reserve(instrument_id, side, volume) if self.risk is not None else None
+
+        def request(exchange):
+            try:
+                response = exchange.insert_order(
+                    instrument_id=instrument_id, price=price, volume=volume, side=side, order_type=order_type
+                    )
+            except BaseException:
+                if reservation is not None:
+                    with self._lock:
+                        self.risk.release(reservation)
+                raise
+            if order_type == 'ioc' and response.success:
+                filled.append(ioc_filled_volume(exchange, instrument_id, response.order_id))
+            return response
+
+        def on_result(response):
+            # ioc orders never rest in the book, their fills reach the risk engine through the trades
+            if reservation is not None:
+                self.risk.release(reservation)
+                if response.success and order_type == 'limit':
+                    self.risk.on_order_inserted(instrument_id, response.order_id, side, volume)
+            if filled:
+                _remember(self.ioc_fills, response.order_id, filled[0])
+            if tag is not None and response.success:
+                _remember(self.order_tags, response.order_id, tag)
+
+        return request, on_result
+
+    def delete(self, instrument_id, order_id):
+        if self.risk is not None:
+            self.risk.on_order_deleted(order_id)
+        return self._enqueue(instrument_id, lambda exchange: exchange.delete_order(instrument_id, order_id=order_id), delete=True)
+
+    def delete_all(self, instrument_id):
+        if self.risk is not None:
+            for order_id in self.risk.order_ids(instrument_id):
+                self.risk.on_order_deleted(order_id)
+        return self._enqueue(instrument_id, lambda exchange: exchange.delete_orders(instrument_id), delete=True)
+
+    def _run(self, future, request, on_result):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = request(self._exchange())
+            if on_result is not None:
+                with self._lock:
+                    on_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def flush(self, block=True, timeout=None):
+        """
+        Sends all queued requests concurrently and returns their futures, in the order they were queued. The
+        inserts of an instrument with deletes in the queue are held back until those deletes have been answered.
+        With <block> set, waits until every request has been answered (or <timeout> seconds have passed).
+        """
+        with self._lock:
+            queue, self._queue = self._queue, []
+        deletes = {}
+        for future, request, on_result, instrument_id, delete in queue:
+            if delete:
+                deletes.setdefault(instrument_id, []).append(future)
+        held = {}
+        for future, request, on_result, instrument_id, delete in queue:
+            if delete or instrument_id not in deletes:
+                self._pool.submit(self._run, future, request, on_result)
+            else:
+                held.setdefault(instrument_id, []).append((future, request, on_result))
+        for instrument_id, requests in held.items():
+            self._release_after(deletes[instrument_id], requests)
+        futures = [future for future, *_ in queue]
+        if block and futures:
+            wait(futures, timeout=timeout)
+        return futures
+
+    def _release_after(self, deletes, requests):
+        # submits <requests> once every one of <deletes> is done, without holding a pool thread while waiting
+        pending = [len(deletes)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            for future, request, on_result in requests:
+                self._pool.submit(self._run, future, request, on_result)
+
+        for delete in deletes:
+            delete.add_done_callback(on_done)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
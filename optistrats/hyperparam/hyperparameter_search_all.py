@@ -3,38 +3,44 @@ import numpy as np
 import datetime as dt
 import time, math
 import logging
-logging.getLogger('client').setLevel('ERROR')
 
-import wandb
-wandb.login()
-
-from optibook.synchronous_client import Exchange
 from optistrats.strats.market_maker import OptionMarketMaker, FutureMarketMaker, StockMarketMaker
-from optistrats.utils import get_bid_ask, clear_orders, clear_position
+from optistrats.utils import get_bid_ask, flatten
+from optistrats.gateway import OrderGateway
 from optistrats.scripts.run import underlying_hash, market_makers_hash
+from optistrats.instruments import InstrumentRegistry
+from optistrats.risk import PreTradeRiskEngine
+from optistrats.pnl import PnLEngine
 
 project_name = 'Optiver-market-making'
 
 
 # 🐝 Step 1: Define the trade function that takes in hyperparameter 
 # values from `wandb.config` and uses them to maket market on an instrument and return metric
-def trade_one_iteration(iteration, market_makers_dict, underlying_dict, exchange, wait_time, credit_ic_mode, volume_ic_mode):
+def trade_one_iteration(iteration, market_makers_dict, underlying_dict, exchange, wait_time, credit_ic_mode, volume_ic_mode, pnl):
+    """
+    Requotes every market maker once and returns the PnL of the PnLEngine <pnl>, which books our fills and marks
+    every instrument to its fair value, without asking the exchange.
+    """
     print(f'')
     print(f'-----------------------------------------------------------------')
     print(f'TRADE LOOP ITERATION {iteration} ENTERED AT {str(dt.datetime.now()):18s} UTC.')
     print(f'-----------------------------------------------------------------')
     
     for instrument_id, market_maker in market_makers_dict.items():
-        market_maker.get_traded_orders(exchange)
+        for trade in market_maker.get_traded_orders(exchange):
+            pnl.on_trade(instrument_id, trade)
         
         stock_value = get_bid_ask(exchange, underlying_dict[instrument_id])
         if stock_value is None:
             print('Empty stock order book on bid or ask-side, or both, unable to update option prices.')
             time.sleep(wait_time)
-            return exchange.get_pnl()
+            return pnl.total()
             
         stock_bid, stock_ask = stock_value
         theoretical_bid_price, theoretical_ask_price = market_maker.compute_fair_quotes(stock_bid.price, stock_ask.price)
+        # only the underlying books are fetched, so positions are marked to our fair value
+        pnl.mark(instrument_id, (theoretical_bid_price + theoretical_ask_price) / 2)
         market_maker.select_credits(exchange, credit_ic_mode)
         market_maker.select_volumes(exchange, volume_ic_mode)
         market_maker.cancel_orders(exchange)
@@ -43,51 +49,58 @@ def trade_one_iteration(iteration, market_makers_dict, underlying_dict, exchange
         print(f'\nSleeping for {wait_time} seconds.')
         time.sleep(wait_time)
     
-    return exchange.get_pnl()
+    return pnl.total()
     
     
 def main():
     # Use the wandb.init() API to generate a background process 
     # to sync and log data as a Weights and Biases run.
     # Optionally provide the name of the project. 
+    import wandb
+    from optibook.synchronous_client import Exchange
+
     run = wandb.init(project=project_name)
     exchange = Exchange()
     exchange.connect()
+    gateway = OrderGateway(pool_size=8)
     # clear all orders
-    clear_orders(exchange)
-    clear_position(exchange)
+    flatten(exchange, gateway)
     
-    all_instruments = exchange.get_instruments()
-    underlying_dict = underlying_hash(all_instruments)
-    market_makers_dict = market_makers_hash(all_instruments, underlying_dict)
+    registry = InstrumentRegistry(exchange.get_instruments())
+    underlying_dict = underlying_hash(registry)
+    # Initializing, the only exchange reconciliation until the end of the run
+    risk = PreTradeRiskEngine(position_limit=wandb.config.position_limit)
+    risk.sync(exchange, registry.instrument_ids)
+    pnl_0 = exchange.get_pnl()
+    pnl = PnLEngine(default_strategy='market_making')
+    pnl.carry_in(risk.positions)
+    market_makers_dict = market_makers_hash(registry, risk=risk)
     # note that we define values from `wandb.config` instead of 
     # defining hard values
-    
-    # Initializing
-    pnl_0 = exchange.get_pnl()
     epochs = wandb.config.epochs
     
     # Trading
     for epoch in np.arange(1, epochs):
-        pnl = trade_one_iteration(
+        pnl_epoch = trade_one_iteration(
             epoch, 
             market_makers_dict,
             underlying_dict,
             exchange, 
             wandb.config.wait_time, 
             wandb.config.credit_ic_mode, 
-            wandb.config.volume_ic_mode
+            wandb.config.volume_ic_mode,
+            pnl
             )
         wandb.log({
-            'PnL': pnl - pnl_0
+            'PnL': pnl_epoch
         })
         
-    # Clearing
-    clear_orders(exchange)
-    clear_position(exchange)
+    # Clearing, the closing trades are not polled, so the final PnL is read from the exchange
+    flatten(exchange, gateway)
+    gateway.close()
     pnl_1 = exchange.get_pnl()
     tot = pnl_1 - pnl_0
-    print(f'\n The cumulative PnL over the trading loop is {tot}.')
+    print(f'\n The cumulative PnL over the trading loop is {tot}, {pnl.total():.2f} before clearing.')
     wandb.log({
         'PnL': tot
     })
@@ -135,8 +148,15 @@ sweep_configuration = {
 
 
 
-# 🐝 Step 3: Initialize sweep by passing in config
-sweep_id = wandb.sweep(sweep=sweep_configuration, project=project_name)
+if __name__ == "__main__":
+    # wandb is slow to import and logging in needs network access, so only do it when running a sweep
+    import wandb
+
+    logging.getLogger('client').setLevel('ERROR')
+    wandb.login()
+
+    # 🐝 Step 3: Initialize sweep by passing in config
+    sweep_id = wandb.sweep(sweep=sweep_configuration, project=project_name)
 
-# 🐝 Step 4: Call to `wandb.agent` to start a sweep
-wandb.agent(sweep_id, function=main, count=100)
\ No newline at end of file
+    # 🐝 Step 4: Call to `wandb.agent` to start a sweep
+    wandb.agent(sweep_id, function=main, count=100)
\ No newline at end of file
@@ -3,37 +3,44 @@ import numpy as np
 import datetime as dt
 import time, math
 import logging
-logging.getLogger('client').setLevel('ERROR')
 
-import wandb
-wandb.login()
-
-from optibook.synchronous_client import Exchange
-from optistrats.strats.market_maker import OptionMarketMaker, FutureMarketMaker, StockMarketMaker
-from optistrats.utils import get_bid_ask, clear_orders, clear_position
+from optistrats.utils import get_bid_ask, flatten
+from optistrats.gateway import OrderGateway
+from optistrats.scripts.run import MARKET_MAKER_CLASSES
+from optistrats.instruments import InstrumentRegistry
+from optistrats.risk import PreTradeRiskEngine
+from optistrats.pnl import PnLEngine
 
 project_name = 'Optiver-market-making'
 
 
 # 🐝 Step 1: Define the trade function that takes in hyperparameter 
 # values from `wandb.config` and uses them to maket market on an instrument and return metric
-def trade_one_iteration(iteration, market_maker, exchange, underlying_id, wait_time, credit_ic_mode, volume_ic_mode):
+def trade_one_iteration(iteration, market_maker, exchange, underlying_id, wait_time, credit_ic_mode, volume_ic_mode, pnl):
+    """
+    Requotes <market_maker> once and returns the PnL and position after the iteration, both computed locally: the
+    fills are booked with the PnLEngine <pnl> and the position comes from the market maker's risk engine.
+    """
     print(f'')
     print(f'-----------------------------------------------------------------')
     print(f'TRADE LOOP ITERATION {iteration} ENTERED AT {str(dt.datetime.now()):18s} UTC.')
     print(f'-----------------------------------------------------------------')
     
-    market_maker.get_traded_orders(exchange)
+    instrument_id = market_maker.primal.instrument_id
+    for trade in market_maker.get_traded_orders(exchange):
+        pnl.on_trade(instrument_id, trade)
     
     stock_value = get_bid_ask(exchange, underlying_id)
     if stock_value is None:
         print('Empty stock order book on bid or ask-side, or both, unable to update option prices.')
         time.sleep(wait_time)
-        return exchange.get_pnl(), exchange.get_positions()[market_maker.primal.instrument_id]
+        return pnl.total(), market_maker.get_position(exchange)
         
 
     stock_bid, stock_ask = stock_value
     theoretical_bid_price, theoretical_ask_price = market_maker.compute_fair_quotes(stock_bid.price, stock_ask.price)
+    # only the underlying book is fetched, so the position is marked to our fair value
+    pnl.mark(instrument_id, (theoretical_bid_price + theoretical_ask_price) / 2)
     market_maker.select_credits(exchange, credit_ic_mode)
     market_maker.select_volumes(exchange, volume_ic_mode)
     market_maker.cancel_orders(exchange)
@@ -41,83 +48,71 @@ def trade_one_iteration(iteration, market_maker, exchange, underlying_id, wait_t
     
     print(f'\nSleeping for {wait_time} seconds.')
     time.sleep(wait_time)
-    return exchange.get_pnl(), exchange.get_positions()[market_maker.primal.instrument_id]
+    return pnl.total(), market_maker.get_position(exchange)
     
     
 def main():
     # Use the wandb.init() API to generate a background process 
     # to sync and log data as a Weights and Biases run.
     # Optionally provide the name of the project. 
+    import wandb
+    from optibook.synchronous_client import Exchange
+
     run = wandb.init(project=project_name)
     exchange = Exchange()
     exchange.connect()
+    gateway = OrderGateway(pool_size=8)
     # clear all orders
-    clear_orders(exchange)
-    clear_position(exchange)
+    flatten(exchange, gateway)
     
-    all_instruments = exchange.get_instruments()
+    registry = InstrumentRegistry(exchange.get_instruments())
     # note that we define values from `wandb.config` instead of 
     # defining hard values
     instrument_id = wandb.config.instrument_id
     
-    # Create market maker
-    if instrument_id[-1] == 'C' or instrument_id[-1] == 'P':
-        market_maker = OptionMarketMaker(
-            all_instruments[instrument_id],
-            wandb.config.credit,
-            wandb.config.volume,
-            wandb.config.ir,
-            wandb.config.vol,
-            wandb.config.position_limit,
-            wandb.config.tick_size
-            )
-    elif instrument_id[-1] == 'F':
-        market_maker = FutureMarketMaker(
-            all_instruments[instrument_id],
-            wandb.config.credit,
-            wandb.config.volume,
-            wandb.config.ir,
-            wandb.config.vol,
-            wandb.config.position_limit,
-            wandb.config.tick_size
-            )
-    else:
-        market_maker = StockMarketMaker(
-            all_instruments[instrument_id],
-            wandb.config.credit,
-            wandb.config.volume,
-            wandb.config.ir,
-            wandb.config.vol,
-            wandb.config.position_limit,
-            wandb.config.tick_size
-            )
-    
-    # Initializing
+    # Initializing, the only exchange reconciliation until the end of the run
+    risk = PreTradeRiskEngine(position_limit=wandb.config.position_limit)
+    risk.sync(exchange, [instrument_id])
     pnl_0 = exchange.get_pnl()
+    pnl = PnLEngine(default_strategy='market_making')
+    pnl.carry_in(risk.positions)
     epochs = wandb.config.epochs
     
+    # Create market maker
+    market_maker = MARKET_MAKER_CLASSES[registry.kind_of(instrument_id)](
+        registry.instrument(instrument_id),
+        wandb.config.credit,
+        wandb.config.volume,
+        wandb.config.ir,
+        wandb.config.vol,
+        wandb.config.position_limit,
+        wandb.config.tick_size,
+        risk=risk,
+        )
+    
     # Trading
     for epoch in np.arange(1, epochs):
-        pnl, pos = trade_one_iteration(
+        pnl_epoch, pos = trade_one_iteration(
             epoch, 
             market_maker, 
             exchange, 
             wandb.config.underlying_id, 
             wandb.config.wait_time, 
             wandb.config.credit_ic_mode, 
-            wandb.config.volume_ic_mode
+            wandb.config.volume_ic_mode,
+            pnl
             )
         wandb.log({
-            'PnL': pnl - pnl_0,
+            'PnL': pnl_epoch,
             'Position': pos
         })
         
-    # Clearing
-    clear_orders(exchange)
-    clear_position(exchange)
+    # Clearing, the closing trades are not polled, so the final PnL is read from the exchange
+    flatten(exchange, gateway)
+    gateway.close()
     pnl_1 = exchange.get_pnl()
     tot = pnl_1 - pnl_0
-    print(f'\n The cumulative PnL over the trading loop is {tot}.')
+    print(f'\n The cumulative PnL over the trading loop is {tot}, {pnl.total():.2f} before clearing.')
     wandb.log({
         'PnL': tot,
         'Position': 0
@@ -174,8 +169,15 @@ sweep_configuration = {
 
 
 
-# 🐝 Step 3: Initialize sweep by passing in config
-sweep_id = wandb.sweep(sweep=sweep_configuration, project=project_name)
+if __name__ == "__main__":
+    # wandb is slow to import and logging in needs network access, so only do it when running a sweep
+    import wandb
+
+    logging.getLogger('client').setLevel('ERROR')
+    wandb.login()
+
+    # 🐝 Step 3: Initialize sweep by passing in config
+    sweep_id = wandb.sweep(sweep=sweep_configuration, project=project_name)
 
-# 🐝 Step 4: Call to `wandb.agent` to start a sweep
-wandb.agent(sweep_id, function=main, count=100)
\ No newline at end of file
+    # 🐝 Step 4: Call to `wandb.agent` to start a sweep
+    wandb.agent(sweep_id, function=main, count=100)
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from optistrats.strats.inventory import InventoryPolicy, CREDIT_IC_MODES, VOLUME_IC_MODES
+from optistrats.utils import TICK_SIZE, TICK_EPSILON
+
+
+_SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+# the market every policy is stressed in, override any of these in `stress_test`
+MARKET = {
+    's0': 60.0,                 # initial value of the underlying
+    'volatility': 3,            # annualized, as assumed by the market makers
+    'interest_rate': .03,
+    'n_steps': 1000,            # quote updates per session
+    'step_seconds': 1.0,        # time between quote updates
+    'arrival_rate': 0.5,        # market orders per side per step hitting a quote at zero distance from fair
+    'decay': 10.0,              # arrivals fall off as exp(-decay * distance of our quote from fair)
+    'order_size': 10,           # lots per market order
+    'tick_size': TICK_SIZE,
+    }
+
+
+class SimulationResult:
+    """
+    Distributions over all simulated sessions of one policy.
+
+    pnl: array               -  Final PnL of every session, inventory marked to the final fair value
+    final_inventory: array   -  Position at the end of every session
+    peak_inventory: array    -  Largest absolute position during every session
+    traded_volume: array     -  Total lots traded in every session
+    """
+    def __init__(self, pnl, final_inventory, peak_inventory, traded_volume):
+        self.pnl = pnl
+        self.final_inventory = final_inventory
+        self.peak_inventory = peak_inventory
+        self.traded_volume = traded_volume
+
+    def summary(self):
+        return {
+            'pnl_mean': float(self.pnl.mean()),
+            'pnl_std': float(self.pnl.std()),
+            'pnl_p05': float(np.percentile(self.pnl, 5)),
+            'pnl_p95': float(np.percentile(self.pnl, 95)),
+            'final_inventory_abs_mean': float(np.abs(self.final_inventory).mean()),
+            'peak_inventory_mean': float(self.peak_inventory.mean()),
+            'traded_volume_mean': float(self.traded_volume.mean()),
+            }
+
+    @classmethod
+    def concatenate(cls, results):
+        return cls(*(np.concatenate(arrays) for arrays in zip(
+            *((result.pnl, result.final_inventory, result.peak_inventory, result.traded_volume) for result in results)
+            )))
+
+
+def simulate_sessions(policy_params, n_paths, seed, market=None):
+    """
+    Simulates <n_paths> market making sessions of one policy at once, with every path a row of the state arrays.
+    The fair value follows a geometric Brownian motion under the Black-Scholes assumptions. Every step the policy
+    quotes around the fair value with the credits and volumes of its current position, rounded outwards to the tick
+    grid, and market orders arrive on each side as a Poisson process whose rate decays with the distance of our quote
+    from fair.
+
+    policy_params: tuple     -  (credit, volume, position_limit, credit_ic_mode, volume_ic_mode) of an InventoryPolicy
+    """
+    market = dict(MARKET, **(market or {}))
+    rng = np.random.default_rng(seed)
+    policy = InventoryPolicy(*policy_params)
+    limit = policy.position_limit
+    tick_size = market['tick_size']
+    dt = market['step_seconds'] / _SECONDS_PER_YEAR
+    sigma = market['volatility']
+    drift = (market['interest_rate'] - 0.5 * sigma ** 2) * dt
+    diffusion = sigma * np.sqrt(dt)
+
+    fair = np.full(n_paths, float(market['s0']))
+    cash = np.zeros(n_paths)
+    position = np.zeros(n_paths, dtype=np.int64)
+    peak = np.zeros(n_paths, dtype=np.int64)
+    traded = np.zeros(n_paths, dtype=np.int64)
+    for _ in range(market['n_steps']):
+        credit_bid, credit_ask, volume_bid, volume_ask = policy.evaluate(position)
+        bid = np.floor((fair - credit_bid) / tick_size + TICK_EPSILON) * tick_size
+        ask = np.ceil((fair + credit_ask) / tick_size - TICK_EPSILON) * tick_size
+
+        arrivals_bid = rng.poisson(market['arrival_rate'] * np.exp(-market['decay'] * (fair - bid)))
+        arrivals_ask = rng.poisson(market['arrival_rate'] * np.exp(-market['decay'] * (ask - fair)))
+        bought = np.minimum(np.minimum(arrivals_bid * market['order_size'], volume_bid), limit - position)
+        sold = np.minimum(np.minimum(arrivals_ask * market['order_size'], volume_ask), limit + position)
+        bought, sold = np.maximum(bought, 0), np.maximum(sold, 0)
+
+        cash += sold * ask - bought * bid
+        position += bought - sold
+        traded += bought + sold
+        np.maximum(peak, np.abs(position), out=peak)
+        fair *= np.exp(drift + diffusion * rng.standard_normal(n_paths))
+
+    return SimulationResult(cash + position * fair, position, peak, traded)
+
+
+def _simulate_chunk(args):
+    return simulate_sessions(*args)
+
+
+def stress_test(policies, n_paths=10000, n_workers=None, chunk_paths=2500, seed=0, market=None):
+    """
+    Simulates <n_paths> sessions of every policy, spread in chunks of <chunk_paths> over a pool of <n_workers>
+    processes (all cores by default, in-process with 1 worker). Every chunk gets its own random stream, so results
+    only depend on <seed> and <chunk_paths>, not on the number of workers.
+
+    policies: dict           -  name -> (credit, volume, position_limit, credit_ic_mode, volume_ic_mode)
+
+    Returns a dict from name to SimulationResult.
+
+    Example usage:
+        results = stress_test({'slippery': (0.03, 80, 100, 'slippery', 'linear-deprecate')}, n_paths=10000)
+        print(results['slippery'].summary())
+    """
+    n_chunks = -(-n_paths // chunk_paths)
+    seeds = np.random.SeedSequence(seed).spawn(len(policies) * n_chunks)
+    tasks = []
+    for i, policy_params in enumerate(policies.values()):
+        for chunk in range(n_chunks):
+            paths = min(chunk_paths, n_paths - chunk * chunk_paths)
+            tasks.append((tuple(policy_params), paths, seeds[i * n_chunks + chunk], market))
+
+    if n_workers == 1:
+        chunks = [_simulate_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+            chunks = list(pool.map(_simulate_chunk, tasks))
+
+    return {
+        name: SimulationResult.concatenate(chunks[i * n_chunks:(i + 1) * n_chunks])
+        for i, name in enumerate(policies)
+        }
+
+
+if __name__ == "__main__":
+    policies = {
+        f'{credit_ic_mode}/{volume_ic_mode}': (0.03, 80, 100, credit_ic_mode, volume_ic_mode)
+        for credit_ic_mode in CREDIT_IC_MODES
+        for volume_ic_mode in VOLUME_IC_MODES
+        }
+    start = time.perf_counter()
+    results = stress_test(policies, n_paths=10000)
+    print(f'Simulated {len(policies)} policies x 10000 sessions in {time.perf_counter() - start:.1f} seconds.\n')
+    for name, result in sorted(results.items(), key=lambda item: -item[1].pnl.mean()):
+        summary = result.summary()
+        print(f'{name:35s}: PnL {summary["pnl_mean"]:9.2f} +/- {summary["pnl_std"]:8.2f} '
+              f'(5%: {summary["pnl_p05"]:9.2f}), |final inventory| {summary["final_inventory_abs_mean"]:5.1f}, '
+              f'peak inventory {summary["peak_inventory_mean"]:5.1f}')
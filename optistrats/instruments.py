@@ -0,0 +1,173 @@
+import datetime as dt
+from collections import defaultdict
+
+import numpy as np
+from optibook.common_types import OptionKind
+
+
+KIND_STOCK = 0
+KIND_FUTURE = 1
+KIND_CALL = 2
+KIND_PUT = 3
+# only used for lookups: matches both calls and puts
+KIND_OPTION = 4
+
+_SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+def _kind_of(instrument):
+    option_kind = getattr(instrument, 'option_kind', None)
+    if option_kind is not None:
+        return KIND_CALL if option_kind == OptionKind.CALL else KIND_PUT
+    if getattr(instrument, 'expiry', None) is not None:
+        return KIND_FUTURE
+    return KIND_STOCK
+
+
+def _underlying_of(instrument):
+    if instrument.base_instrument_id is not None:
+        return instrument.base_instrument_id
+    # dual listings (e.g. NVDA_DUAL) carry no base instrument but price off the primary listing
+    if instrument.instrument_id.endswith('_DUAL'):
+        return instrument.instrument_id.split('_')[0]
+    return instrument.instrument_id
+
+
+def expiry_key(expiry):
+    """
+    Returns the month key of an expiry, e.g. '202406', or None for instruments without expiry.
+    """
+    if expiry is None:
+        return None
+    return expiry.strftime('%Y%m')
+
+
+class InstrumentRegistry:
+    """
+    Indexes the instruments returned by `exchange.get_instruments()` once, so that the trading loop can look
+    instruments up by underlying, kind, expiry and strike without parsing instrument ids.
+
+    Every instrument gets a dense integer id (its position in `instrument_ids`). The arrays `kinds`, `strikes`,
+    `expiries` and `tick_sizes` are indexed by that id and can be fed straight into the vectorized pricing
+    functions of `optistrats.math.black_scholes`.
+
+    Example usage:
+        registry = InstrumentRegistry(exchange.get_instruments())
+        ids = registry.select(underlying='NVDA', kind=KIND_OPTION, expiry='202406')
+        option_strikes = registry.strikes[ids]
+    """
+    def __init__(self, all_instruments):
+        self.instrument_ids = sorted(all_instruments)
+        self.instruments = [all_instruments[instrument_id] for instrument_id in self.instrument_ids]
+        self.index = {instrument_id: i for i, instrument_id in enumerate(self.instrument_ids)}
+
+        n = len(self.instrument_ids)
+        self.kinds = np.empty(n, dtype=np.int8)
+        self.strikes = np.full(n, np.nan)
+        self.expiries = np.full(n, np.nan)
+        self.tick_sizes = np.empty(n)
+        self.underlying_ids = []
+        self.expiry_keys = []
+
+        by_key = defaultdict(list)
+        by_strike = defaultdict(list)
+        for i, instrument in enumerate(self.instruments):
+            kind = _kind_of(instrument)
+            underlying_id = _underlying_of(instrument)
+            expiry = getattr(instrument, 'expiry', None)
+            key = expiry_key(expiry)
+
+            self.kinds[i] = kind
+            self.tick_sizes[i] = getattr(instrument, 'tick_size', np.nan)
+            if expiry is not None:
+                self.expiries[i] = expiry.timestamp()
+            if kind in (KIND_CALL, KIND_PUT):
+                self.strikes[i] = instrument.strike
+                by_strike[(underlying_id, key, float(instrument.strike))].append(i)
+            self.underlying_ids.append(underlying_id)
+            self.expiry_keys.append(key)
+
+            # index every combination of (underlying, kind, expiry), with None as a wildcard,
+            # so that any lookup through `select` is a single dictionary access
+            kinds = (kind, KIND_OPTION, None) if kind in (KIND_CALL, KIND_PUT) else (kind, None)
+            for u in (underlying_id, None):
+                for k in kinds:
+                    for e in {key, None}:
+                        by_key[(u, k, e)].append(i)
+
+        self._by_key = {key: np.array(ids, dtype=np.intp) for key, ids in by_key.items()}
+        self._by_strike = {key: np.array(ids, dtype=np.intp) for key, ids in by_strike.items()}
+        self._empty = np.empty(0, dtype=np.intp)
+
+        # dense id of every instrument's underlying, or -1 if the underlying is not listed itself
+        self.underlyings = np.array(
+            [self.index.get(underlying_id, -1) for underlying_id in self.underlying_ids], dtype=np.intp
+            )
+
+    def __len__(self):
+        return len(self.instrument_ids)
+
+    def __contains__(self, instrument_id):
+        return instrument_id in self.index
+
+    def id_of(self, instrument_id):
+        return self.index[instrument_id]
+
+    def instrument(self, instrument_id):
+        return self.instruments[self.index[instrument_id]]
+
+    def kind_of(self, instrument_id):
+        return int(self.kinds[self.index[instrument_id]])
+
+    def underlying_of(self, instrument_id):
+        return self.underlying_ids[self.index[instrument_id]]
+
+    def select(self, underlying=None, kind=None, expiry=None):
+        """
+        Returns the dense ids of all instruments matching the given underlying, kind and expiry month key,
+        where None matches anything.
+
+        Example: registry.select('NVDA', KIND_OPTION, '202406') gives all options on NVDA expiring 202406.
+        """
+        return self._by_key.get((underlying, kind, expiry), self._empty)
+
+    def at_strike(self, underlying, expiry, strike):
+        """
+        Returns the dense ids of the call and put on <underlying> with the given expiry month key and strike.
+        """
+        return self._by_strike.get((underlying, expiry, float(strike)), self._empty)
+
+    def ids_to_instrument_ids(self, ids):
+        return [self.instrument_ids[i] for i in ids]
+
+    def underlying_dict(self):
+        """
+        Returns a dictionary mapping every instrument id to the instrument id of its underlying.
+        """
+        return dict(zip(self.instrument_ids, self.underlying_ids))
+
+    def time_to_expiry(self, current_time=None):
+        """
+        Returns the time to expiry in years for every instrument, NaN for instruments without expiry.
+        """
+        if current_time is None:
+            current_time = dt.datetime.now()
+        return (self.expiries - current_time.timestamp()) / _SECONDS_PER_YEAR
+
+    def new_array(self, dtype=float, fill=0):
+        """
+        Returns an array with one entry per instrument, used to hold per-instrument state.
+        """
+        return np.full(len(self), fill, dtype=dtype)
+
+    def to_array(self, values, dtype=float, fill=0):
+        """
+        Converts a dictionary keyed by instrument id (e.g. `exchange.get_positions()`) into an array indexed
+        by dense id. Unknown instrument ids are ignored.
+        """
+        array = self.new_array(dtype, fill)
+        for instrument_id, value in values.items():
+            i = self.index.get(instrument_id)
+            if i is not None:
+                array[i] = value
+        return array
@@ -0,0 +1,257 @@
+import json
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from optistrats.utils import TICK_SIZE, to_ticks, from_ticks
+
+
+# a price level as published on the bus, read like the exchange's own price levels
+Level = namedtuple('Level', ['price', 'volume'])
+TopOfBook = namedtuple('TopOfBook', ['bids', 'asks', 'timestamp'])
+
+# fields of a record, all int64
+SEQ, BID_TICKS, BID_VOLUME, ASK_TICKS, ASK_VOLUME, TIMESTAMP_NS = range(6)
+_N_FIELDS = 6
+# metadata length, slots and the feed handler's heartbeat
+_HEADER_BYTES = 24
+# a reader spins this many times on a record being written, then backs off, then gives up
+_SPINS = 100
+_MAX_RETRIES = 1000
+_BACKOFF_SECONDS = 0.0001
+
+
+class MarketDataBus:
+    """
+    Top of book of a set of instruments in shared memory, written by a single feed-handler process and read by any
+    number of strategy processes on the same machine, so every book is polled from the exchange once in total
+    instead of once per process.
+
+    Every instrument has a ring of <slots> records (bid and ask in integer ticks, their volumes and the time of
+    the update). The writer only appends a record when the touch moved. Each record is guarded by a seqlock: its
+    sequence number is odd while the writer is filling it in, and a reader retries whenever it saw an odd number
+    or the number changed during its read. Readers never block the writer and never take a lock. As for the
+    SharedRiskBlock, this relies on aligned int64 stores not being torn or reordered, which holds on x86.
+
+    The writer also stamps a heartbeat on every poll. When the heartbeat is older than <max_age> seconds, e.g.
+    because the feed handler died, readers see no books at all rather than quote on frozen ones. A reader also
+    gives up on a record whose writer never finishes it.
+
+    The instrument ids and tick size are stored in the segment itself, so readers attach by name only. A reader
+    answers `get_last_price_book`, `best_bid_ask` and `check_and_get_best_bid_ask` like the exchange and a
+    MarketDataSnapshot, so it can stand in for either as a source of books.
+
+    Example usage:
+        bus = MarketDataBus.create(['NVDA', 'NVDA_DUAL'], name='optistrats-md')     # in the feed handler
+        bus.poll(exchange)
+        bus = MarketDataBus.attach('optistrats-md')                                # in a strategy process
+        bid, ask = bus.best_bid_ask('NVDA')
+    """
+    def __init__(self, shm, instrument_ids, tick_size, slots, max_age=2.0):
+        self._shm = shm
+        self.max_age = max_age
+        self._header = np.ndarray((3,), dtype=np.int64, buffer=shm.buf)
+        self.instrument_ids = list(instrument_ids)
+        self.index = {instrument_id: i for i, instrument_id in enumerate(self.instrument_ids)}
+        self.tick_size = tick_size
+        self.slots = slots
+        n = len(self.instrument_ids)
+        offset = _HEADER_BYTES + _padded_length(self._metadata(instrument_ids, tick_size, slots))
+        # number of records ever published per instrument, the latest is in slot (head - 1) % slots
+        self.heads = np.ndarray((n,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        self.records = np.ndarray((n, slots, _N_FIELDS), dtype=np.int64, buffer=shm.buf, offset=offset + 8 * n)
+        self.retries = 0
+        self.stale_reads = 0
+        self.published = 0
+
+    @staticmethod
+    def _metadata(instrument_ids, tick_size, slots):
+        return json.dumps({'instrument_ids': list(instrument_ids), 'tick_size': tick_size, 'slots': slots}).encode()
+
+    @classmethod
+    def create(cls, instrument_ids, name=None, tick_size=TICK_SIZE, slots=64):
+        metadata = cls._metadata(instrument_ids, tick_size, slots)
+        n = len(instrument_ids)
+        size = _HEADER_BYTES + _padded_length(metadata) + 8 * n + 8 * n * slots * _N_FIELDS
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        shm.buf[_HEADER_BYTES:_HEADER_BYTES + len(metadata)] = metadata
+        header = np.ndarray((3,), dtype=np.int64, buffer=shm.buf)
+        header[1] = slots
+        # the length goes in last, readers attaching before it is set wait for it
+        header[0] = len(metadata)
+        return cls(shm, instrument_ids, tick_size, slots)
+
+    @classmethod
+    def attach(cls, name, timeout=5.0, max_age=2.0):
+        shm = shared_memory.SharedMemory(name=name)
+        deadline = time.monotonic() + timeout
+        while True:
+            metadata_length = int(np.ndarray((2,), dtype=np.int64, buffer=shm.buf)[0])
+            if metadata_length:
+                break
+            if time.monotonic() > deadline:
+                shm.close()
+                raise Exception(f'''Market data bus {name} was never initialised by its feed handler.''')
+            time.sleep(0.001)
+        metadata = json.loads(bytes(shm.buf[_HEADER_BYTES:_HEADER_BYTES + metadata_length]))
+        return cls(shm, metadata['instrument_ids'], metadata['tick_size'], metadata['slots'], max_age)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __contains__(self, instrument_id):
+        return instrument_id in self.index
+
+    def publish(self, instrument_id, order_book, timestamp_ns=None):
+        """
+        Appends the top of <order_book> to the ring of <instrument_id> if its touch moved, and returns whether it did.
+        Only the feed handler may call this.
+        """
+        i = self.index[instrument_id]
+        bids = order_book.bids if order_book else []
+        asks = order_book.asks if order_book else []
+        values = (
+            to_ticks(bids[0].price, self.tick_size) if bids else 0, bids[0].volume if bids else 0,
+            to_ticks(asks[0].price, self.tick_size) if asks else 0, asks[0].volume if asks else 0,
+            )
+        head = int(self.heads[i])
+        if head and tuple(self.records[i, (head - 1) % self.slots, BID_TICKS:TIMESTAMP_NS]) == values:
+            return False
+
+        record = self.records[i, head % self.slots]
+        record[SEQ] += 1
+        record[BID_TICKS:TIMESTAMP_NS] = values
+        record[TIMESTAMP_NS] = time.time_ns() if timestamp_ns is None else timestamp_ns
+        record[SEQ] += 1
+        self.heads[i] = head + 1
+        self.published += 1
+        self.heartbeat(record[TIMESTAMP_NS])
+        return True
+
+    def heartbeat(self, timestamp_ns=None):
+        """
+        Tells the readers the feed is alive, even when no touch moved.
+        """
+        self._header[2] = time.time_ns() if timestamp_ns is None else timestamp_ns
+
+    @property
+    def age(self):
+        """
+        Seconds since the feed handler's last heartbeat, infinite if it never polled.
+        """
+        heartbeat = int(self._header[2])
+        return (time.time_ns() - heartbeat) / 1e9 if heartbeat else float('inf')
+
+    def poll(self, exchange, instrument_ids=None):
+        """
+        Fetches the order book of every instrument (or of <instrument_ids>) once and publishes their touches.
+        Returns the ids whose touch moved.
+        """
+        if instrument_ids is None:
+            instrument_ids = self.instrument_ids
+        changed = [
+            instrument_id for instrument_id in instrument_ids
+            if self.publish(instrument_id, exchange.get_last_price_book(instrument_id=instrument_id))
+            ]
+        self.heartbeat()
+        return changed
+
+    def _read(self, i, head):
+        """
+        Returns the fields of record number <head> - 1 of instrument <i>, None if the writer has lapped it, or
+        _STUCK if the writer never finished writing it, e.g. because it died halfway.
+        """
+        record = self.records[i, (head - 1) % self.slots]
+        for attempt in range(_MAX_RETRIES):
+            seq = int(record[SEQ])
+            if not seq & 1:
+                values = record.tolist()
+                if int(record[SEQ]) == seq:
+                    break
+            self.retries += 1
+            if attempt >= _SPINS:
+                time.sleep(_BACKOFF_SECONDS)
+        else:
+            return _STUCK
+        if int(self.heads[i]) - head >= self.slots:
+            return None
+        return values
+
+    def sequence(self, instrument_id):
+        """
+        Returns the number of updates published for <instrument_id>, e.g. to tell whether its touch moved since.
+        """
+        return int(self.heads[self.index[instrument_id]])
+
+    def get_last_price_book(self, instrument_id):
+        """
+        Returns the latest top of book of <instrument_id>, with at most one bid and one ask level, or None if
+        nothing was published yet or the feed is older than <max_age> seconds.
+        """
+        if self.max_age is not None and self.age > self.max_age:
+            self.stale_reads += 1
+            return None
+        i = self.index[instrument_id]
+        while True:
+            head = int(self.heads[i])
+            if head == 0:
+                return None
+            values = self._read(i, head)
+            if values is _STUCK:
+                print(f'Market data bus record of {instrument_id} was never completed, is the feed handler alive?')
+                return None
+            if values is not None:
+                return self._top_of_book(values)
+
+    def updates(self, instrument_id, since):
+        """
+        Returns the tops of book published for <instrument_id> after the first <since> updates, oldest first, and
+        the sequence number to pass next time. Updates that were overwritten before they could be read are lost.
+        """
+        i = self.index[instrument_id]
+        head = int(self.heads[i])
+        books = []
+        for sequence in range(max(since, head - self.slots) + 1, head + 1):
+            values = self._read(i, sequence)
+            if values is not None and values is not _STUCK:
+                books.append(self._top_of_book(values))
+        return books, head
+
+    def _top_of_book(self, values):
+        bids = [Level(from_ticks(values[BID_TICKS], self.tick_size), values[BID_VOLUME])] if values[BID_VOLUME] else []
+        asks = [Level(from_ticks(values[ASK_TICKS], self.tick_size), values[ASK_VOLUME])] if values[ASK_VOLUME] else []
+        return TopOfBook(bids, asks, values[TIMESTAMP_NS])
+
+    def best_bid_ask(self, instrument_id):
+        """
+        Returns the best bid and ask of <instrument_id>, or None if either side of the book is empty or the feed is
+        stale.
+        """
+        order_book = self.get_last_price_book(instrument_id)
+        if not (order_book and order_book.bids and order_book.asks):
+            return None
+        return order_book.bids[0], order_book.asks[0]
+
+    def check_and_get_best_bid_ask(self, instrument_id):
+        quotes = self.best_bid_ask(instrument_id)
+        if quotes is None:
+            return False, None, None
+        return (True,) + quotes
+
+    def close(self):
+        self.heads = self.records = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+_STUCK = object()
+
+
+def _padded_length(metadata):
+    return -(-len(metadata) // 8) * 8
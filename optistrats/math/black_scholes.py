@@ -1,10 +1,21 @@
-from scipy import stats
 import numpy as np
 import datetime as dt
 
 
-_norm_cdf = stats.norm(0, 1).cdf
-_norm_pdf = stats.norm(0, 1).pdf
+_SQRT_2PI = np.sqrt(2 * np.pi)
+# scipy takes hundreds of milliseconds to import, so it is only loaded on the first valuation
+_ndtr = None
+
+
+def _norm_cdf(x):
+    global _ndtr
+    if _ndtr is None:
+        from scipy.special import ndtr as _ndtr
+    return _ndtr(x)
+
+
+def _norm_pdf(x):
+    return np.exp(-0.5 * x ** 2) / _SQRT_2PI
 
 
 def _d1(S, K, T, r, sigma):
@@ -213,3 +224,69 @@ def put_vega(S, K, T, r, sigma):
     """
 
     return call_vega(S, K, T, r, sigma)
+
+
+def call_gamma(S, K, T, r, sigma):
+    """
+    The gamma, i.e. the second derivative of the option value with respect to the underlying,
+    of a call option paying max(S-K, 0) at expiry, under the Black-scholes model, for an option
+    with strike <K>, expiring in <T> years, under a fixed interest rate <r>, a stock
+    volatility <sigma>, and when the current price of the underlying stock is <S>.
+
+    Parameters
+    ----------
+    S : float
+        The value of the underlying stock.
+
+    K : float
+        The strike price of the option.
+
+    T : float
+        Time to expiry in years.
+
+    r : float
+        The fixed interest rate valid between now and expiry.
+
+    sigma : float
+        The volatility of the underlying stock process.
+
+    Returns
+    -------
+    call_gamma : float
+        The gamma of the option.
+    """
+
+    return _norm_pdf(_d1(S, K, T, r, sigma)) / (S * sigma * np.sqrt(T))
+
+
+def put_gamma(S, K, T, r, sigma):
+    """
+    The gamma, i.e. the second derivative of the option value with respect to the underlying,
+    of a put option paying max(K-S, 0) at expiry, under the Black-scholes model, for an option
+    with strike <K>, expiring in <T> years, under a fixed interest rate <r>, a stock
+    volatility <sigma>, and when the current price of the underlying stock is <S>.
+
+    Parameters
+    ----------
+    S : float
+        The value of the underlying stock.
+
+    K : float
+        The strike price of the option.
+
+    T : float
+        Time to expiry in years.
+
+    r : float
+        The fixed interest rate valid between now and expiry.
+
+    sigma : float
+        The volatility of the underlying stock process.
+
+    Returns
+    -------
+    put_gamma : float
+        The gamma of the option.
+    """
+
+    return call_gamma(S, K, T, r, sigma)
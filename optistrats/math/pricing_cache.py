@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+from optibook.common_types import OptionKind
+
+from optistrats.math.black_scholes import call_value, put_value
+
+
+class TheoreticalValueCache:
+    """
+    A bounded LRU cache of Black-Scholes option values, keyed on the spot price in integer ticks, a time to expiry
+    bucket, the volatility and the interest rate. The underlying trades on a tick grid and often does not move
+    between iterations, so in a quiet market most lookups skip Black-Scholes entirely.
+
+    Values are always computed at the middle of the time bucket, so a cached value does not depend on when within
+    the bucket it was first requested.
+
+    Example usage:
+        cache = TheoreticalValueCache(maxsize=4096)
+        market_maker = OptionMarketMaker(instrument, pricer=cache)
+        ...
+        print(f'Hit rate: {cache.hit_rate:.1%}')
+    """
+    def __init__(self, maxsize=4096, spot_tick_size=0.10, time_bucket_seconds=60):
+        self.maxsize = maxsize
+        self.spot_tick_size = spot_tick_size
+        self.time_bucket = time_bucket_seconds / (365 * 24 * 60 * 60)
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f'TheoreticalValueCache({len(self)} entries, hit rate {self.hit_rate:.1%})'
+
+    def value(self, option, stock_value, time_to_expiry, interest_rate, volatility):
+        spot_ticks = round(stock_value / self.spot_tick_size)
+        time_bucket = int(time_to_expiry // self.time_bucket)
+        key = (option.instrument_id, spot_ticks, time_bucket, volatility, interest_rate)
+
+        option_value = self._values.get(key)
+        if option_value is not None:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return option_value
+
+        self.misses += 1
+        S = spot_ticks * self.spot_tick_size
+        T = (time_bucket + 0.5) * self.time_bucket
+        if option.option_kind == OptionKind.CALL:
+            option_value = call_value(S=S, K=option.strike, T=T, r=interest_rate, sigma=volatility)
+        else:
+            option_value = put_value(S=S, K=option.strike, T=T, r=interest_rate, sigma=volatility)
+        option_value = float(option_value)
+
+        self._values[key] = option_value
+        if len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+        return option_value
+
+    def invalidate(self, instrument_id=None):
+        """
+        Drops the cached values of <instrument_id>, or of all options, e.g. after a volatility or interest rate change.
+        """
+        if instrument_id is None:
+            self._values.clear()
+        else:
+            for key in [key for key in self._values if key[0] == instrument_id]:
+                del self._values[key]
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
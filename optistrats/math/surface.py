@@ -0,0 +1,191 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from optibook.common_types import OptionKind
+
+from optistrats.math.black_scholes import call_value, put_value, call_delta, put_delta
+
+
+class PriceSurface:
+    """
+    Values and deltas of a set of options on one underlying, evaluated on an evenly spaced spot grid. Every option
+    has its own interest rate and volatility.
+    """
+    def __init__(self, instrument_ids, spot_grid, values, deltas, interest_rates, volatilities):
+        self.rows = {instrument_id: row for row, instrument_id in enumerate(instrument_ids)}
+        self.spot_grid = spot_grid
+        self.step = spot_grid[1] - spot_grid[0]
+        self.values = values
+        self.deltas = deltas
+        self.interest_rates = interest_rates
+        self.volatilities = volatilities
+        self.built_at = time.monotonic()
+
+    def covers(self, stock_value, margin=0):
+        return self.spot_grid[0] + margin <= stock_value < self.spot_grid[-1] - margin
+
+    def prices(self, instrument_id, interest_rate, volatility):
+        """
+        Returns whether <instrument_id> is on the surface, evaluated at <interest_rate> and <volatility>.
+        """
+        row = self.rows.get(instrument_id)
+        return row is not None and self.interest_rates[row] == interest_rate and self.volatilities[row] == volatility
+
+    def value(self, instrument_id, stock_value):
+        """
+        Interpolates the value of <instrument_id> at <stock_value> with a cubic Hermite spline, which uses the deltas
+        on the grid to stay accurate between grid points.
+        """
+        row = self.rows[instrument_id]
+        i = min(int((stock_value - self.spot_grid[0]) // self.step), len(self.spot_grid) - 2)
+        t = (stock_value - self.spot_grid[i]) / self.step
+        t2 = t * t
+        t3 = t2 * t
+        v0, v1 = self.values[row, i], self.values[row, i + 1]
+        d0, d1 = self.deltas[row, i] * self.step, self.deltas[row, i + 1] * self.step
+        return float(
+            (2 * t3 - 3 * t2 + 1) * v0 + (t3 - 2 * t2 + t) * d0 + (-2 * t3 + 3 * t2) * v1 + (t3 - t2) * d1
+            )
+
+
+def build_price_surface(options, stock_value, time_to_expiry, interest_rate, volatility, half_width=5.0, step=0.05):
+    """
+    Evaluates the values and deltas of all <options> on a spot grid of +/- <half_width> around <stock_value>, in one
+    vectorized Black-Scholes call per quantity.
+
+    options: list            -  Option instruments on the same underlying
+    time_to_expiry: array    -  Time to expiry in years of every option
+    interest_rate: float     -  Interest rate, or an array with the interest rate of every option
+    volatility: float        -  Volatility, or an array with the volatility of every option
+    """
+    spot_grid = stock_value - half_width + step * np.arange(int(round(2 * half_width / step)) + 1)
+    S = spot_grid[np.newaxis, :]
+    K = np.array([option.strike for option in options], dtype=float)[:, np.newaxis]
+    T = np.asarray(time_to_expiry, dtype=float)[:, np.newaxis]
+    interest_rates = np.broadcast_to(np.asarray(interest_rate, dtype=float), (len(options),))
+    volatilities = np.broadcast_to(np.asarray(volatility, dtype=float), (len(options),))
+    r = interest_rates[:, np.newaxis]
+    sigma = volatilities[:, np.newaxis]
+    is_call = np.array([option.option_kind == OptionKind.CALL for option in options])[:, np.newaxis]
+
+    values = np.where(
+        is_call,
+        call_value(S, K, T, r, sigma),
+        put_value(S, K, T, r, sigma),
+        )
+    deltas = np.where(
+        is_call,
+        call_delta(S, K, T, r, sigma),
+        put_delta(S, K, T, r, sigma),
+        )
+    instrument_ids = [option.instrument_id for option in options]
+    return PriceSurface(instrument_ids, spot_grid, values, deltas, interest_rates, volatilities)
+
+
+class SurfacePricer:
+    """
+    Quotes options by interpolating into a PriceSurface per underlying, built at the latest volatility and interest
+    rate of every option, so per-option volatilities (e.g. from a VolatilitySurface) are interpolated too. Surfaces
+    are rebuilt on a background thread whenever the spot gets within <margin> of the grid edge, the surface is older
+    than <refresh_seconds>, or the volatility or interest rate of an option changed, so the quoting thread never
+    waits on a rebuild. Until the surface of an underlying is ready, or while the spot is off the grid, options are
+    priced with Black-Scholes directly.
+
+    Example usage:
+        pricer = SurfacePricer(half_width=5.0, step=0.05, refresh_seconds=5)
+        market_maker = OptionMarketMaker(instrument, pricer=pricer)
+    """
+    def __init__(self, half_width=5.0, step=0.05, margin=1.0, refresh_seconds=5):
+        self.half_width = half_width
+        self.step = step
+        self.margin = margin
+        self.refresh_seconds = refresh_seconds
+        self.interpolated = 0
+        self.direct = 0
+        # underlying_id -> list of options, and instrument_id -> (time to expiry, interest rate, volatility) of its
+        # latest valuation, registered on first valuation
+        self._options = {}
+        self._parameters = {}
+        self._surfaces = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='surface-builder')
+
+    def __repr__(self):
+        return f'SurfacePricer({self.interpolated} interpolated valuations, {self.direct} direct valuations)'
+
+    def _needs_rebuild(self, surface, instrument_id, stock_value, interest_rate, volatility):
+        return (
+            surface is None
+            or not surface.prices(instrument_id, interest_rate, volatility)
+            or not surface.covers(stock_value, self.margin)
+            or time.monotonic() - surface.built_at > self.refresh_seconds
+        )
+
+    def _rebuild(self, underlying_id, stock_value):
+        try:
+            with self._lock:
+                options = list(self._options[underlying_id])
+                time_to_expiry, interest_rates, volatilities = zip(
+                    *(self._parameters[option.instrument_id] for option in options)
+                    )
+            self._surfaces[underlying_id] = build_price_surface(
+                options, stock_value, time_to_expiry, interest_rates, volatilities, self.half_width, self.step
+                )
+        finally:
+            with self._lock:
+                self._pending.discard(underlying_id)
+
+    def _schedule_rebuild(self, underlying_id, stock_value):
+        with self._lock:
+            if underlying_id in self._pending:
+                return
+            self._pending.add(underlying_id)
+        self._builder.submit(self._rebuild, underlying_id, stock_value)
+
+    def value(self, option, stock_value, time_to_expiry, interest_rate, volatility):
+        underlying_id = option.base_instrument_id
+        with self._lock:
+            options = self._options.setdefault(underlying_id, [])
+            if option.instrument_id not in self._parameters:
+                options.append(option)
+            self._parameters[option.instrument_id] = (time_to_expiry, interest_rate, volatility)
+
+        surface = self._surfaces.get(underlying_id)
+        if self._needs_rebuild(surface, option.instrument_id, stock_value, interest_rate, volatility):
+            self._schedule_rebuild(underlying_id, stock_value)
+
+        if (
+            surface is not None
+            and surface.prices(option.instrument_id, interest_rate, volatility)
+            and surface.covers(stock_value)
+        ):
+            self.interpolated += 1
+            return surface.value(option.instrument_id, stock_value)
+
+        self.direct += 1
+        if option.option_kind == OptionKind.CALL:
+            return float(call_value(S=stock_value, K=option.strike, T=time_to_expiry, r=interest_rate, sigma=volatility))
+        else:
+            return float(put_value(S=stock_value, K=option.strike, T=time_to_expiry, r=interest_rate, sigma=volatility))
+
+    def invalidate(self, instrument_id=None):
+        """
+        Drops the surface of the underlying of <instrument_id>, or all surfaces if None. They are rebuilt in the
+        background on the next valuations.
+        """
+        if instrument_id is None:
+            self._surfaces.clear()
+            return
+        with self._lock:
+            underlying_ids = [
+                underlying_id for underlying_id, options in self._options.items()
+                if any(option.instrument_id == instrument_id for option in options)
+                ]
+        for underlying_id in underlying_ids:
+            self._surfaces.pop(underlying_id, None)
+
+    def close(self):
+        self._builder.shutdown(wait=True)
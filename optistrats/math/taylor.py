@@ -0,0 +1,69 @@
+from optibook.common_types import OptionKind
+
+from optistrats.math.black_scholes import call_value, put_value, call_delta, put_delta, call_gamma, put_gamma
+
+
+_SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+class TaylorPricer:
+    """
+    Prices options with a second-order Taylor expansion around the last full Black-Scholes reprice,
+
+        value(S) = value(S0) + delta(S0) * (S - S0) + 0.5 * gamma(S0) * (S - S0) ** 2,
+
+    and only reprices in full when the spot has moved more than <max_spot_move> away from S0, when more than
+    <max_elapsed_seconds> of time to expiry has passed, or when the volatility or interest rate changed. This makes
+    reacting to every underlying tick a few multiplications per option.
+
+    Example usage:
+        pricer = TaylorPricer(max_spot_move=0.5, max_elapsed_seconds=10)
+        market_maker = OptionMarketMaker(instrument, pricer=pricer)
+    """
+    def __init__(self, max_spot_move=0.5, max_elapsed_seconds=10):
+        self.max_spot_move = max_spot_move
+        self.max_elapsed = max_elapsed_seconds / _SECONDS_PER_YEAR
+        self.full_reprices = 0
+        self.fast_path = 0
+        # instrument_id -> (S0, T0, r, sigma, value, delta, gamma) at the last full reprice
+        self._anchors = {}
+
+    def __repr__(self):
+        return f'TaylorPricer({self.fast_path} fast path valuations, {self.full_reprices} full reprices)'
+
+    def _reprice(self, option, stock_value, time_to_expiry, interest_rate, volatility):
+        self.full_reprices += 1
+        args = dict(S=stock_value, K=option.strike, T=time_to_expiry, r=interest_rate, sigma=volatility)
+        if option.option_kind == OptionKind.CALL:
+            anchor = (float(call_value(**args)), float(call_delta(**args)), float(call_gamma(**args)))
+        else:
+            anchor = (float(put_value(**args)), float(put_delta(**args)), float(put_gamma(**args)))
+        self._anchors[option.instrument_id] = (stock_value, time_to_expiry, interest_rate, volatility) + anchor
+        return anchor[0]
+
+    def value(self, option, stock_value, time_to_expiry, interest_rate, volatility):
+        anchor = self._anchors.get(option.instrument_id)
+        if anchor is None:
+            return self._reprice(option, stock_value, time_to_expiry, interest_rate, volatility)
+
+        S0, T0, r, sigma, value, delta, gamma = anchor
+        move = stock_value - S0
+        if (
+            abs(move) > self.max_spot_move
+            or T0 - time_to_expiry > self.max_elapsed
+            or r != interest_rate
+            or sigma != volatility
+        ):
+            return self._reprice(option, stock_value, time_to_expiry, interest_rate, volatility)
+
+        self.fast_path += 1
+        return value + delta * move + 0.5 * gamma * move * move
+
+    def invalidate(self, instrument_id=None):
+        """
+        Forces a full reprice of <instrument_id>, or of all options, on their next valuation.
+        """
+        if instrument_id is None:
+            self._anchors.clear()
+        else:
+            self._anchors.pop(instrument_id, None)
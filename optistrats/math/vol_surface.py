@@ -0,0 +1,141 @@
+import numpy as np
+from optibook.common_types import OptionKind
+
+from optistrats.instruments import expiry_key
+from optistrats.math.black_scholes import call_value, put_value, call_vega
+
+
+def implied_volatility(price, S, K, T, r, is_call, initial_sigma, iterations=4, min_vol=0.01, max_vol=20.0):
+    """
+    Inverts Black-Scholes for the volatility of every option at once, with <iterations> Newton steps starting from
+    <initial_sigma>. Steps that would leave the bracket [min_vol, max_vol], narrowed after every step, bisect it
+    instead. Returns the volatilities after the last step, and whether each has converged to within 1e-4 of <price>.
+    Prices outside the no-arbitrage bounds give NaN.
+
+    price: array             -  Option prices to invert
+    is_call: array           -  True for calls, False for puts
+    initial_sigma: array     -  Starting volatilities, e.g. the previous solution
+    """
+    price, K, T = np.asarray(price, dtype=float), np.asarray(K, dtype=float), np.asarray(T, dtype=float)
+    is_call = np.asarray(is_call, dtype=bool)
+    discounted_strike = K * np.exp(-r * T)
+    lower = np.where(is_call, np.maximum(S - discounted_strike, 0), np.maximum(discounted_strike - S, 0))
+    upper = np.where(is_call, S, discounted_strike)
+    valid = (lower < price) & (price < upper) & (T > 0)
+
+    sigma = np.broadcast_to(np.asarray(initial_sigma, dtype=float), price.shape)
+    sigma = np.clip(np.where(np.isfinite(sigma), sigma, 1.0), min_vol, max_vol)
+    low, high = np.full(price.shape, min_vol), np.full(price.shape, max_vol)
+    with np.errstate(all='ignore'):
+        for _ in range(iterations):
+            error = np.where(is_call, call_value(S, K, T, r, sigma), put_value(S, K, T, r, sigma)) - price
+            # option values increase with the volatility
+            high = np.where(error > 0, sigma, high)
+            low = np.where(error < 0, sigma, low)
+            step = sigma - error / call_vega(S, K, T, r, sigma)
+            sigma = np.where((low < step) & (step < high), step, (low + high) / 2)
+        error = np.where(is_call, call_value(S, K, T, r, sigma), put_value(S, K, T, r, sigma)) - price
+    return np.where(valid, sigma, np.nan), valid & (np.abs(error) < 1e-4)
+
+
+class VolatilitySurface:
+    """
+    Fits a smile per underlying and expiry to the implied volatilities of the live option mids, as a quadratic in
+    log-moneyness log(K / F) weighted by vega. Each fit warm-starts the implied volatility solve from the previous
+    one, so that a tick only needs a few vectorized Newton steps, and blends the new smile coefficients with the
+    previous ones by <smoothing>. An expiry with fewer than three quoted strikes is fitted with a line or a flat smile.
+
+    After every fit the smile is evaluated at all strikes of the expiry, so `option_volatility` is a dict lookup.
+    Options that have not been fitted yet are priced at <initial_volatility>.
+
+    Example usage:
+        vol_surface = VolatilitySurface(interest_rate=.03)
+        vol_surface.fit(options, option_mids, stock_value, time_to_expiry)
+        market_maker = OptionMarketMaker(instrument, vol_source=vol_surface)
+    """
+    def __init__(self, interest_rate=.03, initial_volatility=3, smoothing=0.5, newton_iterations=4, min_vol=0.01,
+                 max_vol=20.0, resolution=0.01):
+        self.interest_rate = interest_rate
+        self.initial_volatility = initial_volatility
+        self.smoothing = smoothing
+        self.newton_iterations = newton_iterations
+        self.min_vol = min_vol
+        self.max_vol = max_vol
+        self.resolution = resolution
+        self.fits = 0
+        # (underlying_id, expiry key) -> smile coefficients, highest power first
+        self.smiles = {}
+        # instrument_id -> last implied volatility solution, the next solve starts from it
+        self._implied = {}
+        # instrument_id -> volatility on the fitted smile
+        self._volatilities = {}
+
+    def __repr__(self):
+        return f'VolatilitySurface({len(self.smiles)} smiles, {self.fits} fits)'
+
+    def fit(self, options, option_mids, stock_value, time_to_expiry):
+        """
+        Refits the smiles of all expiries of <options>, which share one underlying.
+
+        options: list            -  Option instruments on the same underlying
+        option_mids: array       -  Mid price of every option, NaN (or None) when its book is not two-sided
+        time_to_expiry: array    -  Time to expiry in years of every option
+        """
+        r = self.interest_rate
+        price = np.array(option_mids, dtype=float)
+        K = np.array([option.strike for option in options], dtype=float)
+        T = np.asarray(time_to_expiry, dtype=float)
+        is_call = np.array([option.option_kind == OptionKind.CALL for option in options])
+        moneyness = np.log(K / (stock_value * np.exp(r * T)))
+        initial_sigma = np.array(
+            [self._implied.get(option.instrument_id, self.initial_volatility) for option in options]
+            )
+
+        sigma, converged = implied_volatility(
+            price, stock_value, K, T, r, is_call, initial_sigma, self.newton_iterations, self.min_vol, self.max_vol
+            )
+        vega = call_vega(stock_value, K, np.maximum(T, 1e-8), r, np.where(np.isnan(sigma), initial_sigma, sigma))
+        for option, implied in zip(options, sigma):
+            if not np.isnan(implied):
+                self._implied[option.instrument_id] = implied
+
+        expiries = np.array([expiry_key(option.expiry) for option in options])
+        for expiry in np.unique(expiries):
+            in_expiry = expiries == expiry
+            points = in_expiry & converged
+            n_points = int(points.sum())
+            if n_points == 0:
+                continue
+            key = (options[0].base_instrument_id, expiry)
+            coefficients = np.zeros(3)
+            coefficients[3 - min(n_points, 3):] = np.polyfit(
+                moneyness[points], sigma[points], min(n_points, 3) - 1, w=np.sqrt(vega[points])
+                )
+            previous = self.smiles.get(key)
+            if previous is not None:
+                coefficients = self.smoothing * previous + (1 - self.smoothing) * coefficients
+            self.smiles[key] = coefficients
+
+            fitted = np.clip(np.polyval(coefficients, moneyness[in_expiry]), self.min_vol, self.max_vol)
+            fitted = np.round(fitted / self.resolution) * self.resolution
+            for i, volatility in zip(np.flatnonzero(in_expiry), fitted):
+                self._volatilities[options[i].instrument_id] = float(volatility)
+        self.fits += 1
+
+    def option_volatility(self, option):
+        return self._volatilities.get(option.instrument_id, self.initial_volatility)
+
+    def state(self):
+        """
+        Returns the fitted smiles and implied volatilities to carry over a restart.
+        """
+        return {
+            'smiles': {key: coefficients.tolist() for key, coefficients in self.smiles.items()},
+            'implied': {instrument_id: float(sigma) for instrument_id, sigma in self._implied.items()},
+            'volatilities': dict(self._volatilities),
+            }
+
+    def restore(self, state):
+        self.smiles.update({key: np.array(coefficients) for key, coefficients in state['smiles'].items()})
+        self._implied.update(state['implied'])
+        self._volatilities.update(state['volatilities'])
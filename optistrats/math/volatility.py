@@ -0,0 +1,144 @@
+import math
+import time
+
+
+_SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+# E|Z| ** 2 for a standard normal Z, scales bipower variation to variance
+_BIPOWER_SCALE = math.pi / 2
+_PARKINSON_SCALE = 1 / (4 * math.log(2))
+
+
+class RealizedVolatilityEstimator:
+    """
+    Streaming, annualized realized volatility of one underlying from its mid price updates, in O(1) time and constant
+    memory per update. Three estimators are maintained side by side, each an exponentially time-weighted average with
+    a half-life of <halflife_seconds>:
+
+        ewma:       squared log returns
+        bipower:    products of consecutive absolute log returns, which is robust to isolated jumps
+        parkinson:  squared log high/low range of bars of <bar_seconds>
+
+    Until <min_observations> returns have been seen, `volatility` returns <initial_volatility>. Estimates are rounded
+    to <resolution>, so that pricers keyed on the volatility are not invalidated by every tiny change, and are never
+    lower than <resolution>, as a volatility of zero cannot be priced.
+
+    Example usage:
+        estimator = RealizedVolatilityEstimator(initial_volatility=3)
+        estimator.update(mid)
+        sigma = estimator.volatility
+    """
+    def __init__(self, halflife_seconds=300, bar_seconds=30, initial_volatility=3, min_observations=20,
+                 method='ewma', resolution=0.01):
+        if method not in ('ewma', 'bipower', 'parkinson'):
+            raise NotImplementedError(f"The {method} volatility estimator has not been implemented.")
+        self.halflife = halflife_seconds
+        self.bar_seconds = bar_seconds
+        self.initial_volatility = initial_volatility
+        self.min_observations = min_observations
+        self.method = method
+        self.resolution = resolution
+        self.observations = 0
+        initial_variance = initial_volatility ** 2
+        self.variances = {'ewma': initial_variance, 'bipower': initial_variance, 'parkinson': initial_variance}
+        self._last_mid = None
+        self._last_time = None
+        self._last_abs_return = None
+        self._bar_start = None
+        self._bar_high = None
+        self._bar_low = None
+
+    def _decay(self, method, elapsed, variance_rate):
+        # weight 1 - exp(-elapsed / halflife) makes the average independent of how often we sample
+        weight = -math.expm1(-elapsed * math.log(2) / self.halflife)
+        self.variances[method] += weight * (variance_rate - self.variances[method])
+
+    def update(self, mid, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if mid is None or mid <= 0:
+            return
+
+        if self._last_mid is not None and timestamp > self._last_time:
+            elapsed = timestamp - self._last_time
+            years = elapsed / _SECONDS_PER_YEAR
+            log_return = math.log(mid / self._last_mid)
+            abs_return = abs(log_return)
+            self._decay('ewma', elapsed, log_return * log_return / years)
+            if self._last_abs_return is not None:
+                self._decay('bipower', elapsed, _BIPOWER_SCALE * abs_return * self._last_abs_return / years)
+            self._last_abs_return = abs_return
+            self.observations += 1
+
+        if self._bar_start is None:
+            self._bar_start, self._bar_high, self._bar_low = timestamp, mid, mid
+        else:
+            self._bar_high = max(self._bar_high, mid)
+            self._bar_low = min(self._bar_low, mid)
+            bar_elapsed = timestamp - self._bar_start
+            if bar_elapsed >= self.bar_seconds:
+                log_range = math.log(self._bar_high / self._bar_low)
+                years = bar_elapsed / _SECONDS_PER_YEAR
+                self._decay('parkinson', bar_elapsed, _PARKINSON_SCALE * log_range * log_range / years)
+                self._bar_start, self._bar_high, self._bar_low = timestamp, mid, mid
+
+        self._last_mid = mid
+        self._last_time = timestamp
+
+    def estimate(self, method=None):
+        """
+        Returns the unrounded annualized volatility of <method>, or of the configured method.
+        """
+        return math.sqrt(self.variances[method or self.method])
+
+    def state(self):
+        """
+        Returns the estimates to carry over a restart. The last mid and bar are not kept, their timestamps come from
+        a monotonic clock that does not survive the process.
+        """
+        return {'variances': dict(self.variances), 'observations': self.observations}
+
+    def restore(self, state):
+        self.variances.update(state['variances'])
+        self.observations = state['observations']
+
+    @property
+    def volatility(self):
+        if self.observations < self.min_observations:
+            return self.initial_volatility
+        return max(round(self.estimate() / self.resolution), 1) * self.resolution
+
+
+class RealizedVolatilityBook:
+    """
+    One RealizedVolatilityEstimator per underlying, created on the first update of that underlying.
+
+    Example usage:
+        vol_book = RealizedVolatilityBook(initial_volatility=3)
+        vol_book.update('NVDA', mid)
+        market_maker = OptionMarketMaker(instrument, vol_source=vol_book)
+    """
+    def __init__(self, **estimator_kwargs):
+        self.estimator_kwargs = estimator_kwargs
+        self.estimators = {}
+
+    def estimator(self, underlying_id):
+        estimator = self.estimators.get(underlying_id)
+        if estimator is None:
+            estimator = self.estimators[underlying_id] = RealizedVolatilityEstimator(**self.estimator_kwargs)
+        return estimator
+
+    def update(self, underlying_id, mid, timestamp=None):
+        self.estimator(underlying_id).update(mid, timestamp)
+
+    def volatility(self, underlying_id):
+        return self.estimator(underlying_id).volatility
+
+    def option_volatility(self, option):
+        return self.volatility(option.base_instrument_id)
+
+    def state(self):
+        return {underlying_id: estimator.state() for underlying_id, estimator in self.estimators.items()}
+
+    def restore(self, state):
+        for underlying_id, estimator_state in state.items():
+            self.estimator(underlying_id).restore(estimator_state)
@@ -0,0 +1,255 @@
+import json
+import time
+import threading
+import logging
+import logging.handlers
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricsRegistry:
+    """
+    In-process counters, gauges and latency summaries, each identified by a name and optional labels. Updating a
+    metric is a dict update under a lock, so it can be done from the hot path and from the OrderGateway's threads.
+    The values are read by a MetricsServer and a RollingMetricsFile in the background.
+
+    Example usage:
+        metrics = MetricsRegistry()
+        metrics.inc('orders_inserted', instrument_id='NVDA')
+        metrics.set('pnl', 1250.0)
+        metrics.observe('exchange_call_seconds', 0.004, method='insert_order')
+        print(metrics.render())
+    """
+    def __init__(self, prefix='optistrats'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # name -> 'counter', 'gauge' or 'summary'
+        self._types = {}
+        # (name, labels) -> value, or [count, sum, max] for summaries
+        self._values = {}
+
+    def _key(self, name, kind, labels):
+        if self._types.setdefault(name, kind) != kind:
+            raise Exception(f'''Metric {name} is a {self._types[name]}, not a {kind}.''')
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, 'counter', labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, 'gauge', labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, 'summary', labels)
+        with self._lock:
+            summary = self._values.get(key)
+            if summary is None:
+                self._values[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    def value(self, name, **labels):
+        value = self._values.get((name, tuple(sorted(labels.items()))))
+        return list(value) if isinstance(value, list) else value
+
+    def _samples(self):
+        """
+        Yields the (sample name, Prometheus type, labels, value) of every metric.
+        """
+        with self._lock:
+            items = [(key, list(value) if isinstance(value, list) else value) for key, value in self._values.items()]
+        for (name, labels), value in sorted(items):
+            full_name = f'{self.prefix}_{name}'
+            label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+            label_text = f'{{{label_text}}}' if label_text else ''
+            kind = self._types[name]
+            if kind == 'counter':
+                yield f'{full_name}_total', 'counter', label_text, value
+            elif kind == 'gauge':
+                yield full_name, 'gauge', label_text, value
+            else:
+                count, total, maximum = value
+                yield f'{full_name}_count', 'counter', label_text, count
+                yield f'{full_name}_sum', 'counter', label_text, total
+                yield f'{full_name}_max', 'gauge', label_text, maximum
+
+    def snapshot(self):
+        """
+        Returns all current values as a flat dict from Prometheus sample (name and labels) to value.
+        """
+        return {f'{name}{labels}': value for name, _, labels, value in self._samples()}
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        samples = {}
+        for name, kind, labels, value in self._samples():
+            samples.setdefault((name, kind), []).append(f'{name}{labels} {value}')
+        lines = []
+        for (name, kind), name_samples in sorted(samples.items()):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(name_samples)
+        return '\n'.join(lines) + '\n'
+
+
+class CycleMeter:
+    """
+    Counts the iterations of a loop and keeps the loop rate over the last <window> seconds as a gauge.
+    """
+    def __init__(self, metrics, name='cycles', window=10.0, clock=time.monotonic):
+        self.metrics = metrics
+        self.name = name
+        self.window = window
+        self.clock = clock
+        self._window_start = clock()
+        self._window_cycles = 0
+
+    def tick(self):
+        self.metrics.inc(self.name)
+        self._window_cycles += 1
+        now = self.clock()
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            self.metrics.set(f'{self.name}_per_second', self._window_cycles / elapsed)
+            self._window_start, self._window_cycles = now, 0
+
+
+class InstrumentedExchange:
+    """
+    Wraps an exchange client to time every call, per method, and to count order inserts, deletes and fills per
+    instrument. Anything else is passed through, so it can stand in for the exchange anywhere.
+
+    Example usage:
+        exchange = InstrumentedExchange(exchange, metrics)
+        gateway = OrderGateway(pool_size=4, risk=risk, metrics=metrics)
+    """
+    def __init__(self, exchange, metrics):
+        self._exchange = exchange
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._exchange, name)
+        if not callable(attribute):
+            return attribute
+        metrics = self._metrics
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            result = attribute(*args, **kwargs)
+            metrics.observe('exchange_call_seconds', time.perf_counter() - start, method=name)
+            if name in _COUNTED_CALLS:
+                _COUNTED_CALLS[name](metrics, kwargs.get('instrument_id', args[0] if args else None), result)
+            return result
+
+        # cached on the instance, so the wrapper is only built on the first call
+        setattr(self, name, call)
+        return call
+
+
+def _count_insert(metrics, instrument_id, response):
+    if getattr(response, 'success', True):
+        metrics.inc('orders_inserted', instrument_id=instrument_id)
+    else:
+        metrics.inc('orders_rejected', instrument_id=instrument_id)
+
+
+def _count_delete(metrics, instrument_id, response):
+    metrics.inc('order_deletes', instrument_id=instrument_id)
+
+
+def _count_delete_all(metrics, instrument_id, response):
+    # the exchange does not say how many orders it deleted, so these calls are not counted as order deletes
+    metrics.inc('delete_all_calls', instrument_id=instrument_id)
+
+
+def _count_fills(metrics, instrument_id, trades):
+    if trades:
+        metrics.inc('fills', len(trades), instrument_id=instrument_id)
+        metrics.inc('filled_lots', sum(trade.volume for trade in trades), instrument_id=instrument_id)
+
+
+_COUNTED_CALLS = {
+    'insert_order': _count_insert,
+    'delete_order': _count_delete,
+    'delete_orders': _count_delete_all,
+    'poll_new_trades': _count_fills,
+    }
+
+
+class MetricsServer:
+    """
+    Serves the Prometheus text format of <metrics> on http://<host>:<port>/metrics from a background thread.
+    """
+    def __init__(self, metrics, port=9108, host='127.0.0.1'):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RollingMetricsFile:
+    """
+    Appends a json line with all metrics to <path> every <interval> seconds from a background thread, rolling
+    over to <path>.1 ... <path>.<backups> when the file reaches <max_bytes>.
+    """
+    def __init__(self, metrics, path='metrics.jsonl', interval=10.0, max_bytes=10_000_000, backups=5):
+        self.metrics = metrics
+        self.interval = interval
+        self._handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        line = json.dumps({'time': time.time(), 'metrics': self.metrics.snapshot()})
+        self._handler.emit(logging.makeLogRecord({'msg': line}))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-file', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        self._handler.close()
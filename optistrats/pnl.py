@@ -0,0 +1,175 @@
+from collections import defaultdict
+
+
+class _Ledger:
+    """
+    Position and PnL of one strategy in one instrument.
+    """
+    __slots__ = ('position', 'cost', 'realized', 'spread_capture', 'inventory_drift', 'volume')
+
+    def __init__(self):
+        self.position = 0
+        # cost basis of the open position, position * average price
+        self.cost = 0.0
+        self.realized = 0.0
+        self.spread_capture = 0.0
+        self.inventory_drift = 0.0
+        self.volume = 0
+
+    def fill(self, quantity, price, mark):
+        """
+        Books a signed fill of <quantity> lots at <price> while the instrument is marked at <mark>.
+        """
+        self.volume += abs(quantity)
+        # the edge against the mark at the time of the fill, positive when we bought below or sold above it
+        self.spread_capture += quantity * (mark - price)
+        if self.position == 0 or (quantity > 0) == (self.position > 0):
+            self.cost += quantity * price
+            self.position += quantity
+            return
+        average_price = self.cost / self.position
+        closing = max(quantity, -self.position) if quantity < 0 else min(quantity, -self.position)
+        self.realized -= closing * (price - average_price)
+        self.position += closing
+        self.cost = average_price * self.position
+        opening = quantity - closing
+        if opening:
+            self.cost += opening * price
+            self.position += opening
+
+    def unrealized(self, mark):
+        return self.position * mark - self.cost
+
+
+class PnLEngine:
+    """
+    Streaming PnL per instrument and per strategy, computed locally from our own fills and the marks of the local
+    books, without asking the exchange. Every fill is booked at average cost, so the PnL splits into realized
+    (closed lots) and unrealized (open position marked to the latest mid).
+
+    The same PnL is also attributed to its two sources:
+        spread capture:   the edge of every fill against the mark at the time of the fill
+        inventory drift:  the moves of the marks while we held a position
+    which add up to the total (realized + unrealized) PnL at all times.
+
+    Fills are attributed to the strategy that sent the order, using the tags of an OrderGateway, and otherwise to
+    <default_strategy>.
+
+    Example usage:
+        pnl = PnLEngine(gateway)
+        pnl.on_trade('NVDA', trade)
+        pnl.mark('NVDA', 25.05)
+        print(pnl.total(), pnl.report())
+    """
+    def __init__(self, gateway=None, default_strategy='untagged'):
+        self.gateway = gateway
+        self.default_strategy = default_strategy
+        # (instrument_id, strategy) -> _Ledger
+        self.ledgers = {}
+        self._ledgers_by_instrument = defaultdict(list)
+        self.marks = {}
+        # positions held before we started booking fills, opened at their first mark
+        self._carried = {}
+
+    def _ledger(self, instrument_id, strategy):
+        ledger = self.ledgers.get((instrument_id, strategy))
+        if ledger is None:
+            ledger = self.ledgers[instrument_id, strategy] = _Ledger()
+            self._ledgers_by_instrument[instrument_id].append((strategy, ledger))
+        return ledger
+
+    def carry_in(self, positions, strategy=None):
+        """
+        Registers positions we already held, e.g. after a restart. Each is booked as bought at its first mark,
+        so only the PnL made from then on is counted, and belongs to <strategy> (by default <default_strategy>).
+        """
+        if strategy is None:
+            strategy = self.default_strategy
+        for instrument_id, position in positions.items():
+            if position:
+                self._carried[instrument_id] = (position, strategy)
+
+    def mark(self, instrument_id, mid):
+        if mid is None or mid != mid:
+            return
+        carried = self._carried.pop(instrument_id, None)
+        if carried is not None:
+            position, strategy = carried
+            ledger = self._ledger(instrument_id, strategy)
+            ledger.position += position
+            ledger.cost += position * mid
+        previous = self.marks.get(instrument_id)
+        if previous is not None and mid != previous:
+            for _, ledger in self._ledgers_by_instrument[instrument_id]:
+                ledger.inventory_drift += ledger.position * (mid - previous)
+        self.marks[instrument_id] = mid
+
+    def mark_books(self, books, instrument_ids=None):
+        """
+        Marks every instrument we hold (or <instrument_ids>) to the mid of its book in <books>, e.g. a
+        MarketDataSnapshot, an OrderBookCache or a MarketDataBus. Instruments without a two-sided book keep their
+        previous mark.
+        """
+        if instrument_ids is None:
+            instrument_ids = list(self._ledgers_by_instrument) + list(self._carried)
+        for instrument_id in instrument_ids:
+            try:
+                quotes = books.best_bid_ask(instrument_id)
+            except KeyError:
+                continue
+            if quotes is not None:
+                self.mark(instrument_id, (quotes[0].price + quotes[1].price) / 2)
+
+    def on_fill(self, instrument_id, side, volume, price, strategy=None):
+        if strategy is None:
+            strategy = self.default_strategy
+        mark = self.marks.get(instrument_id)
+        if mark is None:
+            # nothing to measure the edge against yet, the fill price is the best mark we have
+            mark = self.marks[instrument_id] = price
+        self._ledger(instrument_id, strategy).fill(volume if side == 'bid' else -volume, price, mark)
+
+    def on_trade(self, instrument_id, trade, strategy=None):
+        """
+        Books one of our trades as returned by `exchange.poll_new_trades`.
+        """
+        if strategy is None and self.gateway is not None:
+            strategy = self.gateway.order_tags.get(trade.order_id)
+        self.on_fill(instrument_id, trade.side, trade.volume, trade.price, strategy)
+
+    def _totals(self, group):
+        totals = defaultdict(lambda: {
+            'position': 0, 'realized': 0.0, 'unrealized': 0.0, 'total': 0.0, 'spread_capture': 0.0,
+            'inventory_drift': 0.0, 'volume': 0,
+            })
+        for (instrument_id, strategy), ledger in self.ledgers.items():
+            unrealized = ledger.unrealized(self.marks[instrument_id])
+            row = totals[group(instrument_id, strategy)]
+            row['position'] += ledger.position
+            row['realized'] += ledger.realized
+            row['unrealized'] += unrealized
+            row['total'] += ledger.realized + unrealized
+            row['spread_capture'] += ledger.spread_capture
+            row['inventory_drift'] += ledger.inventory_drift
+            row['volume'] += ledger.volume
+        return dict(totals)
+
+    def report(self):
+        """
+        Returns the positions, PnL and attribution per instrument.
+        """
+        return self._totals(lambda instrument_id, strategy: instrument_id)
+
+    def by_strategy(self):
+        return self._totals(lambda instrument_id, strategy: strategy)
+
+    def total(self):
+        return self._totals(lambda instrument_id, strategy: None).get(None, {}).get('total', 0.0)
+
+    def print_report(self):
+        for title, rows in (('instrument', self.report()), ('strategy', self.by_strategy())):
+            print(f'{title:20s} {"position":>8s} {"realized":>10s} {"unrealized":>10s} {"spread":>10s} {"drift":>10s}')
+            for name, row in sorted(rows.items()):
+                print(f'{name:20s} {row["position"]:8d} {row["realized"]:10.2f} {row["unrealized"]:10.2f} '
+                      f'{row["spread_capture"]:10.2f} {row["inventory_drift"]:10.2f}')
+        print(f'Total PnL: {self.total():.2f}.')
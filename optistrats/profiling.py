@@ -0,0 +1,225 @@
+import os
+import io
+import sys
+import time
+import signal
+import cProfile
+import pstats
+import threading
+import functools
+import collections
+import datetime as dt
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler: a background thread samples the stack of <thread_id> every <interval>
+    seconds and counts how often each stack is seen, so the profiled thread itself runs at full speed. When
+    <active> is given, only samples for which active() is True are counted, e.g. to profile a single stage.
+    """
+    def __init__(self, thread_id, interval=0.005, active=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.active = active
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or (self.active is not None and not self.active()):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_report(self, path):
+        """
+        Writes the sampled stacks in the collapsed format read by flamegraph tools to <path>.folded, and the
+        functions seen most often (inclusive and on top of the stack) to <path>.txt.
+        """
+        with open(f'{path}.folded', 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+        inclusive, on_top = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(';')
+            on_top[functions[-1]] += count
+            for function in set(functions):
+                inclusive[function] += count
+        with open(f'{path}.txt', 'w') as file:
+            file.write(f'{self.samples} samples every {self.interval * 1000:.1f} ms.\n\n')
+            for title, counter in (('Inclusive', inclusive), ('On top of the stack', on_top)):
+                file.write(f'{title}:\n')
+                for function, count in counter.most_common(40):
+                    file.write(f'{100 * count / max(self.samples, 1):6.1f}%  {function}\n')
+                file.write('\n')
+
+
+class _DeterministicProfiler:
+    """
+    cProfile behind the same interface as the SamplingProfiler.
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def write_report(self, path):
+        self.profile.dump_stats(f'{path}.prof')
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(60)
+        with open(f'{path}.txt', 'w') as file:
+            file.write(stream.getvalue())
+
+
+class ProfilingController:
+    """
+    Starts and stops profiling of a running trading loop without restarting it. A profiling session is requested
+    by sending the process <signum> (SIGUSR1 by default) or by creating <control_file>, optionally containing the
+    number of seconds to profile for. Requesting again while a session runs stops it early. The loop calls `poll`
+    once per iteration, which starts a requested session and, after <duration> seconds, stops it and writes its
+    report to <report_dir>.
+
+    By default the whole loop of the thread calling `poll` is profiled. After `wrap_stage`, only the time spent in
+    that stage is.
+
+    mode: str                -  'sampling' for a SamplingProfiler, 'cprofile' for the deterministic cProfile
+
+    Example usage:
+        profiler = ProfilingController(control_file='/tmp/optistrats.profile', duration=30)
+        profiler.install()
+        profiler.wrap_stage([OptionMarketMaker], 'compute_fair_quotes')
+        while True:
+            profiler.poll()
+            ...
+        $ kill -USR1 <pid>   or   $ echo 60 > /tmp/optistrats.profile
+    """
+    def __init__(self, report_dir='profiles', duration=30, mode='sampling', control_file=None,
+                 signum=getattr(signal, 'SIGUSR1', None), interval=0.005):
+        if mode not in ('sampling', 'cprofile'):
+            raise NotImplementedError(f"Profiling mode {mode} is not implemented.")
+        self.report_dir = report_dir
+        self.duration = duration
+        self.mode = mode
+        self.control_file = control_file
+        self.signum = signum
+        self.interval = interval
+        self.stage = None
+        self.reports = []
+        self._requested = None
+        self._profiler = None
+        self._started_at = None
+        self._session_duration = None
+        self._stage_depth = 0
+
+    @property
+    def active(self):
+        return self._profiler is not None
+
+    def install(self):
+        """
+        Registers the signal handler. Must be called from the main thread, where Python runs signal handlers.
+        """
+        if self.signum is not None:
+            signal.signal(self.signum, lambda signum, frame: self.request())
+
+    def request(self, duration=None):
+        """
+        Requests a profiling session of <duration> seconds (or stops the current one) at the next `poll`.
+        """
+        self._requested = duration or self.duration
+
+    def wrap_stage(self, targets, name):
+        """
+        Restricts profiling to the method <name> of every class or object in <targets>.
+        """
+        self.stage = name
+        for target in targets:
+            setattr(target, name, self._wrap(getattr(target, name)))
+
+    def _wrap(self, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            # only the outermost call switches a cProfile on and off, e.g. when a subclass calls its parent's stage
+            profiler = self._profiler
+            outermost = self._stage_depth == 0
+            self._stage_depth += 1
+            if outermost and self.mode == 'cprofile' and profiler is not None:
+                profiler.enable()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._stage_depth -= 1
+                if outermost and self.mode == 'cprofile' and profiler is not None:
+                    profiler.disable()
+        return wrapper
+
+    def _poll_control_file(self):
+        if self.control_file is None or not os.path.exists(self.control_file):
+            return
+        try:
+            with open(self.control_file) as file:
+                content = file.read().strip()
+            os.remove(self.control_file)
+        except OSError:
+            return
+        self.request(float(content) if content.replace('.', '', 1).isdigit() else None)
+
+    def poll(self):
+        self._poll_control_file()
+        requested, self._requested = self._requested, None
+        if self.active:
+            if requested is not None or time.monotonic() - self._started_at >= self._session_duration:
+                return self.stop()
+        elif requested is not None:
+            self.start(requested)
+
+    def start(self, duration=None):
+        if self.mode == 'sampling':
+            active = (lambda: self._stage_depth > 0) if self.stage is not None else None
+            self._profiler = SamplingProfiler(threading.get_ident(), self.interval, active)
+        else:
+            self._profiler = _DeterministicProfiler()
+        self._session_duration = duration or self.duration
+        self._started_at = time.monotonic()
+        # a stage is only profiled while it runs, see `_wrap`
+        if self.mode == 'sampling' or self.stage is None:
+            self._profiler.enable()
+        print(f'Started {self.mode} profiling of {self.stage or "the main loop"} for {self._session_duration} seconds.')
+
+    def stop(self):
+        """
+        Stops the current session and returns the path of its report, without extension.
+        """
+        profiler, self._profiler = self._profiler, None
+        if self.mode == 'sampling' or self.stage is None:
+            profiler.disable()
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f'{self.stage or "loop"}-{dt.datetime.now():%Y%m%d-%H%M%S}')
+        profiler.write_report(path)
+        self.reports.append(path)
+        print(f'Stopped profiling after {time.monotonic() - self._started_at:.1f} seconds, report written to {path}.txt.')
+        return path
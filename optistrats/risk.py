@@ -0,0 +1,231 @@
+import itertools
+from collections import defaultdict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedRiskBlock:
+    """
+    Positions and delta exposures of every instrument in an `InstrumentRegistry`, stored in shared memory so that
+    the processes of a sharded runner all see the same risk picture.
+
+    Each instrument is traded by exactly one shard, which is the only writer of its slot. Every other process
+    only reads, so no locking is needed: single float64 writes are not torn on the platforms we run on.
+
+    Example usage:
+        risk = SharedRiskBlock(registry, create=True)          # in the parent process
+        risk = SharedRiskBlock(registry, name=risk.name)       # in a worker process
+    """
+    def __init__(self, registry, name=None, create=False):
+        self.registry = registry
+        size = 2 * len(registry) * np.dtype(np.float64).itemsize
+        if create:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            if self._shm.size < size:
+                raise Exception(f'''Shared risk block {name} holds {self._shm.size} bytes, expected {size}. Were the instruments listed differently?''')
+        self._array = np.ndarray((2, len(registry)), dtype=np.float64, buffer=self._shm.buf)
+        if create:
+            self._array[:] = 0
+        # positions in lots, and position-weighted delta exposure in units of the underlying
+        self.positions = self._array[0]
+        self.deltas = self._array[1]
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def publish(self, ids, positions, deltas):
+        """
+        Publishes the positions and per-lot deltas of the instruments with dense ids <ids>.
+        """
+        self.positions[ids] = positions
+        self.deltas[ids] = np.asarray(positions) * np.asarray(deltas)
+
+    def position(self, instrument_id):
+        return float(self.positions[self.registry.id_of(instrument_id)])
+
+    def net_delta(self, underlying_id):
+        """
+        Returns the net delta of all published positions on <underlying_id>, across every shard.
+        """
+        return float(self.deltas[self.registry.select(underlying_id)].sum())
+
+    def gross_position(self):
+        return float(np.abs(self.positions).sum())
+
+    def would_breach_position_limit(self, instrument_id, volume, side, position_limit=100):
+        position = self.position(instrument_id)
+        if side == 'bid':
+            return position + volume > position_limit
+        elif side == 'ask':
+            return position - volume < -position_limit
+        else:
+            raise Exception(f'''Invalid side provided: {side}, expecting 'bid' or 'ask'.''')
+
+    def close(self):
+        self.positions = self.deltas = self._array = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class PreTradeRiskEngine:
+    """
+    Keeps track of our filled position and the volume of our working orders per instrument and side, updated from
+    our own order acknowledgements, deletes and fills. Limit checks are answered locally, counting the worst case
+    in which every working order on a side gets filled. An order that is sent but not yet acknowledged already
+    counts as working: its volume is reserved when it is sent and released once it is rejected, or handed over to
+    the acknowledged order.
+
+    Example usage:
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.sync(exchange)
+        volume = risk.allowed_volume('NVDA_202406_050C', 'bid', 80)
+    """
+    def __init__(self, position_limit=100, shared=None, gross_position_limit=None):
+        self.position_limit = position_limit
+        # with a SharedRiskBlock, orders are also sized to keep the gross position of all shards within the limit
+        self.shared = shared
+        self.gross_position_limit = gross_position_limit
+        self.positions = defaultdict(int)
+        self.working = {'bid': defaultdict(int), 'ask': defaultdict(int)}
+        # order_id -> [instrument_id, side, remaining volume]
+        self.orders = {}
+        # order_id -> volume of fills booked by on_fill_confirmed whose trades have not been polled yet
+        self.confirmed_fills = {}
+        # reservation -> [instrument_id, side, volume] of the orders sent but not yet answered
+        self.reserved = {}
+        self._reservations = itertools.count()
+
+    def sync(self, exchange, instrument_ids=None):
+        """
+        Resets the local state to the positions and outstanding orders known by the exchange.
+        """
+        self.positions = defaultdict(int, exchange.get_positions())
+        self.working = {'bid': defaultdict(int), 'ask': defaultdict(int)}
+        self.orders = {}
+        self.reserved = {}
+        for instrument_id in instrument_ids or exchange.get_instruments():
+            for order_id, order in exchange.get_outstanding_orders(instrument_id).items():
+                self.on_order_inserted(instrument_id, order_id, order.side, order.volume)
+
+    def position(self, instrument_id):
+        return self.positions[instrument_id]
+
+    def publish(self, ids, instrument_ids, deltas):
+        """
+        Publishes our positions in <instrument_ids>, with dense ids <ids> and per-lot <deltas>, to the shared risk
+        block.
+        """
+        self.shared.publish(ids, [self.positions[instrument_id] for instrument_id in instrument_ids], deltas)
+
+    def order_ids(self, instrument_id):
+        return [order_id for order_id, order in self.orders.items() if order[0] == instrument_id]
+
+    def worst_case_position(self, instrument_id, side):
+        if side == 'bid':
+            return self.positions[instrument_id] + self.working['bid'][instrument_id]
+        elif side == 'ask':
+            return self.positions[instrument_id] - self.working['ask'][instrument_id]
+        else:
+            raise Exception(f'''Invalid side provided: {side}, expecting 'bid' or 'ask'.''')
+
+    def allowed_volume(self, instrument_id, side, volume, position_limit=None):
+        """
+        Returns <volume> sized down so that the order cannot take us over the position limit, even if it and all
+        our working orders on the same side were filled. With a shared risk block and a gross position limit, the
+        worst case of this instrument plus the positions published by every shard for all other instruments must
+        also stay within the gross position limit.
+        """
+        limit = self.position_limit if position_limit is None else position_limit
+        if self.shared is not None and self.gross_position_limit is not None:
+            others = self.shared.gross_position() - abs(self.shared.position(instrument_id))
+            limit = min(limit, self.gross_position_limit - others)
+        if side == 'bid':
+            room = limit - self.worst_case_position(instrument_id, side)
+        else:
+            room = limit + self.worst_case_position(instrument_id, side)
+        return max(0, min(volume, room))
+
+    def allowed_volumes(self, instrument_ids, side, volumes, position_limits=None, replacing=False):
+        """
+        Returns `allowed_volume` for every instrument in <instrument_ids> at once, with <volumes> and
+        <position_limits> given as arrays in the same order. With <replacing>, the acknowledged working orders of
+        these instruments are assumed deleted before the new orders go in, as in a requote; the volume reserved for
+        orders not yet answered still counts.
+        """
+        n = len(instrument_ids)
+        limits = np.full(n, self.position_limit) if position_limits is None else np.asarray(position_limits)
+        if self.shared is not None and self.gross_position_limit is not None:
+            published = np.abs(self.shared.positions[[self.shared.registry.id_of(instrument_id) for instrument_id in instrument_ids]])
+            limits = np.minimum(limits, self.gross_position_limit - (self.shared.gross_position() - published))
+        working = self.working[side]
+        if replacing:
+            working = defaultdict(int, working)
+            for instrument_id, order_side, remaining in self.orders.values():
+                if order_side == side:
+                    working[instrument_id] -= remaining
+        positions = np.fromiter((self.positions.get(instrument_id, 0) for instrument_id in instrument_ids), dtype=np.int64, count=n)
+        working = np.fromiter((working.get(instrument_id, 0) for instrument_id in instrument_ids), dtype=np.int64, count=n)
+        if side == 'bid':
+            room = limits - (positions + working)
+        elif side == 'ask':
+            room = limits + (positions - working)
+        else:
+            raise Exception(f'''Invalid side provided: {side}, expecting 'bid' or 'ask'.''')
+        return np.maximum(0, np.minimum(volumes, room)).astype(np.int64)
+
+    def would_breach_position_limit(self, instrument_id, volume, side, position_limit=None):
+        return self.allowed_volume(instrument_id, side, volume, position_limit) < volume
+
+    def reserve(self, instrument_id, side, volume):
+        """
+        Counts <volume> as working on <side> until the order is answered, and returns the reservation to release then.
+        """
+        reservation = next(self._reservations)
+        self.reserved[reservation] = [instrument_id, side, volume]
+        self.working[side][instrument_id] += volume
+        return reservation
+
+    def release(self, reservation):
+        order = self.reserved.pop(reservation, None)
+        if order is not None:
+            instrument_id, side, volume = order
+            self.working[side][instrument_id] -= volume
+
+    def on_order_inserted(self, instrument_id, order_id, side, volume):
+        self.orders[order_id] = [instrument_id, side, volume]
+        self.working[side][instrument_id] += volume
+
+    def on_order_deleted(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            instrument_id, side, remaining = order
+            self.working[side][instrument_id] -= remaining
+
+    def on_fill_confirmed(self, instrument_id, order_id, side, volume):
+        """
+        Books a fill we learnt of before polling its trades, e.g. from the response to an ioc order, so that the
+        next checks see it. The trades are not booked again when they are polled.
+        """
+        if volume:
+            self.positions[instrument_id] += volume if side == 'bid' else -volume
+            self.confirmed_fills[order_id] = self.confirmed_fills.get(order_id, 0) + volume
+
+    def on_trade(self, instrument_id, order_id, side, volume):
+        confirmed = self.confirmed_fills.pop(order_id, 0)
+        if confirmed > volume:
+            self.confirmed_fills[order_id] = confirmed - volume
+        unbooked = max(0, volume - confirmed)
+        self.positions[instrument_id] += unbooked if side == 'bid' else -unbooked
+        order = self.orders.get(order_id)
+        if order is not None:
+            filled = min(volume, order[2])
+            order[2] -= filled
+            self.working[side][instrument_id] -= filled
+            if order[2] == 0:
+                del self.orders[order_id]
@@ -0,0 +1,113 @@
+import math
+import time
+
+
+class TokenBucket:
+    """
+    Message budget refilled at <rate> messages per second, holding at most <capacity> messages, so bursts are
+    bounded by the capacity and the sustained message rate by the rate.
+    """
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._refilled_at = clock()
+
+    def available(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        return self.tokens
+
+    def try_consume(self, messages):
+        if self.available() < messages:
+            return False
+        self.tokens -= messages
+        return True
+
+
+class RequoteScheduler:
+    """
+    Decides which instruments to requote this tick within a global message budget. Every candidate is ranked by how
+    far (in ticks) the quotes it would send now are from its live quotes, weighted up by the time since its last
+    requote:
+
+        priority = edge_ticks * (1 + age / staleness_seconds)
+
+    Quotes are compared as sent, after credits and rounding, so a change of credit moves them as much as a move of
+    the fair value. A change of quoted volume counts as up to one tick, in proportion to the volume that changes.
+
+    Instruments that were never quoted, or that are forced (e.g. because they traded), come first. Candidates below
+    <min_priority> are left alone unless their quotes are older than <max_age> seconds. The remaining candidates are
+    requoted in order of priority for as long as the TokenBucket has messages for them.
+
+    Example usage:
+        scheduler = RequoteScheduler(TokenBucket(rate=20, capacity=40))
+        for instrument_id in scheduler.plan({'NVDA': (249, 251, 80, 80, 4, False)}):
+            ...requote NVDA...
+            scheduler.mark_requoted('NVDA', 249, 251, 80, 80)
+    """
+    def __init__(self, bucket, staleness_seconds=2.0, min_priority=0.5, max_age=10.0, clock=time.monotonic):
+        self.bucket = bucket
+        self.staleness_seconds = staleness_seconds
+        self.min_priority = min_priority
+        self.max_age = max_age
+        self.clock = clock
+        self.requoted = 0
+        self.deferred = 0
+        # instrument_id -> (time, bid ticks, ask ticks, bid volume, ask volume) of its live quotes
+        self._quoted = {}
+
+    def priority(self, instrument_id, bid_ticks, ask_ticks, bid_volume, ask_volume, force=False):
+        quoted = self._quoted.get(instrument_id)
+        if quoted is None or force:
+            return math.inf
+        quoted_at, quoted_bid_ticks, quoted_ask_ticks, quoted_bid_volume, quoted_ask_volume = quoted
+        age = self.clock() - quoted_at
+        edge_ticks = max(
+            abs(bid_ticks - quoted_bid_ticks),
+            abs(ask_ticks - quoted_ask_ticks),
+            abs(bid_volume - quoted_bid_volume) / max(bid_volume, quoted_bid_volume, 1),
+            abs(ask_volume - quoted_ask_volume) / max(ask_volume, quoted_ask_volume, 1),
+            )
+        priority = edge_ticks * (1 + age / self.staleness_seconds)
+        if age >= self.max_age:
+            # stale quotes qualify however small their edge, the stalest first
+            priority = max(priority, self.min_priority * age / self.max_age)
+        return priority
+
+    def plan(self, candidates):
+        """
+        Returns the ids of the instruments to requote now, highest priority first, and takes their messages from
+        the budget.
+
+        candidates: dict         -  instrument_id -> (bid ticks, ask ticks, bid volume, ask volume, messages needed, force)
+        """
+        ranked = []
+        for instrument_id, (bid_ticks, ask_ticks, bid_volume, ask_volume, messages, force) in candidates.items():
+            priority = self.priority(instrument_id, bid_ticks, ask_ticks, bid_volume, ask_volume, force)
+            if priority >= self.min_priority:
+                ranked.append((priority, instrument_id, messages))
+        ranked.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        selected = []
+        for priority, instrument_id, messages in ranked:
+            if self.bucket.try_consume(messages):
+                selected.append(instrument_id)
+            else:
+                self.deferred += 1
+        self.requoted += len(selected)
+        return selected
+
+    def mark_requoted(self, instrument_id, bid_ticks, ask_ticks, bid_volume, ask_volume):
+        """
+        Records the quotes just sent for <instrument_id>, in ticks and lots.
+        """
+        self._quoted[instrument_id] = (self.clock(), bid_ticks, ask_ticks, bid_volume, ask_volume)
+
+    def forget(self, instrument_id):
+        """
+        Makes <instrument_id> be requoted first on the next tick, e.g. after its orders were pulled.
+        """
+        self._quoted.pop(instrument_id, None)
@@ -1,77 +1,171 @@
+import os
 import datetime as dt
 import time
 import logging
 
 from optistrats.utils import get_bid_ask
+from optistrats.book_cache import OrderBookCache
+from optistrats.strats.market_maker import OptionMarketMaker, FutureMarketMaker, StockMarketMaker
+from optistrats.instruments import InstrumentRegistry, KIND_STOCK, KIND_FUTURE, KIND_CALL, KIND_PUT
+from optistrats.risk import PreTradeRiskEngine
+from optistrats.gateway import OrderGateway
+from optistrats.math.pricing_cache import TheoreticalValueCache
+from optistrats.math.taylor import TaylorPricer
+from optistrats.math.surface import SurfacePricer
+from optistrats.math.volatility import RealizedVolatilityBook
+from optistrats.profiling import ProfilingController
+from optistrats.market_data_bus import MarketDataBus
+from optistrats.state_snapshot import StateSnapshotter, restore_risk, restore_market_makers
+from optistrats.pnl import PnLEngine
+from optistrats.metrics import MetricsRegistry, CycleMeter, InstrumentedExchange, MetricsServer, RollingMetricsFile
 
-logging.getLogger('client').setLevel('ERROR')
-
-
-from optibook.synchronous_client import Exchange
-from optibook.common_types import InstrumentType, OptionKind
 
-from optistrats.strats.market_maker import OptionMarketMaker, FutureMarketMaker, StockMarketMaker
+MARKET_MAKER_CLASSES = {
+    KIND_STOCK: StockMarketMaker,
+    KIND_FUTURE: FutureMarketMaker,
+    KIND_CALL: OptionMarketMaker,
+    KIND_PUT: OptionMarketMaker,
+    }
 
 
-def underlying_hash(all_instruments):
-    underlying_dict = {}
-    for instrument_id, instrument in all_instruments.items():
-        if instrument.base_instrument_id is not None:
-            underlying_dict[instrument_id] = instrument.base_instrument_id
-        elif instrument_id[-1] == 'L':
-            underlying_dict[instrument_id] = instrument_id.split('_')[0]
-        else:
-            underlying_dict[instrument_id] = instrument_id
-    return underlying_dict
+def underlying_hash(registry):
+    return registry.underlying_dict()
     
     
-def market_makers_hash(all_instruments, all_instruments_underlying_ids):
+def market_makers_hash(registry, *args, **kwargs):
     all_market_makers = {}
-    for instrument_id, underlying_id in all_instruments_underlying_ids.items():
-        if instrument_id[-1] == 'C' or instrument_id[-1] == 'P':
-            market_maker = OptionMarketMaker(all_instruments[instrument_id])
-        elif instrument_id[-2:] == '_F':
-            market_maker = FutureMarketMaker(all_instruments[instrument_id])
-        else:
-            market_maker = StockMarketMaker(all_instruments[instrument_id])
-           
+    for instrument_id, instrument, kind in zip(registry.instrument_ids, registry.instruments, registry.kinds):
+        market_maker = MARKET_MAKER_CLASSES[kind](instrument, *args, **kwargs)
         all_market_makers[instrument_id] = market_maker
     return all_market_makers
 
+def trade_one_cycle(exchange, market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode, wait_time, gateway=None, vol_book=None,
+                    book_cache=None, market_data=None, pnl=None):
+    print(f'')
+    print(f'-----------------------------------------------------------------')
+    print(f'TRADE LOOP ITERATION ENTERED AT {str(dt.datetime.now()):18s} UTC.')
+    print(f'-----------------------------------------------------------------')
+    
+    if book_cache is not None:
+        # one book request per underlying per cycle, instead of one per market maker, or none with a MarketDataBus
+        book_cache.refresh(market_data if market_data is not None else exchange)
+    
+    if vol_book is not None:
+        # one return per underlying per cycle, however many market makers quote on it
+        for underlying_id in sorted(set(underlying_dict.values())):
+            if book_cache is not None:
+                quotes = book_cache.best_bid_ask(underlying_id)
+            else:
+                quotes = get_bid_ask(exchange, underlying_id)
+            if quotes is not None:
+                vol_book.update(underlying_id, (quotes[0].price + quotes[1].price) / 2)
+    
+    for instrument_id, market_maker in market_makers_dict.items():
+        trades = market_maker.get_traded_orders(exchange)
+        if pnl is not None:
+            for trade in trades:
+                pnl.on_trade(instrument_id, trade)
+    
+        if book_cache is not None:
+            stock_value = book_cache.best_bid_ask(underlying_dict[instrument_id])
+        else:
+            stock_value = get_bid_ask(exchange, underlying_dict[instrument_id])
+        if stock_value is None:
+            print('Empty stock order book on bid or ask-side, or both, unable to update option prices.')
+            time.sleep(wait_time)
+            continue
+    
+        stock_bid, stock_ask = stock_value
+        theoretical_bid_price, theoretical_ask_price = market_maker.compute_fair_quotes(stock_bid.price, stock_ask.price)
+        if pnl is not None:
+            # not every instrument's own book is fetched, so positions are marked to our fair value
+            pnl.mark(instrument_id, (theoretical_bid_price + theoretical_ask_price) / 2)
+        market_maker.select_credits(exchange, credit_ic_mode)
+        market_maker.select_volumes(exchange, volume_ic_mode)
+        market_maker.cancel_orders(exchange)
+        market_maker.update_limit_orders(exchange, theoretical_bid_price, theoretical_ask_price)
+        
+        if gateway is None:
+            print(f'\nSleeping for {wait_time} seconds.')
+            time.sleep(wait_time)
+        
+    if gateway is not None:
+        # all deletes and inserts queued during the cycle go out together, then we wait once per cycle
+        gateway.flush()
+        print(f'\nSleeping for {wait_time} seconds.')
+        time.sleep(wait_time)
+
+
 if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
     exchange = Exchange()
     exchange.connect()
+
+    # curl localhost:9108/metrics, or read metrics/metrics.jsonl
+    metrics = MetricsRegistry()
+    exchange = InstrumentedExchange(exchange, metrics)
+    MetricsServer(metrics, port=9108).start()
+    os.makedirs('metrics', exist_ok=True)
+    RollingMetricsFile(metrics, 'metrics/metrics.jsonl', interval=10).start()
+    cycle_meter = CycleMeter(metrics)
     
-    all_instruments = exchange.get_instruments()
-    underlying_dict = underlying_hash(all_instruments)
-    market_makers_dict = market_makers_hash(all_instruments, underlying_dict)
+    # a recent snapshot replaces the instrument, position and order queries: our orders are deleted instead, and
+    # the positions reconciled with one position query
+    snapshotter = StateSnapshotter('state/run.snapshot', interval=30, max_age=3600)
+    state = snapshotter.load()
+    risk = PreTradeRiskEngine(position_limit=100)
+    gateway = OrderGateway(pool_size=4, risk=risk, metrics=metrics)
+    if state is not None:
+        registry = InstrumentRegistry(state['instruments'])
+        restore_risk(state, risk, exchange, gateway)
+    else:
+        registry = InstrumentRegistry(exchange.get_instruments())
+        risk.sync(exchange, registry.instrument_ids)
+    underlying_dict = underlying_hash(registry)
+    book_cache = OrderBookCache(sorted(set(underlying_dict.values())))
+    market_data_bus = None # e.g. 'optistrats-md', to read the books published by scripts/run_feed.py
+    market_data = MarketDataBus.attach(market_data_bus) if market_data_bus is not None else None
+    pricing_mode = 'cache' # ['exact', 'cache', 'taylor', 'surface']
+    # only the selected pricer is built, the SurfacePricer starts a background executor
+    pricer = {
+        'exact': lambda: None,
+        'cache': lambda: TheoreticalValueCache(maxsize=4096),
+        'taylor': lambda: TaylorPricer(max_spot_move=0.5, max_elapsed_seconds=10),
+        'surface': lambda: SurfacePricer(half_width=5.0, step=0.05, refresh_seconds=5),
+        }[pricing_mode]()
+    vol_book = RealizedVolatilityBook(halflife_seconds=300, initial_volatility=3, method='bipower')
+    market_makers_dict = market_makers_hash(registry, risk=risk, gateway=gateway, pricer=pricer, vol_source=vol_book)
+    if state is not None:
+        restore_market_makers(state, market_makers_dict, vol_book)
+        print(f'Resumed from the snapshot taken {time.time() - state["saved_at"]:.0f} seconds ago.')
+
+    pnl = PnLEngine(gateway, default_strategy='market_making')
+    pnl.carry_in(risk.positions)
 
     credit_ic_mode = 'slippery' # ['constant', 'rigid', 'linear-advocate', 'slippery']
     volume_ic_mode = 'linear-deprecate' # ['constant', 'linear-advocate', 'linear-deprecate']
 
     wait_time = .2
+
+    # kill -USR1 <pid>, or echo <seconds> > /tmp/optistrats.profile, to profile the running loop
+    profile_mode = 'sampling' # ['sampling', 'cprofile']
+    profile_stage = None # [None, 'compute_fair_quotes', 'update_limit_orders']
+    profiler = ProfilingController(report_dir='profiles', duration=30, mode=profile_mode, control_file='/tmp/optistrats.profile')
+    profiler.install()
+    if profile_stage is not None:
+        profiler.wrap_stage({type(market_maker) for market_maker in market_makers_dict.values()}, profile_stage)
     
     while True:
-        print(f'')
-        print(f'-----------------------------------------------------------------')
-        print(f'TRADE LOOP ITERATION ENTERED AT {str(dt.datetime.now()):18s} UTC.')
-        print(f'-----------------------------------------------------------------')
-        
-        for instrument_id, market_maker in market_makers_dict.items():
-            market_maker.get_traded_orders(exchange)
-        
-            stock_value = get_bid_ask(exchange, underlying_dict[instrument_id])
-            if stock_value is None:
-                print('Empty stock order book on bid or ask-side, or both, unable to update option prices.')
-                time.sleep(wait_time)
-                continue
-        
-            stock_bid, stock_ask = stock_value
-            theoretical_bid_price, theoretical_ask_price = market_maker.compute_fair_quotes(stock_bid.price, stock_ask.price)
-            market_maker.select_credits(exchange, credit_ic_mode)
-            market_maker.select_volumes(exchange, volume_ic_mode)
-            market_maker.cancel_orders(exchange)
-            market_maker.update_limit_orders(exchange, theoretical_bid_price, theoretical_ask_price)
-            
-            print(f'\nSleeping for {wait_time} seconds.')
-            time.sleep(wait_time)
\ No newline at end of file
+        profiler.poll()
+        trade_one_cycle(exchange, market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode, wait_time, gateway, vol_book, book_cache, market_data, pnl)
+        cycle_meter.tick()
+        for instrument_id, position in risk.positions.items():
+            metrics.set('position', position, instrument_id=instrument_id)
+        metrics.set('pnl', pnl.total())
+        for strategy, row in pnl.by_strategy().items():
+            metrics.set('strategy_pnl', row['total'], strategy=strategy)
+        snapshotter.maybe_save(registry, risk, market_makers_dict, vol_book)
+        if pricer is not None:
+            print(f'Pricer: {pricer}.')
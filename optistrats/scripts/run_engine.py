@@ -0,0 +1,99 @@
+import os
+import logging
+
+from optistrats.engine import TradingEngine
+from optistrats.gateway import OrderGateway
+from optistrats.instruments import InstrumentRegistry, KIND_STOCK, KIND_FUTURE
+from optistrats.math.pricing_cache import TheoreticalValueCache
+from optistrats.math.volatility import RealizedVolatilityBook
+from optistrats.math.vol_surface import VolatilitySurface
+from optistrats.profiling import ProfilingController
+from optistrats.market_data_bus import MarketDataBus
+from optistrats.state_snapshot import StateSnapshotter, StateSnapshotStrategy, restore_risk, restore_market_makers
+from optistrats.metrics import MetricsRegistry, InstrumentedExchange, MetricsServer, RollingMetricsFile
+from optistrats.risk import PreTradeRiskEngine
+from optistrats.pnl import PnLEngine
+from optistrats.scheduler import RequoteScheduler, TokenBucket
+from optistrats.scripts.run import underlying_hash, market_makers_hash
+from optistrats.strats.arbitrage import ArbitrageStrategy, DualListArb, FutureSpotArb
+from optistrats.strats.market_maker import MarketMakingStrategy
+from optistrats.strats.market_making_book import MarketMakingBook
+from optistrats.strats.hedger import DeltaHedger
+
+
+if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
+    exchange = Exchange()
+    exchange.connect()
+
+    # curl localhost:9108/metrics, or read metrics/metrics.jsonl
+    metrics = MetricsRegistry()
+    exchange = InstrumentedExchange(exchange, metrics)
+    MetricsServer(metrics, port=9108).start()
+    os.makedirs('metrics', exist_ok=True)
+    RollingMetricsFile(metrics, 'metrics/metrics.jsonl', interval=10).start()
+
+    credit_ic_mode = 'slippery' # ['constant', 'rigid', 'linear-advocate', 'slippery']
+    volume_ic_mode = 'linear-deprecate' # ['constant', 'linear-advocate', 'linear-deprecate']
+    wait_time = .2
+
+    # a recent snapshot replaces the instrument, position and order queries: our orders are deleted instead, and
+    # the positions reconciled with one position query
+    snapshotter = StateSnapshotter('state/engine.snapshot', interval=30, max_age=3600)
+    state = snapshotter.load()
+    risk = PreTradeRiskEngine(position_limit=100)
+    gateway = OrderGateway(pool_size=4, risk=risk, metrics=metrics)
+    if state is not None:
+        registry = InstrumentRegistry(state['instruments'])
+        restore_risk(state, risk, exchange, gateway)
+    else:
+        registry = InstrumentRegistry(exchange.get_instruments())
+        risk.sync(exchange, registry.instrument_ids)
+
+    underlying_dict = underlying_hash(registry)
+    vol_mode = 'surface' # ['realized', 'surface']
+    vol_book = RealizedVolatilityBook(halflife_seconds=300, initial_volatility=3, method='bipower') if vol_mode == 'realized' else None
+    vol_surface = VolatilitySurface(interest_rate=.03, initial_volatility=3) if vol_mode == 'surface' else None
+    market_makers_dict = market_makers_hash(
+        registry, risk=risk, gateway=gateway, pricer=TheoreticalValueCache(maxsize=4096), vol_source=vol_book or vol_surface
+        )
+    if state is not None:
+        restore_market_makers(state, market_makers_dict, vol_book or vol_surface)
+
+    arbitrageurs = [
+        # dual listings are the stocks whose underlying is another listed stock
+        DualListArb(exchange, registry.instrument_ids[i], registry.underlying_ids[i], risk, gateway)
+        for i in registry.select(kind=KIND_STOCK)
+        if registry.underlying_ids[i] != registry.instrument_ids[i] and registry.underlying_ids[i] in registry
+        ] + [
+        FutureSpotArb(exchange, registry.instrument_ids[i], registry.underlying_ids[i], risk, gateway)
+        for i in registry.select(kind=KIND_FUTURE)
+        ]
+
+    # the message budget is shared by all market makers, the arbitrageurs' ioc orders are not throttled
+    scheduler = RequoteScheduler(TokenBucket(rate=25, capacity=50), staleness_seconds=2.0)
+
+    book = MarketMakingBook(market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode)
+
+    market_data_bus = None # e.g. 'optistrats-md', to read the books published by scripts/run_feed.py
+    market_data = MarketDataBus.attach(market_data_bus) if market_data_bus is not None else None
+
+    # fills of the arbitrageurs and the hedger are told apart from the market makers' by their gateway tags
+    pnl = PnLEngine(gateway, default_strategy='market_making')
+    pnl.carry_in(risk.positions)
+
+    engine = TradingEngine(exchange, risk, gateway, metrics, market_data, pnl)
+    engine.add_strategy(MarketMakingStrategy(
+        market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode, vol_book, vol_surface, scheduler=scheduler,
+        book=book,
+        ))
+    engine.add_strategy(ArbitrageStrategy(arbitrageurs))
+    engine.add_strategy(DeltaHedger(registry, band=20, max_volume=50, vol_source=vol_book or vol_surface))
+    engine.add_strategy(StateSnapshotStrategy(snapshotter, registry, market_makers_dict, vol_book or vol_surface))
+
+    # kill -USR1 <pid>, or echo <seconds> > /tmp/optistrats.profile, to profile the running engine
+    profiler = ProfilingController(report_dir='profiles', duration=30, mode='sampling', control_file='/tmp/optistrats.profile')
+    profiler.install()
+    engine.run(wait_time, profiler)
@@ -0,0 +1,38 @@
+import time
+import logging
+
+from optistrats.instruments import InstrumentRegistry
+from optistrats.market_data_bus import MarketDataBus
+
+
+def run_feed(exchange, bus, wait_time):
+    """
+    Polls every order book on <bus> once per cycle and publishes the touches that moved.
+    """
+    while True:
+        start = time.perf_counter()
+        changed = bus.poll(exchange)
+        elapsed = time.perf_counter() - start
+        print(f'Published {len(changed):3d} of {len(bus.instrument_ids)} books in {elapsed * 1000:6.1f} ms.')
+        time.sleep(max(0, wait_time - elapsed))
+
+
+if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
+    exchange = Exchange()
+    exchange.connect()
+
+    # strategies attach with MarketDataBus.attach(bus_name), see market_data_bus in run.py and run_engine.py
+    bus_name = 'optistrats-md'
+    wait_time = .1
+
+    registry = InstrumentRegistry(exchange.get_instruments())
+    bus = MarketDataBus.create(registry.instrument_ids, name=bus_name, slots=64)
+    print(f'Publishing {len(registry)} instruments on market data bus {bus.name}.')
+    try:
+        run_feed(exchange, bus, wait_time)
+    finally:
+        bus.close()
+        bus.unlink()
@@ -0,0 +1,116 @@
+import logging
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+from optistrats.instruments import InstrumentRegistry
+from optistrats.risk import SharedRiskBlock, PreTradeRiskEngine
+from optistrats.gateway import OrderGateway
+from optistrats.book_cache import OrderBookCache
+from optistrats.scripts.run import MARKET_MAKER_CLASSES, underlying_hash, trade_one_cycle
+
+
+def partition_by_underlying(registry, n_shards):
+    """
+    Splits all instruments into at most <n_shards> groups, keeping every underlying (with its options, futures and
+    dual listings) in a single group. Groups are balanced on instrument count, largest underlyings first.
+    """
+    by_underlying = defaultdict(list)
+    for instrument_id, underlying_id in zip(registry.instrument_ids, registry.underlying_ids):
+        by_underlying[underlying_id].append(instrument_id)
+
+    shards = [[] for _ in range(min(n_shards, len(by_underlying)))]
+    for instrument_ids in sorted(by_underlying.values(), key=len, reverse=True):
+        min(shards, key=len).extend(instrument_ids)
+    return shards
+
+
+def publish_risk(pre_trade_risk, market_makers_dict, ids, book_cache):
+    """
+    Publishes the positions and delta exposures of the instruments traded by this shard to the shared risk block,
+    from the shard's own risk engine and the underlying books fetched this cycle, without asking the exchange.
+    """
+    registry = pre_trade_risk.shared.registry
+    published_ids, instrument_ids, deltas = [], [], []
+    for i, (instrument_id, market_maker) in zip(ids, market_makers_dict.items()):
+        mid = book_cache.midpoint(registry.underlying_ids[i])
+        if mid is None:
+            continue
+        published_ids.append(i)
+        instrument_ids.append(instrument_id)
+        deltas.append(market_maker.compute_delta(mid))
+    pre_trade_risk.publish(np.array(published_ids, dtype=np.intp), instrument_ids, deltas)
+
+
+def run_shard(shard_index, instrument_ids, risk_name, credit_ic_mode, volume_ic_mode, wait_time, gross_position_limit=None):
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
+
+    exchange = Exchange()
+    exchange.connect()
+
+    registry = InstrumentRegistry(exchange.get_instruments())
+    risk = SharedRiskBlock(registry, name=risk_name)
+    pre_trade_risk = PreTradeRiskEngine(position_limit=100, shared=risk, gross_position_limit=gross_position_limit)
+    pre_trade_risk.sync(exchange, instrument_ids)
+    gateway = OrderGateway(pool_size=2, risk=pre_trade_risk)
+    underlying_dict = underlying_hash(registry)
+    market_makers_dict = {
+        instrument_id: MARKET_MAKER_CLASSES[registry.kind_of(instrument_id)](
+            registry.instrument(instrument_id), risk=pre_trade_risk, gateway=gateway
+            )
+        for instrument_id in instrument_ids
+        }
+    ids = np.array([registry.id_of(instrument_id) for instrument_id in instrument_ids], dtype=np.intp)
+    underlying_ids = sorted({underlying_dict[instrument_id] for instrument_id in instrument_ids})
+    book_cache = OrderBookCache(underlying_ids)
+
+    print(f'Shard {shard_index} trading {len(instrument_ids)} instruments on {", ".join(underlying_ids)}.')
+    while True:
+        trade_one_cycle(exchange, market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode, wait_time, gateway,
+                        book_cache=book_cache)
+        publish_risk(pre_trade_risk, market_makers_dict, ids, book_cache)
+        print(f'Shard {shard_index}: gross position {risk.gross_position():.0f} lots across all shards.')
+        for underlying_id in underlying_ids:
+            print(f'  {underlying_id:20s}: net delta {risk.net_delta(underlying_id):8.2f}')
+
+
+if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
+
+    credit_ic_mode = 'slippery' # ['constant', 'rigid', 'linear-advocate', 'slippery']
+    volume_ic_mode = 'linear-deprecate' # ['constant', 'linear-advocate', 'linear-deprecate']
+    wait_time = .2
+    n_shards = 4
+    gross_position_limit = 2000 # lots, summed over every instrument of every shard
+
+    exchange = Exchange()
+    exchange.connect()
+    registry = InstrumentRegistry(exchange.get_instruments())
+    exchange.disconnect()
+
+    risk = SharedRiskBlock(registry, create=True)
+    # every worker opens its own exchange connection, so do not inherit the parent's socket
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(
+            target=run_shard,
+            args=(shard_index, instrument_ids, risk.name, credit_ic_mode, volume_ic_mode, wait_time, gross_position_limit),
+            daemon=True,
+            )
+        for shard_index, instrument_ids in enumerate(partition_by_underlying(registry, n_shards))
+        ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+        risk.close()
+        risk.unlink()
@@ -0,0 +1,169 @@
+import os
+import time
+import pickle
+from collections import defaultdict
+
+
+SNAPSHOT_VERSION = 2
+
+
+def capture_state(registry, risk, market_makers_dict, vol_source=None):
+    """
+    Returns everything needed to resume quoting after a restart: the instruments, our positions as booked by the
+    PreTradeRiskEngine, the hyperparameters of every market maker (credit, volume, limit, interest rate for the
+    carry and volatility) and the state of the vol source, if any. Working orders are not kept, see `restore_risk`.
+    """
+    return {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'instruments': dict(zip(registry.instrument_ids, registry.instruments)),
+        'positions': dict(risk.positions),
+        'market_makers': {
+            instrument_id: {
+                'credit': market_maker.c0,
+                'volume': market_maker.v0,
+                'position_limit': market_maker.position_limit,
+                'interest_rate': market_maker.interest_rate,
+                'volatility': market_maker.volatility,
+                }
+            for instrument_id, market_maker in market_makers_dict.items()
+            },
+        'vol_source': vol_source.state() if vol_source is not None else None,
+        }
+
+
+def restore_risk(state, risk, exchange, gateway=None):
+    """
+    Deletes all our orders in the instruments of <state>, loads its positions into <risk> and reconciles them with
+    a single exchange query. Returns the instruments whose position moved while we were down, mapped to (snapshot
+    position, exchange position).
+
+    A snapshot can be older than the orders resting on the exchange, which it would then not know about, so its
+    working orders are not trusted: one delete-all per instrument is sent instead, concurrently through <gateway>
+    if given, and the positions are only read once every delete has been answered. The risk engine starts without
+    working orders.
+    """
+    for instrument_id in state['instruments']:
+        if gateway is not None:
+            gateway.delete_all(instrument_id)
+        else:
+            exchange.delete_orders(instrument_id)
+    if gateway is not None:
+        gateway.flush()
+    positions = exchange.get_positions()
+    moved = {
+        instrument_id: (state['positions'].get(instrument_id, 0), position)
+        for instrument_id, position in positions.items()
+        if position != state['positions'].get(instrument_id, 0)
+        }
+    risk.positions = defaultdict(int, positions)
+    risk.working = {'bid': defaultdict(int), 'ask': defaultdict(int)}
+    risk.orders = {}
+    risk.reserved = {}
+    for instrument_id, (old, new) in moved.items():
+        print(f'Position in {instrument_id} moved from {old} to {new} while we were down.')
+    return moved
+
+
+def restore_market_makers(state, market_makers_dict, vol_source=None):
+    """
+    Restores the hyperparameters of every market maker in <state> and the estimates of <vol_source>.
+    """
+    for instrument_id, parameters in state['market_makers'].items():
+        market_maker = market_makers_dict.get(instrument_id)
+        if market_maker is None:
+            continue
+        market_maker.set_inventory_parameters(parameters['credit'], parameters['volume'], parameters['position_limit'])
+        market_maker.interest_rate = parameters['interest_rate']
+        market_maker.volatility = parameters['volatility']
+    if vol_source is not None and state['vol_source'] is not None:
+        vol_source.restore(state['vol_source'])
+
+
+class StateSnapshotter:
+    """
+    Writes the state of the trading loop to <path> every <interval> seconds and reads it back on startup. A
+    snapshot is written to a temporary file, synced and renamed over the previous one, so a crash halfway
+    through a write leaves the previous snapshot intact. Snapshots older than <max_age> seconds are ignored.
+
+    Example usage:
+        snapshotter = StateSnapshotter('state/run.snapshot', interval=30)
+        state = snapshotter.load()
+        if state is not None:
+            registry = InstrumentRegistry(state['instruments'])
+            restore_risk(state, risk, exchange, gateway)
+        ...
+        while True:
+            ...
+            snapshotter.maybe_save(registry, risk, market_makers_dict, vol_book)
+    """
+    def __init__(self, path='state/engine.snapshot', interval=30, max_age=3600, clock=time.monotonic):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.clock = clock
+        self.saves = 0
+        self._saved_at = clock()
+
+    def save(self, state):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+        self.saves += 1
+        self._saved_at = self.clock()
+
+    def maybe_save(self, registry, risk, market_makers_dict, vol_source=None):
+        """
+        Saves a snapshot if the last one is older than the interval, and returns whether it did.
+        """
+        if self.clock() - self._saved_at < self.interval:
+            return False
+        self.save(capture_state(registry, risk, market_makers_dict, vol_source))
+        return True
+
+    def load(self):
+        """
+        Returns the last snapshot, or None if there is none, it cannot be read or it is too old to trust.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as file:
+                state = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            print(f'Ignoring unreadable snapshot {self.path}: {e}.')
+            return None
+        if state.get('version') != SNAPSHOT_VERSION:
+            print(f'Ignoring snapshot {self.path} of version {state.get("version")}, expecting {SNAPSHOT_VERSION}.')
+            return None
+        age = time.time() - state['saved_at']
+        if age > self.max_age:
+            print(f'Ignoring snapshot {self.path} taken {age:.0f} seconds ago.')
+            return None
+        return state
+
+
+class StateSnapshotStrategy:
+    """
+    Saves snapshots from within a TradingEngine, as a strategy that reads no books and trades nothing.
+
+    Example usage:
+        engine.add_strategy(StateSnapshotStrategy(snapshotter, registry, market_makers_dict, vol_source))
+    """
+    book_ids = []
+    traded_ids = []
+
+    def __init__(self, snapshotter, registry, market_makers_dict, vol_source=None):
+        self.snapshotter = snapshotter
+        self.registry = registry
+        self.market_makers_dict = market_makers_dict
+        self.vol_source = vol_source
+
+    def on_tick(self, engine, snapshot):
+        self.snapshotter.maybe_save(self.registry, engine.risk, self.market_makers_dict, self.vol_source)
@@ -3,27 +3,29 @@ import logging
 import datetime as dt
 import time
 from optistrats.utils import calculate_current_time_to_date, expiry_in_years
-from optistrats.utils import clear_position, print_positions_and_pnl
+from optistrats.utils import flatten, print_positions_and_pnl
 from optistrats.utils import trade_would_breach_position_limit, check_and_get_best_bid_ask
-from optibook.synchronous_client import Exchange
-from optibook.common_types import InstrumentType
+from optistrats.utils import TICK_SIZE, to_ticks, ticks_down, ticks_up
+from optistrats.market_data_bus import MarketDataBus
+from optistrats.gateway import ioc_filled_volume
 
 
 INTEREST_RATE = .03
 VOLATILITY = 3
 
-exchange = Exchange()
-exchange.connect()
-
-logging.getLogger('client').setLevel('ERROR')
-
 
 class Arbitrageur:
-    def __init__(self, primal_instrument_id, hedge_instrument_id):
+    def __init__(self, exchange, primal_instrument_id, hedge_instrument_id, risk=None, gateway=None, tick_size=TICK_SIZE):
         '''
         Primal instrument: illiquid instrument
         Hedge instrument: liquid instrument
+        Risk and gateway: optional PreTradeRiskEngine and OrderGateway shared with other strategies
+        Tick size: prices are compared in ticks of this size
         '''
+        self.exchange = exchange
+        self.tick_size = tick_size
+        self.risk = risk
+        self.gateway = gateway
         self.primal_id = primal_instrument_id
         self.hedge_id = hedge_instrument_id
         self.bid_primal = None
@@ -32,10 +34,42 @@ class Arbitrageur:
         self.ask_hedge = None
         self.primal_side = []
     
-    def get_best_quotes(self):
-        primal_exists, self.bid_primal, self.ask_primal = check_and_get_best_bid_ask(exchange, self.primal_id)
-        dual_exists, self.bid_hedge, self.ask_hedge = check_and_get_best_bid_ask(exchange, self.hedge_id)
+    def get_best_quotes(self, snapshot=None):
+        if snapshot is not None:
+            primal_exists, self.bid_primal, self.ask_primal = snapshot.check_and_get_best_bid_ask(self.primal_id)
+            dual_exists, self.bid_hedge, self.ask_hedge = snapshot.check_and_get_best_bid_ask(self.hedge_id)
+        else:
+            primal_exists, self.bid_primal, self.ask_primal = check_and_get_best_bid_ask(self.exchange, self.primal_id)
+            dual_exists, self.bid_hedge, self.ask_hedge = check_and_get_best_bid_ask(self.exchange, self.hedge_id)
         return primal_exists and dual_exists
+    
+    def _would_breach_position_limit(self, instrument_id, volume, side):
+        if self.risk is not None:
+            return self.risk.would_breach_position_limit(instrument_id, volume, side)
+        return trade_would_breach_position_limit(self.exchange, instrument_id, volume, side)
+    
+    def _insert_ioc_order(self, instrument_id, price, volume, side):
+        '''
+        Sends an ioc order and returns the volume it traded, which is booked with the risk engine right away.
+        '''
+        if self.gateway is not None:
+            # the hedge depends on this fill, so send it right away, leaving the requotes queued this tick for the
+            # engine's flush
+            response = self.gateway.insert_now(instrument_id, price=price, volume=volume, side=side, order_type='ioc', tag='arbitrage')
+            response = response.result()
+            filled = self.gateway.ioc_fills.pop(response.order_id, 0) if response.success else 0
+        else:
+            response = self.exchange.insert_order(
+                instrument_id=instrument_id,
+                price=price,
+                volume=volume,
+                side=side,
+                order_type='ioc'
+                )
+            filled = ioc_filled_volume(self.exchange, instrument_id, response.order_id) if response.success else 0
+        if self.risk is not None:
+            self.risk.on_fill_confirmed(instrument_id, response.order_id, side, filled)
+        return filled
         
     def trade(self):
         for side in self.primal_side:
@@ -51,27 +85,14 @@ class Arbitrageur:
                 hedge_price = self.ask_hedge.price
                 desiredVolume = min(self.bid_primal.volume, self.ask_hedge.volume)
             # trade on primal book
-            if not trade_would_breach_position_limit(exchange, self.primal_id, desiredVolume, side):
+            if not self._would_breach_position_limit(self.primal_id, desiredVolume, side):
                 print(f'- Inserting {side} ioc order in {self.primal_id} for {desiredVolume} @ {primal_price:8.2f}.')
-                response = exchange.insert_order(
-                    instrument_id=self.primal_id,
-                    price=primal_price,
-                    volume=desiredVolume,
-                    side=side,
-                    order_type='ioc'
-                    )
-                if response.success:
-                    # trade on hedge book
-                    tradedVolume = exchange.get_trade_history(self.primal_id)[-1].volume
-                    if not trade_would_breach_position_limit(exchange, self.hedge_id, tradedVolume, opposite):
+                tradedVolume = self._insert_ioc_order(self.primal_id, primal_price, desiredVolume, side)
+                if tradedVolume > 0:
+                    # trade on hedge book, only what traded on the primal book
+                    if not self._would_breach_position_limit(self.hedge_id, tradedVolume, opposite):
                         print(f'- Inserting {opposite} ioc order in {self.hedge_id} for {tradedVolume} @ {hedge_price:8.2f}.')
-                        exchange.insert_order(
-                            instrument_id=self.hedge_id,
-                            price=hedge_price,
-                            volume=tradedVolume,
-                            side=opposite,
-                            order_type='ioc'
-                            )
+                        self._insert_ioc_order(self.hedge_id, hedge_price, tradedVolume, opposite)
                             
     def reset(self):
         self.bid_primal = None
@@ -83,9 +104,9 @@ class Arbitrageur:
 
 class DualListArb(Arbitrageur):
     def detect(self):
-        if self.ask_primal.price < self.bid_hedge.price:
+        if to_ticks(self.ask_primal.price, self.tick_size) < to_ticks(self.bid_hedge.price, self.tick_size):
             self.primal_side.append('bid')
-        if self.bid_primal.price > self.ask_hedge.price:
+        if to_ticks(self.bid_primal.price, self.tick_size) > to_ticks(self.ask_hedge.price, self.tick_size):
             self.primal_side.append('ask')
     
 
@@ -94,50 +115,83 @@ class FutureSpotArb(Arbitrageur):
     Primal instrument: future contract
     Hedge instrument: spot equity
     '''
-    def __init__(self, future_id, spot_id):
-        super(FutureSpotArb, self).__init__(future_id, spot_id)
+    def __init__(self, exchange, future_id, spot_id, risk=None, gateway=None, tick_size=TICK_SIZE):
+        super(FutureSpotArb, self).__init__(exchange, future_id, spot_id, risk, gateway, tick_size)
         expiry = expiry_in_years(exchange, future_id)
         self.cost_factor = math.exp(INTEREST_RATE * expiry)
         
     def detect(self):
-        if self.ask_primal.price < self.bid_hedge.price * self.cost_factor:
+        # a future price on the grid is below (above) the carried spot price iff it is below the tick above
+        # (above the tick below) it
+        if to_ticks(self.ask_primal.price, self.tick_size) < ticks_up(self.bid_hedge.price * self.cost_factor, self.tick_size):
             self.primal_side.append('bid')
-        if self.bid_primal.price > self.ask_hedge.price * self.cost_factor:
+        if to_ticks(self.bid_primal.price, self.tick_size) > ticks_down(self.ask_hedge.price * self.cost_factor, self.tick_size):
             self.primal_side.append('ask')
 
 
+class ArbitrageStrategy:
+    '''
+    Runs a set of arbitrageurs as a TradingEngine strategy, detecting on the engine's snapshot
+    instead of fetching the books again.
+    '''
+    def __init__(self, arbitrageurs):
+        self.arbitrageurs = arbitrageurs
+        instrument_ids = set()
+        for arb in arbitrageurs:
+            instrument_ids.update((arb.primal_id, arb.hedge_id))
+        self.book_ids = sorted(instrument_ids)
+        self.traded_ids = sorted(instrument_ids)
+        
+    def on_tick(self, engine, snapshot):
+        for arb in self.arbitrageurs:
+            if arb.get_best_quotes(snapshot):
+                arb.detect()
+                arb.trade()
+            arb.reset()
+
+
 ###########################
 # Trading - Start here #
 ###########################
 
-if True: 
-    clear_position(exchange)
+if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+    from optibook.common_types import InstrumentType
 
+    exchange = Exchange()
+    exchange.connect()
 
-stocks = [
-    DualListArb('NVDA_DUAL', 'NVDA'),
-    DualListArb('SAN_DUAL', 'SAN'),
-    ]
-    
-futures = []
-for id, instrument in exchange.get_instruments().items():
-    if instrument.instrument_type == InstrumentType.STOCK_FUTURE:
-        futures.append(
-            FutureSpotArb(id, instrument.base_instrument_id)
-            )
-
-arbitrageurs = stocks + futures
-
-while True:
-    print(f'')
-    print(f'-----------------------------------------------------------------')
-    print(f'TRADE LOOP ITERATION ENTERED AT {str(dt.datetime.now()):18s} UTC.')
-    print(f'-----------------------------------------------------------------')
-    for arb in arbitrageurs:
-        if arb.get_best_quotes():
-            arb.detect()
-            arb.trade()
-            arb.reset()
-    # time.sleep(2)
-    
-    
\ No newline at end of file
+    logging.getLogger('client').setLevel('ERROR')
+
+    if True: 
+        flatten(exchange)
+
+
+    stocks = [
+        DualListArb(exchange, 'NVDA_DUAL', 'NVDA'),
+        DualListArb(exchange, 'SAN_DUAL', 'SAN'),
+        ]
+        
+    futures = []
+    for id, instrument in exchange.get_instruments().items():
+        if instrument.instrument_type == InstrumentType.STOCK_FUTURE:
+            futures.append(
+                FutureSpotArb(exchange, id, instrument.base_instrument_id)
+                )
+
+    arbitrageurs = stocks + futures
+
+    market_data_bus = None # e.g. 'optistrats-md', to read the books published by scripts/run_feed.py
+    market_data = MarketDataBus.attach(market_data_bus) if market_data_bus is not None else None
+
+    while True:
+        print(f'')
+        print(f'-----------------------------------------------------------------')
+        print(f'TRADE LOOP ITERATION ENTERED AT {str(dt.datetime.now()):18s} UTC.')
+        print(f'-----------------------------------------------------------------')
+        for arb in arbitrageurs:
+            if arb.get_best_quotes(market_data):
+                arb.detect()
+                arb.trade()
+                arb.reset()
+        # time.sleep(2)
@@ -0,0 +1,127 @@
+import numpy as np
+
+from optistrats.instruments import KIND_STOCK, KIND_FUTURE, KIND_CALL, KIND_PUT
+from optistrats.math.black_scholes import call_delta, put_delta
+
+
+class DeltaHedger:
+    """
+    Keeps the net delta of every underlying within +/- <band> as a TradingEngine strategy. Every tick the deltas of
+    all instruments are recomputed at once from the underlyings' mids (1 for stocks and dual listings, the carry
+    exp(rT) for futures and Black-Scholes for options), weighted by our positions in the engine's
+    PreTradeRiskEngine and summed per underlying.
+
+    When an underlying's net delta leaves the band, it is hedged back to zero with an ioc order in the cheapest hedge
+    instrument: the stock, its dual listing or one of its futures, whichever costs the least per unit of delta to
+    cross, counting both its half spread and its premium or discount to the carried spot. All hedges of a tick are
+    queued on the shared OrderGateway and sent together with the engine's flush.
+
+    Example usage:
+        hedger = DeltaHedger(registry, band=20, max_volume=50)
+        engine.add_strategy(hedger)
+    """
+    def __init__(self, registry, band=20, max_volume=50, interest_rate=.03, volatility=3, vol_source=None, position_limit=100):
+        self.registry = registry
+        self.band = band
+        self.max_volume = max_volume
+        self.interest_rate = interest_rate
+        self.volatility = volatility
+        # optional RealizedVolatilityBook or VolatilitySurface, as used by the option market makers
+        self.vol_source = vol_source
+        self.position_limit = position_limit
+        self.hedges = 0
+
+        kinds = registry.kinds
+        listed = registry.underlyings >= 0
+        self.is_option = listed & ((kinds == KIND_CALL) | (kinds == KIND_PUT))
+        self.is_future = listed & (kinds == KIND_FUTURE)
+        self.option_rows = np.flatnonzero(self.is_option)
+        self.risk_rows = np.flatnonzero(listed)
+        hedge_rows = np.flatnonzero(listed & ((kinds == KIND_STOCK) | (kinds == KIND_FUTURE)))
+        # underlying row -> rows of the instruments we can hedge it with
+        self.hedge_rows = {}
+        for row in hedge_rows:
+            self.hedge_rows.setdefault(int(registry.underlyings[row]), []).append(int(row))
+        self.underlying_rows = sorted(self.hedge_rows)
+
+        self.book_ids = sorted({registry.instrument_ids[row] for row in hedge_rows})
+        self.traded_ids = list(self.book_ids)
+
+    def deltas(self, mids):
+        """
+        Returns the delta of one unit of every instrument, given the mids of the underlyings in an array indexed
+        like the registry. NaN where the mid of the underlying is unknown.
+        """
+        registry = self.registry
+        stock_value = np.full(len(registry), np.nan)
+        stock_value[self.risk_rows] = mids[registry.underlyings[self.risk_rows]]
+        time_to_expiry = registry.time_to_expiry()
+
+        deltas = np.where(self.is_future, np.exp(self.interest_rate * np.nan_to_num(time_to_expiry)), 1.0)
+        rows = self.option_rows
+        if len(rows):
+            if self.vol_source is not None:
+                sigma = np.array([self.vol_source.option_volatility(registry.instruments[row]) for row in rows])
+            else:
+                sigma = self.volatility
+            S, K, T = stock_value[rows], registry.strikes[rows], time_to_expiry[rows]
+            deltas[rows] = np.where(
+                registry.kinds[rows] == KIND_CALL,
+                call_delta(S, K, T, self.interest_rate, sigma),
+                put_delta(S, K, T, self.interest_rate, sigma),
+                )
+        return np.where(np.isnan(stock_value), np.nan, deltas)
+
+    def net_deltas(self, positions, deltas):
+        """
+        Returns the net delta per underlying, in an array indexed like the registry.
+        """
+        rows = self.risk_rows
+        exposure = np.nan_to_num(positions[rows] * deltas[rows])
+        return np.bincount(self.registry.underlyings[rows], weights=exposure, minlength=len(self.registry))
+
+    def cheapest_hedge(self, snapshot, underlying_row, side, mids, deltas):
+        """
+        Returns the row and best opposite level of the hedge instrument for <underlying_row> that is cheapest to
+        trade on <side> per unit of delta, or (None, None) if no hedge instrument has a quote on that side.
+        """
+        best_row, best_level, best_cost = None, None, np.inf
+        for row in self.hedge_rows[underlying_row]:
+            quotes = snapshot.best_bid_ask(self.registry.instrument_ids[row])
+            if quotes is None:
+                continue
+            # the carried spot is what the instrument should trade at, anything paid on top of it costs us
+            fair = mids[underlying_row] * deltas[row]
+            level = quotes[1] if side == 'bid' else quotes[0]
+            cost = (level.price - fair if side == 'bid' else fair - level.price) / deltas[row]
+            if cost < best_cost:
+                best_row, best_level, best_cost = row, level, cost
+        return best_row, best_level
+
+    def on_tick(self, engine, snapshot):
+        registry = self.registry
+        mids = np.full(len(registry), np.nan)
+        for row in self.underlying_rows:
+            quotes = snapshot.best_bid_ask(registry.instrument_ids[row])
+            if quotes is not None:
+                mids[row] = (quotes[0].price + quotes[1].price) / 2
+
+        deltas = self.deltas(mids)
+        net_deltas = self.net_deltas(registry.to_array(engine.risk.positions), deltas)
+        for underlying_row in self.underlying_rows:
+            net_delta = net_deltas[underlying_row]
+            if np.isnan(mids[underlying_row]) or abs(net_delta) <= self.band:
+                continue
+
+            side = 'ask' if net_delta > 0 else 'bid'
+            row, level = self.cheapest_hedge(snapshot, underlying_row, side, mids, deltas)
+            if row is None:
+                print(f'No quotes to hedge a delta of {net_delta:.1f} in {registry.instrument_ids[underlying_row]}.')
+                continue
+            instrument_id = registry.instrument_ids[row]
+            volume = min(int(round(abs(net_delta) / deltas[row])), self.max_volume, level.volume)
+            volume = engine.risk.allowed_volume(instrument_id, side, volume, self.position_limit)
+            if volume > 0:
+                print(f'- Hedging a delta of {net_delta:.1f} in {registry.instrument_ids[underlying_row]}: {side} ioc order in {instrument_id} for {volume} @ {level.price:8.2f}.')
+                engine.gateway.insert(instrument_id, price=level.price, volume=volume, side=side, order_type='ioc', tag='hedging')
+                self.hedges += 1
@@ -0,0 +1,146 @@
+from functools import lru_cache
+
+import numpy as np
+
+from optistrats.utils import slippery_credit
+
+
+CREDIT_IC_MODES = ['constant', 'rigid', 'linear-advocate', 'slippery']
+VOLUME_IC_MODES = ['constant', 'linear-advocate', 'linear-deprecate']
+
+SLIPPERY_CMAX = .5
+
+
+def _credit_curves(c0, v0, position_limit, ic_mode, positions):
+    bid = np.full(len(positions), c0, dtype=float)
+    ask = np.full(len(positions), c0, dtype=float)
+    if ic_mode == 'constant':
+        pass
+    elif ic_mode == 'rigid':
+        bid[positions == -position_limit] = 0
+        ask[positions == position_limit] = 0
+    elif ic_mode == 'linear-advocate':
+        factor = 1 - np.abs(positions) / position_limit
+        bid = np.where(positions < 0, c0 * factor, bid)
+        ask = np.where(positions > 0, c0 * factor, ask)
+    elif ic_mode == 'slippery':
+        bid = np.array([slippery_credit('bid', p, c0, SLIPPERY_CMAX, v0, position_limit) for p in positions.tolist()])
+        ask = np.array([slippery_credit('ask', p, c0, SLIPPERY_CMAX, v0, position_limit) for p in positions.tolist()])
+    else:
+        raise NotImplementedError(f"The credit {ic_mode} mode for inventory management has not been implemented.")
+    return bid, ask
+
+
+def _volume_curves(v0, position_limit, ic_mode, positions):
+    bid = np.full(len(positions), v0, dtype=int)
+    ask = np.full(len(positions), v0, dtype=int)
+    factor = 1 - np.abs(positions) / position_limit
+    if ic_mode == 'constant':
+        pass
+    elif ic_mode == 'linear-deprecate':
+        reduced = (v0 * factor).astype(int)
+        bid = np.where(positions > 0, reduced, bid)
+        ask = np.where(positions < 0, reduced, ask)
+    elif ic_mode == 'linear-advocate':
+        increased = (v0 * factor + np.abs(positions)).astype(int)
+        bid = np.where(positions < 0, increased, bid)
+        ask = np.where(positions > 0, increased, ask)
+    else:
+        raise NotImplementedError(f"The volume {ic_mode} mode for inventory management has not been implemented.")
+    return bid, ask
+
+
+class InventoryCurve:
+    """
+    A bid/ask pair of values for every position in [-position_limit, position_limit].
+    """
+    def __init__(self, position_limit, bid, ask):
+        self.position_limit = position_limit
+        self.bid = bid
+        self.ask = ask
+        # plain lists are faster than numpy arrays for single lookups and give back python numbers
+        self._pairs = list(zip(bid.tolist(), ask.tolist()))
+
+    def at(self, position):
+        return self._pairs[min(max(position, -self.position_limit), self.position_limit) + self.position_limit]
+
+    def evaluate(self, positions):
+        i = np.clip(positions, -self.position_limit, self.position_limit).astype(np.intp) + self.position_limit
+        return self.bid[i], self.ask[i]
+
+
+@lru_cache(maxsize=None)
+def credit_curve(credit, volume, position_limit, ic_mode):
+    positions = np.arange(-position_limit, position_limit + 1)
+    return InventoryCurve(position_limit, *_credit_curves(credit, volume, position_limit, ic_mode, positions))
+
+
+@lru_cache(maxsize=None)
+def volume_curve(volume, position_limit, ic_mode):
+    positions = np.arange(-position_limit, position_limit + 1)
+    return InventoryCurve(position_limit, *_volume_curves(volume, position_limit, ic_mode, positions))
+
+
+class InventoryPolicy:
+    """
+    Bid/ask credits and volumes for every position in [-position_limit, position_limit], computed once when the
+    policy is constructed, so that the per-tick inventory control is a single table lookup. The tables are shared
+    between all policies with the same hyperparameters.
+
+    Example usage:
+        policy = InventoryPolicy(0.03, 80, 100, 'slippery', 'linear-deprecate')
+        credit_bid, credit_ask, volume_bid, volume_ask = policy.lookup(position)
+    """
+    def __init__(self, credit=0.03, volume=80, position_limit=100, credit_ic_mode='constant', volume_ic_mode='constant'):
+        self.position_limit = position_limit
+        self.credit_ic_mode = credit_ic_mode
+        self.volume_ic_mode = volume_ic_mode
+        self.credits = credit_curve(credit, volume, position_limit, credit_ic_mode)
+        self.volumes = volume_curve(volume, position_limit, volume_ic_mode)
+
+    def lookup(self, position):
+        return self.credits.at(position) + self.volumes.at(position)
+
+    def evaluate(self, positions):
+        """
+        Returns the arrays (credit_bid, credit_ask, volume_bid, volume_ask) for a vector of positions.
+        """
+        return self.credits.evaluate(positions) + self.volumes.evaluate(positions)
+
+
+class InventoryPolicyBook:
+    """
+    Stacks the tables of one InventoryPolicy per instrument, so that the policies of all instruments are evaluated
+    at once from a vector of positions.
+
+    Example usage:
+        book = InventoryPolicyBook([market_maker.inventory_policy(credit_ic_mode, volume_ic_mode) for market_maker in makers])
+        credit_bid, credit_ask, volume_bid, volume_ask = book.evaluate(registry.to_array(positions, dtype=int))
+    """
+    def __init__(self, policies):
+        self.limits = np.array([policy.position_limit for policy in policies], dtype=np.intp)
+        width = 2 * int(self.limits.max(initial=0)) + 1
+        self.offset = (width - 1) // 2
+        self.credit_bid = np.zeros((len(policies), width))
+        self.credit_ask = np.zeros((len(policies), width))
+        self.volume_bid = np.zeros((len(policies), width), dtype=int)
+        self.volume_ask = np.zeros((len(policies), width), dtype=int)
+        for row, policy in enumerate(policies):
+            columns = slice(self.offset - policy.position_limit, self.offset + policy.position_limit + 1)
+            self.credit_bid[row, columns] = policy.credits.bid
+            self.credit_ask[row, columns] = policy.credits.ask
+            self.volume_bid[row, columns] = policy.volumes.bid
+            self.volume_ask[row, columns] = policy.volumes.ask
+        self._rows = np.arange(len(policies))
+
+    def evaluate(self, positions):
+        """
+        Returns the arrays (credit_bid, credit_ask, volume_bid, volume_ask), one entry per policy.
+        """
+        columns = np.clip(positions, -self.limits, self.limits).astype(np.intp) + self.offset
+        return (
+            self.credit_bid[self._rows, columns],
+            self.credit_ask[self._rows, columns],
+            self.volume_bid[self._rows, columns],
+            self.volume_ask[self._rows, columns],
+            )
@@ -1,19 +1,28 @@
 import datetime as dt
 import time, math
 import logging
-logging.getLogger('client').setLevel('ERROR')
+
+import numpy as np
 
 from optistrats.math.black_scholes import call_value, put_value, call_delta, put_delta
-from optistrats.utils import calculate_current_time_to_date, round_down_to_tick, round_up_to_tick
-from optistrats.utils import get_bid_ask, slippery_credit
+from optistrats.utils import calculate_current_time_to_date, ticks_down, ticks_up, from_ticks
+from optistrats.utils import get_bid_ask
+from optistrats.strats.inventory import InventoryPolicy
 
-from optibook.synchronous_client import Exchange
 from optibook.common_types import OptionKind
 
 
 class MarketMaker:
-    def __init__(self, instrument, credit=0.03, volume=80, ir=.03, vol=3, position_limit=100, tick_size=0.1):
+    def __init__(self, instrument, credit=0.03, volume=80, ir=.03, vol=3, position_limit=100, tick_size=0.1, risk=None, gateway=None, pricer=None, vol_source=None):
         self.primal = instrument
+        # optional PreTradeRiskEngine shared by all market makers, used instead of remote position lookups
+        self.risk = risk
+        # optional OrderGateway, orders are then queued and only sent when the gateway is flushed
+        self.gateway = gateway
+        # optional option pricer (e.g. a TheoreticalValueCache) used instead of calling Black-Scholes directly
+        self.pricer = pricer
+        # optional RealizedVolatilityBook or VolatilitySurface, option market makers then reprice with its volatility every cycle
+        self.vol_source = vol_source
         # trading environment and exchange resolution parameters
         self.interest_rate = ir
         self.volatility = vol
@@ -22,25 +31,48 @@ class MarketMaker:
         # market making algorithm hyperparameters
         self.c0 = credit
         self.v0 = volume
+        # InventoryPolicy of the hyperparameters above, built on first use and dropped when they change
+        self._inventory_policy = None
 
         
+    def get_position(self, exchange):
+        if self.risk is not None:
+            return self.risk.position(self.primal.instrument_id)
+        return exchange.get_positions()[self.primal.instrument_id]
+        
+        
     def get_traded_orders(self, exchange):
         """
-        Print any new trades
+        Print any new trades, and return them
         """
         trades = exchange.poll_new_trades(instrument_id=self.primal.instrument_id)
         for trade in trades:
             print(f'- Last period, traded {trade.volume} lots in {self.primal.instrument_id} at price {trade.price:.2f}, side {trade.side}.')
+            if self.risk is not None:
+                self.risk.on_trade(self.primal.instrument_id, trade.order_id, trade.side, trade.volume)
+        return trades
             
             
     def cancel_orders(self, exchange):
         """
         Remove any current oustanding orders
         """
+        if self.gateway is not None and self.risk is not None:
+            # our working orders are known locally, no need to ask the exchange
+            for order_id in self.risk.order_ids(self.primal.instrument_id):
+                print(f'- Deleting old order {order_id} in {self.primal.instrument_id}.')
+                self.gateway.delete(self.primal.instrument_id, order_id)
+            return
+        
         orders = exchange.get_outstanding_orders(instrument_id=self.primal.instrument_id)
         for order_id, order in orders.items():
             print(f'- Deleting old {order.side} order in {self.primal.instrument_id} for {order.volume} @ {order.price:8.2f}.')
+            if self.gateway is not None:
+                self.gateway.delete(self.primal.instrument_id, order_id)
+                continue
             exchange.delete_order(instrument_id=self.primal.instrument_id, order_id=order_id)
+            if self.risk is not None:
+                self.risk.on_order_deleted(order_id)
     
 
     def update_limit_orders(self, exchange, theoretical_bid_price, theoretical_ask_price):
@@ -55,147 +87,165 @@ class MarketMaker:
             theoretical_bid_price: float   -  Price to bid around
             theoretical_ask_price: float   -  Price to ask around
         """
-        # Calculate bid and ask price
-        bid_price = round_down_to_tick(theoretical_bid_price - self.credit_bid, self.tick_size)
-        ask_price = round_up_to_tick(theoretical_ask_price + self.credit_ask, self.tick_size)
+        if not (math.isfinite(theoretical_bid_price) and math.isfinite(theoretical_ask_price)):
+            print(f'- Not quoting {self.primal.instrument_id}, its theoretical prices are {theoretical_bid_price} and {theoretical_ask_price}.')
+            return
+        
+        # Calculate bid and ask price, in ticks, only converted to prices when sent
+        bid_ticks, ask_ticks = self.quote_ticks(theoretical_bid_price, theoretical_ask_price)
+        bid_price = from_ticks(bid_ticks, self.tick_size)
+        ask_price = from_ticks(ask_ticks, self.tick_size)
     
         # Calculate bid and ask volumes, taking into account the provided position_limit
-        position = exchange.get_positions()[self.primal.instrument_id]
-    
-        max_volume_to_buy = self.position_limit - position
-        max_volume_to_sell = self.position_limit + position
-    
-        bid_volume = min(self.volume_bid, max_volume_to_buy)
-        ask_volume = min(self.volume_ask, max_volume_to_sell)
+        if self.risk is not None:
+            # also counts the volume of our working orders, so resting quotes can never take us over the limit
+            bid_volume = self.risk.allowed_volume(self.primal.instrument_id, 'bid', self.volume_bid, self.position_limit)
+            ask_volume = self.risk.allowed_volume(self.primal.instrument_id, 'ask', self.volume_ask, self.position_limit)
+        else:
+            position = exchange.get_positions()[self.primal.instrument_id]
+        
+            max_volume_to_buy = self.position_limit - position
+            max_volume_to_sell = self.position_limit + position
+        
+            bid_volume = min(self.volume_bid, max_volume_to_buy)
+            ask_volume = min(self.volume_ask, max_volume_to_sell)
     
         # Insert new limit orders
+        self.insert_quotes(exchange, bid_price, bid_volume, ask_price, ask_volume)
+            
+            
+    def insert_quotes(self, exchange, bid_price, bid_volume, ask_price, ask_volume):
+        """
+        Inserts a bid and an ask limit order at prices already sized and rounded to the tick, skipping a side without
+        volume. The old orders are not deleted, see `cancel_orders`.
+        """
         if bid_volume > 0:
             print(f'- Inserting bid limit order in {self.primal.instrument_id} for {bid_volume} @ {bid_price:8.2f}.')
-            exchange.insert_order(
-                instrument_id=self.primal.instrument_id,
-                price=bid_price,
-                volume=bid_volume,
-                side='bid',
-                order_type='limit',
-            )
+            self._insert_limit_order(exchange, bid_price, bid_volume, 'bid')
         if ask_volume > 0:
             print(f'- Inserting ask limit order in {self.primal.instrument_id} for {ask_volume} @ {ask_price:8.2f}.')
-            exchange.insert_order(
-                instrument_id=self.primal.instrument_id,
-                price=ask_price,
-                volume=ask_volume,
-                side='ask',
-                order_type='limit',
-            )
+            self._insert_limit_order(exchange, ask_price, ask_volume, 'ask')
             
-    
-    def _volume_constant(self):
-        self.volume_bid = self.v0
-        self.volume_ask = self.v0        
+            
+    def quote_ticks(self, theoretical_bid_price, theoretical_ask_price):
+        """
+        Returns the bid and ask prices we quote around the theoretical prices with the current credits, in ticks.
+        """
+        bid_ticks = ticks_down(theoretical_bid_price - self.credit_bid, self.tick_size)
+        ask_ticks = ticks_up(theoretical_ask_price + self.credit_ask, self.tick_size)
+        return bid_ticks, ask_ticks
         
         
-    def _volume_linear_deprecate(self, exchange):
-        self.volume_bid = self.v0
-        self.volume_ask = self.v0            
-        instrument_id = self.primal.instrument_id
-        position = exchange.get_positions()[instrument_id]
-        factor = 1 - abs(position) / self.position_limit
-        if position > 0:
-            self.volume_bid = int(self.volume_bid * factor)
-        elif position < 0:
-            self.volume_ask = int(self.volume_ask * factor)
+    def _insert_limit_order(self, exchange, price, volume, side):
+        if self.gateway is not None:
+            # returns a Future, the gateway books the order with the risk engine once acknowledged
+            return self.gateway.insert(self.primal.instrument_id, price, volume, side, order_type='limit', tag='market_making')
+        response = exchange.insert_order(
+            instrument_id=self.primal.instrument_id,
+            price=price,
+            volume=volume,
+            side=side,
+            order_type='limit',
+        )
+        if self.risk is not None and response.success:
+            self.risk.on_order_inserted(self.primal.instrument_id, response.order_id, side, volume)
+        return response
             
     
-    def _volume_linear_advocate(self, exchange):
-        self.volume_bid = self.v0
-        self.volume_ask = self.v0            
-        instrument_id = self.primal.instrument_id
-        position = exchange.get_positions()[instrument_id]
-        factor = 1 - abs(position) / self.position_limit
-        v = int(self.v0 * factor + abs(position))
-        if position > 0:
-            self.volume_ask = v
-        elif position < 0:
-            self.volume_bid = v
+    def set_inventory_parameters(self, credit=None, volume=None, position_limit=None):
+        """
+        Updates the credit, volume and/or position limit hyperparameters, rebuilding the inventory policy on next use.
+        """
+        if credit is not None:
+            self.c0 = credit
+        if volume is not None:
+            self.v0 = volume
+        if position_limit is not None:
+            self.position_limit = position_limit
+        self._inventory_policy = None
+    
+    
+    def inventory_policy(self, credit_ic_mode, volume_ic_mode):
+        """
+        Returns the InventoryPolicy of the current hyperparameters, kept on the market maker until they or the modes change.
+        """
+        policy = self._inventory_policy
+        if policy is None or policy.credit_ic_mode != credit_ic_mode or policy.volume_ic_mode != volume_ic_mode:
+            policy = self._inventory_policy = InventoryPolicy(self.c0, self.v0, self.position_limit, credit_ic_mode, volume_ic_mode)
+        return policy
     
     
     def select_volumes(self, exchange, ic_mode):
-        if ic_mode == 'constant':
-            self._volume_constant()
-        elif ic_mode == 'linear-deprecate':
-            self._volume_linear_deprecate(exchange)
-        elif ic_mode == 'linear-advocate':
-            self._volume_linear_advocate(exchange)
-        else:
-            raise NotImplementedError(f"The volume {ic_mode} mode for inventory management has not been implemented.")
-                
-                
-    def _credit_constant(self):
-        self.credit_bid = self.c0
-        self.credit_ask = self.c0   
-        
-                
-    def _credit_linear_advocate(self, exchange):
-        self.credit_bid = self.c0
-        self.credit_ask = self.c0
-        instrument_id = self.primal.instrument_id
-        position = exchange.get_positions()[instrument_id]
-        factor = 1 - abs(position) / self.position_limit
-        if position > 0:
-            self.credit_ask *= factor
-        elif position < 0:
-            self.credit_bid *= factor
-            
+        """
+        Sets the bid and ask volumes for the current position, looked up in the precomputed volume curve of <ic_mode>
+        (one of 'constant', 'linear-advocate', 'linear-deprecate').
+        """
+        policy = self._inventory_policy
+        if policy is None or policy.volume_ic_mode != ic_mode:
+            policy = self.inventory_policy(policy.credit_ic_mode if policy is not None else 'constant', ic_mode)
+        position = self.get_position(exchange)
+        self.volume_bid, self.volume_ask = policy.volumes.at(position)
                 
-    def _credit_rigid(self, exchange):
-        self.credit_bid = self.c0
-        self.credit_ask = self.c0
-        instrument_id = self.primal.instrument_id
-        position = exchange.get_positions()[instrument_id]
-        if position == self.position_limit:
-            self.credit_ask = 0
-        elif position == -self.position_limit:
-            self.credit_bid = 0        
-    
-    
-    def _credit_slippery(self, exchange):
-        instrument_id = self.primal.instrument_id
-        position = exchange.get_positions()[instrument_id]
-        cmax = .5
-        self.credit_bid = slippery_credit(
-            'bid', position, self.c0, cmax, self.v0, self.position_limit
-            )
-        self.credit_ask = slippery_credit(
-            'ask', position, self.c0, cmax, self.v0, self.position_limit
-            )
-
             
     def select_credits(self, exchange, ic_mode):
-        if ic_mode == 'constant':
-            self._credit_constant()
-        elif ic_mode == 'rigid':
-            self._credit_rigid(exchange)
-        elif ic_mode == 'linear-advocate':
-            self._credit_linear_advocate(exchange)
-        elif ic_mode == 'slippery':
-            self._credit_slippery(exchange)
-        else:
-            raise NotImplementedError(f"The credit {ic_mode} mode for inventory management has not been implemented.")
+        """
+        Sets the bid and ask credits for the current position, looked up in the precomputed credit curve of <ic_mode>
+        (one of 'constant', 'rigid', 'linear-advocate', 'slippery').
+        """
+        policy = self._inventory_policy
+        if policy is None or policy.credit_ic_mode != ic_mode:
+            policy = self.inventory_policy(ic_mode, policy.volume_ic_mode if policy is not None else 'constant')
+        position = self.get_position(exchange)
+        self.credit_bid, self.credit_ask = policy.credits.at(position)
                 
 
+
 class StockMarketMaker(MarketMaker):
     def compute_fair_quotes(self, stock_bid_price, stock_ask_price):
         return stock_bid_price, stock_ask_price
         
         
+    def compute_delta(self, stock_value):
+        return 1.0
+        
+        
 class FutureMarketMaker(MarketMaker):
     def compute_fair_quotes(self, stock_bid_price, stock_ask_price):
         tau = calculate_current_time_to_date(self.primal.expiry)
         ratio = math.exp(self.interest_rate*tau)
         return stock_bid_price * ratio, stock_ask_price * ratio
         
+        
+    def compute_delta(self, stock_value):
+        tau = calculate_current_time_to_date(self.primal.expiry)
+        return math.exp(self.interest_rate*tau)
+        
 
 class OptionMarketMaker(MarketMaker):
+    def set_pricing_parameters(self, volatility=None, interest_rate=None):
+        """
+        Updates the volatility and/or interest rate used for pricing, dropping any values the pricer cached for
+        this option under the old parameters.
+        """
+        if volatility is not None:
+            self.volatility = volatility
+        if interest_rate is not None:
+            self.interest_rate = interest_rate
+        if self.pricer is not None:
+            self.pricer.invalidate(self.primal.instrument_id)
+        
+        
+    def refresh_volatility(self):
+        """
+        Reads the latest volatility of this option from the vol source, if any, and switches to it when it changed.
+        """
+        if self.vol_source is None:
+            return
+        volatility = self.vol_source.option_volatility(self.primal)
+        if volatility != self.volatility:
+            self.set_pricing_parameters(volatility=volatility)
+        
+        
     def _calculate_theoretical_option_value(self, stock_value):
         """
         This function calculates the current fair call or put value based on Black & Scholes assumptions.
@@ -206,6 +256,9 @@ class OptionMarketMaker(MarketMaker):
         strike = self.primal.strike
         option_kind = self.primal.option_kind
         time_to_expiry = calculate_current_time_to_date(expiry)
+        
+        if self.pricer is not None:
+            return self.pricer.value(self.primal, stock_value, time_to_expiry, self.interest_rate, self.volatility)
     
         if option_kind == OptionKind.CALL:
             option_value = call_value(S=stock_value, K=strike, T=time_to_expiry, r=self.interest_rate, sigma=self.volatility)
@@ -216,6 +269,7 @@ class OptionMarketMaker(MarketMaker):
         
         
     def compute_fair_quotes(self, stock_bid_price, stock_ask_price):
+        self.refresh_volatility()
         theoretical_value_1 = self._calculate_theoretical_option_value(
             stock_bid_price
             )
@@ -227,8 +281,179 @@ class OptionMarketMaker(MarketMaker):
         return theoretical_bid_price, theoretical_ask_price
         
         
+    def compute_delta(self, stock_value):
+        time_to_expiry = calculate_current_time_to_date(self.primal.expiry)
+        if self.primal.option_kind == OptionKind.CALL:
+            return call_delta(S=stock_value, K=self.primal.strike, T=time_to_expiry, r=self.interest_rate, sigma=self.volatility)
+        else:
+            return put_delta(S=stock_value, K=self.primal.strike, T=time_to_expiry, r=self.interest_rate, sigma=self.volatility)
+
+
+class MarketMakingStrategy:
+    """
+    Runs a set of market makers as a TradingEngine strategy. The market makers must share the engine's
+    PreTradeRiskEngine and OrderGateway, so that a tick makes no exchange calls besides the engine's snapshot.
+    
+    With a RealizedVolatilityBook the mid of every underlying is fed to it each tick, with a VolatilitySurface the
+    option books are added to the snapshot and the smiles of every underlying are refitted each tick.
+    
+    Fair quotes are only recomputed when the touch of the underlying moved, the volatility changed or they are older
+    than <reprice_seconds>; otherwise the previous ones are requoted with the current credits and volumes.
+    
+    With a RequoteScheduler only the instruments it picks within its message budget are requoted, the others keep
+    their live orders until a later tick. Instruments that traded are always picked first.
+    
+    With a MarketMakingBook over the same market makers, all quotes are computed at once from the book's arrays
+    instead of market maker by market maker.
+    """
+    def __init__(self, market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode, vol_book=None, vol_surface=None,
+                 reprice_seconds=5, scheduler=None, book=None):
+        self.market_makers_dict = market_makers_dict
+        self.underlying_dict = underlying_dict
+        self.credit_ic_mode = credit_ic_mode
+        self.volume_ic_mode = volume_ic_mode
+        self.underlying_ids = sorted({underlying_dict[instrument_id] for instrument_id in market_makers_dict})
+        self.book_ids = list(self.underlying_ids)
+        self.traded_ids = sorted(market_makers_dict)
+        # optional RealizedVolatilityBook, fed with the mid of every underlying once per tick
+        self.vol_book = vol_book
+        # optional VolatilitySurface, refitted to the option mids once per tick
+        self.vol_surface = vol_surface
+        self.reprice_seconds = reprice_seconds
+        self.scheduler = scheduler
+        self.book = book
+        self.repriced = 0
+        self.reused = 0
+        # instrument_id -> (time, volatility, fair quotes) of the last pricing
+        self._fair_quotes = {}
+        # underlying_id -> the options we make markets in on it
+        self.options_by_underlying = {}
+        if vol_surface is not None:
+            for instrument_id, market_maker in market_makers_dict.items():
+                if isinstance(market_maker, OptionMarketMaker):
+                    self.options_by_underlying.setdefault(underlying_dict[instrument_id], []).append(market_maker.primal)
+            self.book_ids = sorted(set(self.book_ids) | {
+                option.instrument_id for options in self.options_by_underlying.values() for option in options
+                })
+        
+        
+    def fit_vol_surface(self, snapshot):
+        for underlying_id, options in self.options_by_underlying.items():
+            stock_value = snapshot.best_bid_ask(underlying_id)
+            if stock_value is None:
+                continue
+            option_mids = []
+            for option in options:
+                quotes = snapshot.best_bid_ask(option.instrument_id)
+                option_mids.append(None if quotes is None else (quotes[0].price + quotes[1].price) / 2)
+            time_to_expiry = [calculate_current_time_to_date(option.expiry) for option in options]
+            self.vol_surface.fit(options, option_mids, (stock_value[0].price + stock_value[1].price) / 2, time_to_expiry)
+            
+            
+    def fair_quotes(self, snapshot, instrument_id, market_maker, stock_value):
+        if isinstance(market_maker, OptionMarketMaker):
+            market_maker.refresh_volatility()
+        now = time.monotonic()
+        last = self._fair_quotes.get(instrument_id)
+        if (
+            last is not None
+            and not snapshot.touch_changed(self.underlying_dict[instrument_id])
+            and last[1] == market_maker.volatility
+            and now - last[0] < self.reprice_seconds
+        ):
+            self.reused += 1
+            return last[2]
+        
+        stock_bid, stock_ask = stock_value
+        quotes = market_maker.compute_fair_quotes(stock_bid.price, stock_ask.price)
+        self._fair_quotes[instrument_id] = (now, market_maker.volatility, quotes)
+        self.repriced += 1
+        return quotes
+            
+            
+    def on_tick(self, engine, snapshot):
+        if self.vol_surface is not None:
+            self.fit_vol_surface(snapshot)
+        if self.vol_book is not None:
+            for underlying_id in self.underlying_ids:
+                quotes = snapshot.best_bid_ask(underlying_id)
+                if quotes is not None:
+                    self.vol_book.update(underlying_id, (quotes[0].price + quotes[1].price) / 2)
+        
+        if self.book is not None:
+            self.requote_book(engine, snapshot)
+            return
+                    
+        fair_quotes = {}
+        for instrument_id, market_maker in self.market_makers_dict.items():
+            stock_value = snapshot.best_bid_ask(self.underlying_dict[instrument_id])
+            if stock_value is None:
+                print(f'Empty stock order book on bid or ask-side, or both, unable to update {instrument_id} prices.')
+                continue
+            fair_quotes[instrument_id] = self.fair_quotes(snapshot, instrument_id, market_maker, stock_value)
+            
+        if self.scheduler is not None:
+            # the credits and volumes are needed to know how far the new quotes are from the live ones
+            quotes = {}
+            for instrument_id, (theoretical_bid_price, theoretical_ask_price) in fair_quotes.items():
+                if not (math.isfinite(theoretical_bid_price) and math.isfinite(theoretical_ask_price)):
+                    continue
+                market_maker = self.market_makers_dict[instrument_id]
+                market_maker.select_credits(engine.exchange, self.credit_ic_mode)
+                market_maker.select_volumes(engine.exchange, self.volume_ic_mode)
+                quotes[instrument_id] = (
+                    *market_maker.quote_ticks(theoretical_bid_price, theoretical_ask_price),
+                    market_maker.volume_bid, market_maker.volume_ask,
+                    )
+            selected = self.scheduler.plan(self.requote_candidates(snapshot, quotes))
+            fair_quotes = {instrument_id: fair_quotes[instrument_id] for instrument_id in selected}
+            
+        for instrument_id, (theoretical_bid_price, theoretical_ask_price) in fair_quotes.items():
+            market_maker = self.market_makers_dict[instrument_id]
+            if self.scheduler is None:
+                market_maker.select_credits(engine.exchange, self.credit_ic_mode)
+                market_maker.select_volumes(engine.exchange, self.volume_ic_mode)
+            market_maker.cancel_orders(engine.exchange)
+            market_maker.update_limit_orders(engine.exchange, theoretical_bid_price, theoretical_ask_price)
+            if self.scheduler is not None:
+                self.scheduler.mark_requoted(instrument_id, *quotes[instrument_id])
+                
+                
+    def requote_book(self, engine, snapshot):
+        book = self.book
+        book.compute_quotes(snapshot, engine.risk.positions, engine.risk)
+        rows = np.flatnonzero(book.quotable)
+        if self.scheduler is not None:
+            quotes = {book.instrument_ids[row]: book.quote(row) for row in rows}
+            selected = self.scheduler.plan(self.requote_candidates(snapshot, quotes))
+            rows = [book.index[instrument_id] for instrument_id in selected]
+            
+        for row in rows:
+            book.send_quotes(engine.exchange, row)
+            if self.scheduler is not None:
+                self.scheduler.mark_requoted(book.instrument_ids[row], *book.quote(row))
+                
+                
+    def requote_candidates(self, snapshot, quotes):
+        """
+        quotes: dict             -  instrument_id -> (bid ticks, ask ticks, bid volume, ask volume) we would quote now
+        """
+        candidates = {}
+        for instrument_id, quote in quotes.items():
+            market_maker = self.market_makers_dict[instrument_id]
+            # deletes of the working orders plus a new bid and ask
+            if market_maker.risk is not None:
+                messages = len(market_maker.risk.order_ids(instrument_id)) + 2
+            else:
+                messages = 4
+            candidates[instrument_id] = (*quote, messages, instrument_id in snapshot.trades)
+        return candidates
+
 
 if __name__ == "__main__":
+    from optibook.synchronous_client import Exchange
+
+    logging.getLogger('client').setLevel('ERROR')
     exchange = Exchange()
     exchange.connect()
     market_maker = OptionMarketMaker(exchange.get_instruments()['NVDA_202406_050P'])
@@ -0,0 +1,182 @@
+import datetime as dt
+
+import numpy as np
+from optibook.common_types import OptionKind
+
+from optistrats.math.black_scholes import call_value, put_value
+from optistrats.strats.inventory import InventoryPolicyBook
+from optistrats.utils import from_ticks, TICK_EPSILON
+from optistrats.strats.market_maker import StockMarketMaker, FutureMarketMaker, OptionMarketMaker
+
+
+_SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+class MarketMakingBook:
+    """
+    The quoting state of a set of market makers as one struct of arrays, one entry per market maker: fair values,
+    credits, volumes, positions and the resulting quote prices (in integer ticks) and volumes. A requote of the whole book is a few
+    vector operations, computing per kind exactly what StockMarketMaker, FutureMarketMaker and OptionMarketMaker
+    compute one at a time:
+        stocks:   the underlying's bid and ask
+        futures:  the underlying's bid and ask carried to expiry at the interest rate
+        options:  the Black-Scholes values at the underlying's bid and ask, lowest as bid and highest as ask
+
+    The market maker objects are kept for their hyperparameters, volatility sources and order handling.
+
+    Example usage:
+        book = MarketMakingBook(market_makers_dict, underlying_dict, 'slippery', 'linear-deprecate')
+        book.compute_quotes(snapshot, risk.positions, risk)
+        for row in np.flatnonzero(book.quotable):
+            book.send_quotes(exchange, row)
+    """
+    def __init__(self, market_makers_dict, underlying_dict, credit_ic_mode, volume_ic_mode):
+        self.instrument_ids = list(market_makers_dict)
+        self.market_makers = [market_makers_dict[instrument_id] for instrument_id in self.instrument_ids]
+        self.index = {instrument_id: row for row, instrument_id in enumerate(self.instrument_ids)}
+        self.underlying_ids = sorted({underlying_dict[instrument_id] for instrument_id in self.instrument_ids})
+        underlying_rows = {underlying_id: row for row, underlying_id in enumerate(self.underlying_ids)}
+        self.underlying_rows = np.array(
+            [underlying_rows[underlying_dict[instrument_id]] for instrument_id in self.instrument_ids], dtype=np.intp
+            )
+
+        for market_maker in self.market_makers:
+            if not isinstance(market_maker, (StockMarketMaker, FutureMarketMaker, OptionMarketMaker)):
+                raise NotImplementedError(f"{type(market_maker).__name__} is not supported by the MarketMakingBook.")
+        self.is_future = np.array([isinstance(market_maker, FutureMarketMaker) for market_maker in self.market_makers])
+        self.is_option = np.array([isinstance(market_maker, OptionMarketMaker) for market_maker in self.market_makers])
+        self.option_rows = np.flatnonzero(self.is_option)
+        self.is_call = np.array([
+            market_maker.primal.option_kind == OptionKind.CALL if is_option else False
+            for market_maker, is_option in zip(self.market_makers, self.is_option)
+            ])
+        self.strikes = np.array([
+            market_maker.primal.strike if is_option else np.nan
+            for market_maker, is_option in zip(self.market_makers, self.is_option)
+            ], dtype=float)
+        self.expiries = np.array([
+            market_maker.primal.expiry.timestamp() if is_option or is_future else np.nan
+            for market_maker, is_option, is_future in zip(self.market_makers, self.is_option, self.is_future)
+            ], dtype=float)
+        self.tick_sizes = np.array([market_maker.tick_size for market_maker in self.market_makers], dtype=float)
+        self.position_limits = np.array([market_maker.position_limit for market_maker in self.market_makers])
+        self.interest_rates = np.array([market_maker.interest_rate for market_maker in self.market_makers], dtype=float)
+        self.volatilities = np.array([market_maker.volatility for market_maker in self.market_makers], dtype=float)
+        # only these can change volatility by themselves between cycles
+        self.vol_source_rows = [
+            row for row in self.option_rows if self.market_makers[row].vol_source is not None
+            ]
+        self.policies = InventoryPolicyBook(
+            [market_maker.inventory_policy(credit_ic_mode, volume_ic_mode) for market_maker in self.market_makers]
+            )
+
+        n = len(self)
+        self.positions = np.zeros(n, dtype=np.int64)
+        self.fair_bid = np.full(n, np.nan)
+        self.fair_ask = np.full(n, np.nan)
+        self.credit_bid = np.zeros(n)
+        self.credit_ask = np.zeros(n)
+        self.bid_ticks = np.zeros(n, dtype=np.int64)
+        self.ask_ticks = np.zeros(n, dtype=np.int64)
+        self.bid_volume = np.zeros(n, dtype=np.int64)
+        self.ask_volume = np.zeros(n, dtype=np.int64)
+        # False where the underlying's book was not two-sided this cycle
+        self.quotable = np.zeros(n, dtype=bool)
+
+    def __len__(self):
+        return len(self.instrument_ids)
+
+    def refresh_parameters(self, all_rows=False):
+        """
+        Lets option market makers with a vol source pick up their latest volatility and copies it. With <all_rows>,
+        copies the interest rates and volatilities of all market makers, e.g. after setting them by hand.
+        """
+        rows = range(len(self)) if all_rows else self.vol_source_rows
+        for row in rows:
+            market_maker = self.market_makers[row]
+            if self.is_option[row] and market_maker.vol_source is not None:
+                market_maker.refresh_volatility()
+            self.interest_rates[row] = market_maker.interest_rate
+            self.volatilities[row] = market_maker.volatility
+
+    def compute_fair_quotes(self, stock_bids, stock_asks, current_time=None):
+        """
+        Sets the fair bid and ask of every instrument from the bids and asks of their underlyings, given as arrays
+        ordered like `underlying_ids`.
+        """
+        if current_time is None:
+            current_time = dt.datetime.now()
+        stock_bid = np.asarray(stock_bids, dtype=float)[self.underlying_rows]
+        stock_ask = np.asarray(stock_asks, dtype=float)[self.underlying_rows]
+        time_to_expiry = (self.expiries - current_time.timestamp()) / _SECONDS_PER_YEAR
+
+        carry = np.where(self.is_future, np.exp(self.interest_rates * np.nan_to_num(time_to_expiry)), 1.0)
+        fair_bid = stock_bid * carry
+        fair_ask = stock_ask * carry
+
+        rows = self.option_rows
+        if len(rows):
+            K, T, r, sigma = self.strikes[rows], time_to_expiry[rows], self.interest_rates[rows], self.volatilities[rows]
+            is_call = self.is_call[rows]
+            value_1 = np.where(is_call, call_value(stock_bid[rows], K, T, r, sigma), put_value(stock_bid[rows], K, T, r, sigma))
+            value_2 = np.where(is_call, call_value(stock_ask[rows], K, T, r, sigma), put_value(stock_ask[rows], K, T, r, sigma))
+            fair_bid[rows] = np.minimum(value_1, value_2)
+            fair_ask[rows] = np.maximum(value_1, value_2)
+
+        self.fair_bid, self.fair_ask = fair_bid, fair_ask
+
+    def compute_quotes(self, snapshot, positions, risk=None):
+        """
+        Computes the quote prices and volumes of every instrument whose underlying has a two-sided book in
+        <snapshot>, assuming all working orders are deleted before the new quotes go in, as in
+        `MarketMaker.update_limit_orders`.
+
+        positions: dict          -  instrument_id -> position, e.g. `risk.positions` or `exchange.get_positions()`
+        risk: PreTradeRiskEngine -  if given, sizes the volumes like `allowed_volume`, also counting the orders not
+                                    yet answered and the shared gross position limit
+        """
+        stock_bids = np.full(len(self.underlying_ids), np.nan)
+        stock_asks = np.full(len(self.underlying_ids), np.nan)
+        for row, underlying_id in enumerate(self.underlying_ids):
+            quotes = snapshot.best_bid_ask(underlying_id)
+            if quotes is not None:
+                stock_bids[row], stock_asks[row] = quotes[0].price, quotes[1].price
+
+        self.refresh_parameters()
+        self.compute_fair_quotes(stock_bids, stock_asks)
+        # a failed pricing leaves NaN fair values even with a two-sided underlying book
+        self.quotable = np.isfinite(self.fair_bid) & np.isfinite(self.fair_ask)
+
+        self.positions = np.fromiter(
+            (positions.get(instrument_id, 0) for instrument_id in self.instrument_ids), dtype=np.int64, count=len(self)
+            )
+        self.credit_bid, self.credit_ask, volume_bid, volume_ask = self.policies.evaluate(self.positions)
+        # instruments that are not quotable have NaN fair values, their ticks are meaningless
+        bid_ticks = np.floor(np.nan_to_num((self.fair_bid - self.credit_bid) / self.tick_sizes) + TICK_EPSILON)
+        ask_ticks = np.ceil(np.nan_to_num((self.fair_ask + self.credit_ask) / self.tick_sizes) - TICK_EPSILON)
+        self.bid_ticks = bid_ticks.astype(np.int64)
+        self.ask_ticks = ask_ticks.astype(np.int64)
+        if risk is not None:
+            self.bid_volume = risk.allowed_volumes(self.instrument_ids, 'bid', volume_bid, self.position_limits, replacing=True)
+            self.ask_volume = risk.allowed_volumes(self.instrument_ids, 'ask', volume_ask, self.position_limits, replacing=True)
+        else:
+            self.bid_volume = np.maximum(0, np.minimum(volume_bid, self.position_limits - self.positions))
+            self.ask_volume = np.maximum(0, np.minimum(volume_ask, self.position_limits + self.positions))
+
+    def quote(self, row):
+        """
+        Returns the computed bid and ask of the market maker in <row>, as (bid ticks, ask ticks, bid volume, ask volume).
+        """
+        return int(self.bid_ticks[row]), int(self.ask_ticks[row]), int(self.bid_volume[row]), int(self.ask_volume[row])
+
+    def send_quotes(self, exchange, row):
+        """
+        Replaces the working orders of the market maker in <row> by its computed quotes.
+        """
+        market_maker = self.market_makers[row]
+        market_maker.cancel_orders(exchange)
+        market_maker.insert_quotes(
+            exchange,
+            from_ticks(int(self.bid_ticks[row]), self.tick_sizes[row]), int(self.bid_volume[row]),
+            from_ticks(int(self.ask_ticks[row]), self.tick_sizes[row]), int(self.ask_volume[row]),
+            )
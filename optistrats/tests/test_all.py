@@ -1,17 +1,55 @@
+import sys
+import time
+import threading
+import subprocess
 import unittest
+import pytest
+import numpy as np
 import optistrats.utils as utils
 from optistrats.scripts.run import underlying_hash, market_makers_hash
+import datetime as dt
+from types import SimpleNamespace
 from optibook.synchronous_client import Exchange
-from optistrats.strats.market_maker import OptionMarketMaker
+from optibook.common_types import OptionKind
+from optistrats.strats.market_maker import OptionMarketMaker, StockMarketMaker, FutureMarketMaker
+from optistrats.strats.market_making_book import MarketMakingBook
+from optistrats.strats.hedger import DeltaHedger
+from optistrats.strats.arbitrage import DualListArb
+from optistrats.instruments import InstrumentRegistry, KIND_OPTION, KIND_FUTURE, KIND_CALL
+from optistrats.risk import SharedRiskBlock, PreTradeRiskEngine
+from optistrats.scripts.run_sharded import partition_by_underlying
+from optistrats.gateway import OrderGateway
+from optistrats.strats.inventory import InventoryPolicy, InventoryPolicyBook
+from optistrats.math.pricing_cache import TheoreticalValueCache
+from optistrats.math.black_scholes import call_value
+from optistrats.math.taylor import TaylorPricer
+from optistrats.math.surface import SurfacePricer, build_price_surface
+from optistrats.math.volatility import RealizedVolatilityEstimator, RealizedVolatilityBook
+from optistrats.math.vol_surface import VolatilitySurface, implied_volatility
+from optistrats.math.black_scholes import put_value
+from optistrats.engine import TradingEngine
+from optistrats.book_cache import OrderBookCache
+from optistrats.market_data_bus import MarketDataBus
+from optistrats.scheduler import RequoteScheduler, TokenBucket
+from optistrats.hyperparam.stress_simulation import simulate_sessions, stress_test
+from optistrats.profiling import ProfilingController
+from optistrats.state_snapshot import StateSnapshotter, capture_state, restore_risk, restore_market_makers
+from optistrats.metrics import MetricsRegistry, InstrumentedExchange, MetricsServer, RollingMetricsFile
+from optistrats.pnl import PnLEngine
 
-from hyperparameter import trade_one_iteration
+from optistrats.hyperparam.hyperparameter_search_individual import trade_one_iteration
 
-exchange = Exchange()
-exchange.connect()
+
+@pytest.fixture(scope='module')
+def exchange():
+    # only tests that need the exchange connect to it, and only when they run
+    exchange = Exchange()
+    exchange.connect()
+    return exchange
 
 
 class TestMarketMaker:
-    def test_OptionMarketMaker_init_(self):
+    def test_OptionMarketMaker_init_(self, exchange):
         option_id = utils.option_ids[0]
         option = exchange.get_instruments()[option_id]
         omm = OptionMarketMaker(option)
@@ -19,7 +57,7 @@ class TestMarketMaker:
         print(omm.primal.base_instrument_id)
         
         
-    def test_OptionMarketMaker__calculate_theoretical_option_value(self):
+    def test_OptionMarketMaker__calculate_theoretical_option_value(self, exchange):
         option_id = utils.option_ids[0]
         option = exchange.get_instruments()[option_id]
         omm = OptionMarketMaker(option)
@@ -27,23 +65,22 @@ class TestMarketMaker:
         print(omm._calculate_theoretical_option_value(stock_value))
         
         
-    def test_OptionMarketMaker__compute_fair_quotes(self):
+    def test_OptionMarketMaker__compute_fair_quotes(self, exchange):
         option_id = utils.option_ids[1]
         option = exchange.get_instruments()[option_id]
         omm = OptionMarketMaker(option)     
         print(omm.compute_fair_quotes(25.1, 25.3))
         
-    def test_trade_load(self):
-        all_instruments = exchange.get_instruments()
-        underlying_dict = underlying_hash(all_instruments)
+    def test_trade_load(self, exchange):
+        registry = InstrumentRegistry(exchange.get_instruments())
+        underlying_dict = underlying_hash(registry)
         assert underlying_dict['CSCO'] == 'CSCO'
         print(underlying_dict)
         
         
-    def test_trade_init(self):
-        all_instruments = exchange.get_instruments()
-        underlying_dict = underlying_hash(all_instruments)
-        market_makers_dict = market_makers_hash(all_instruments, underlying_dict)
+    def test_trade_init(self, exchange):
+        registry = InstrumentRegistry(exchange.get_instruments())
+        market_makers_dict = market_makers_hash(registry)
         print(market_makers_dict)
         
         
@@ -61,21 +98,1125 @@ class TestMarketMaker:
         assert utils.detect_arbitrage(best_bid_price, best_ask_price, theoretical_bid_price, theoretical_ask_price) == 'bid'
         
         
+    def test_ticks(self):
+        assert utils.round_down_to_tick(0.3, 0.1) == 0.3
+        assert utils.round_up_to_tick(0.1 + 0.2, 0.1) == 0.3
+        assert utils.round_down_to_tick(0.97, 0.1) == 0.9
+        assert utils.from_ticks(utils.to_ticks(25.3) + 1) == 25.4
+        # a book bid touching our theoretical ask, which a float comparison would see as crossed by rounding error
+        assert 0.3 > 0.7 - 0.4
+        assert utils.detect_arbitrage(0.3, 0.4, 0.1, 0.7 - 0.4) is None
+        # a book bid one tick above our theoretical ask
+        assert utils.detect_arbitrage(0.4, 0.5, 0.1, 0.7 - 0.4) == 'ask'
+        assert utils.detect_arbitrage(0.3, 0.4, float('nan'), float('nan')) is None
+        exchange = _RecordingExchange()
+        market_maker = StockMarketMaker(_fake_instrument('NVDA'), risk=PreTradeRiskEngine())
+        market_maker.update_limit_orders(exchange, float('nan'), float('nan'))
+        assert exchange.requests == []
+        
+        
+def _fake_instrument(instrument_id, base_instrument_id=None, expiry=None, strike=None, option_kind=None):
+    return SimpleNamespace(
+        instrument_id=instrument_id,
+        base_instrument_id=base_instrument_id,
+        expiry=expiry,
+        strike=strike,
+        option_kind=option_kind,
+        tick_size=0.1,
+        )
+
+
+class TestInstrumentRegistry:
+    expiry = dt.datetime(2024, 6, 28, 12, 0, 0)
+    all_instruments = {
+        'NVDA': _fake_instrument('NVDA'),
+        'NVDA_DUAL': _fake_instrument('NVDA_DUAL'),
+        'NVDA_202406_F': _fake_instrument('NVDA_202406_F', 'NVDA', expiry),
+        'NVDA_202406_050C': _fake_instrument('NVDA_202406_050C', 'NVDA', expiry, 50, OptionKind.CALL),
+        'NVDA_202406_050P': _fake_instrument('NVDA_202406_050P', 'NVDA', expiry, 50, OptionKind.PUT),
+        'OB5X_202406_050C': _fake_instrument('OB5X_202406_050C', 'OB5X', expiry, 50, OptionKind.CALL),
+        }
+
+    def test_select(self):
+        registry = InstrumentRegistry(self.all_instruments)
+        ids = registry.select('NVDA', KIND_OPTION, '202406')
+        assert registry.ids_to_instrument_ids(ids) == ['NVDA_202406_050C', 'NVDA_202406_050P']
+        assert registry.ids_to_instrument_ids(registry.select(kind=KIND_CALL)) == ['NVDA_202406_050C', 'OB5X_202406_050C']
+        assert registry.kind_of('NVDA_202406_F') == KIND_FUTURE
+        assert len(registry.select('CSCO')) == 0
+
+    def test_underlyings(self):
+        registry = InstrumentRegistry(self.all_instruments)
+        assert registry.underlying_of('NVDA_DUAL') == 'NVDA'
+        assert registry.underlying_of('NVDA') == 'NVDA'
+        assert registry.underlyings[registry.id_of('OB5X_202406_050C')] == -1
+        assert len(registry.at_strike('NVDA', '202406', 50)) == 2
+
+
+class TestShardedRunner:
+    def test_partition_by_underlying(self):
+        registry = InstrumentRegistry(TestInstrumentRegistry.all_instruments)
+        shards = partition_by_underlying(registry, 4)
+        assert len(shards) == 2
+        assert sorted(len(shard) for shard in shards) == [1, 5]
+        
+    def test_shared_risk_block(self):
+        registry = InstrumentRegistry(TestInstrumentRegistry.all_instruments)
+        owner = SharedRiskBlock(registry, create=True)
+        reader = SharedRiskBlock(registry, name=owner.name)
+        try:
+            owner.publish(registry.id_of('NVDA_202406_050C'), 10, 0.5)
+            owner.publish(registry.id_of('NVDA'), -2, 1.0)
+            assert reader.position('NVDA_202406_050C') == 10
+            assert reader.net_delta('NVDA') == 3
+            assert reader.would_breach_position_limit('NVDA_202406_050C', 91, 'bid')
+            assert not reader.would_breach_position_limit('NVDA_202406_050C', 91, 'ask')
+        finally:
+            reader.close()
+            owner.close()
+            owner.unlink()
+            
+    def test_pre_trade_check_uses_shared_gross_position(self):
+        registry = InstrumentRegistry(TestInstrumentRegistry.all_instruments)
+        shared = SharedRiskBlock(registry, create=True)
+        try:
+            # another shard holds 150 lots of OB5X
+            shared.publish(registry.id_of('OB5X_202406_050C'), -150, 0.5)
+            risk = PreTradeRiskEngine(position_limit=100, shared=shared, gross_position_limit=200)
+            risk.on_trade('NVDA', 1, 'bid', 20)
+            risk.publish(np.array([registry.id_of('NVDA')]), ['NVDA'], [1.0])
+            assert shared.position('NVDA') == 20
+            assert shared.gross_position() == 170
+            assert risk.allowed_volume('NVDA', 'bid', 80) == 30
+            assert risk.allowed_volume('NVDA', 'ask', 80) == 70
+        finally:
+            shared.close()
+            shared.unlink()
+
+
+class TestPreTradeRiskEngine:
+    def test_working_orders_count_against_limit(self):
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.on_trade('NVDA', 1, 'bid', 20)
+        risk.on_order_inserted('NVDA', 2, 'bid', 60)
+        assert risk.allowed_volume('NVDA', 'bid', 80) == 20
+        assert risk.allowed_volume('NVDA', 'ask', 80) == 80
+        assert risk.would_breach_position_limit('NVDA', 21, 'bid')
+        
+    def test_fills_and_deletes(self):
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.on_order_inserted('NVDA', 1, 'ask', 50)
+        risk.on_trade('NVDA', 1, 'ask', 30)
+        assert risk.position('NVDA') == -30
+        assert risk.worst_case_position('NVDA', 'ask') == -50
+        risk.on_order_deleted(1)
+        assert risk.worst_case_position('NVDA', 'ask') == -30
+        assert risk.orders == {}
+        
+    def test_confirmed_fills_are_booked_once(self):
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.on_fill_confirmed('NVDA', 7, 'bid', 30)
+        assert risk.position('NVDA') == 30
+        risk.on_trade('NVDA', 7, 'bid', 20)
+        risk.on_trade('NVDA', 7, 'bid', 10)
+        assert risk.position('NVDA') == 30
+        assert risk.confirmed_fills == {}
+
+
+class _RecordingExchange:
+    def __init__(self):
+        self.requests = []
+        
+    def insert_order(self, instrument_id, price, volume, side, order_type):
+        self.requests.append(('insert', instrument_id, side))
+        return SimpleNamespace(success=True, order_id=len(self.requests))
+        
+    def delete_order(self, instrument_id, order_id):
+        self.requests.append(('delete', instrument_id, order_id))
+        return True
+
+
+class _SlowDeleteExchange(_RecordingExchange):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        
+    def insert_order(self, instrument_id, price, volume, side, order_type):
+        with self._lock:
+            return super().insert_order(instrument_id, price, volume, side, order_type)
+        
+    def delete_order(self, instrument_id, order_id):
+        time.sleep(0.05)
+        with self._lock:
+            return super().delete_order(instrument_id, order_id)
+
+
+class _IocExchange(_RecordingExchange):
+    def __init__(self, fillable):
+        super().__init__()
+        # instrument_id -> lots an ioc order can take
+        self.fillable = fillable
+        self.trades = []
+        
+    def insert_order(self, instrument_id, price, volume, side, order_type):
+        response = super().insert_order(instrument_id, price, volume, side, order_type)
+        filled = min(volume, self.fillable.get(instrument_id, 0))
+        if filled:
+            self.trades.append(SimpleNamespace(instrument_id=instrument_id, order_id=response.order_id, volume=filled))
+        return response
+        
+    def get_trade_history(self, instrument_id):
+        return [trade for trade in self.trades if trade.instrument_id == instrument_id]
+
+
+class TestOrderGateway:
+    def test_flush_resolves_futures(self):
+        exchange = _RecordingExchange()
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.on_order_inserted('NVDA', 'old', 'bid', 50)
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1, risk=risk)
+        deleted = gateway.delete('NVDA', 'old')
+        inserted = gateway.insert('NVDA', price=25.1, volume=10, side='bid')
+        assert exchange.requests == []
+        # the queued insert is already counted
+        assert risk.worst_case_position('NVDA', 'bid') == 10
+        futures = gateway.flush()
+        gateway.close()
+        assert futures == [deleted, inserted]
+        assert deleted.result() is True
+        assert inserted.result().success
+        assert risk.worst_case_position('NVDA', 'bid') == 10
+        assert risk.reserved == {} and list(risk.orders) == [inserted.result().order_id]
+        
+    def test_releases_rejected_and_ioc_inserts(self):
+        exchange = _IocExchange({'NVDA': 3})
+        rejected = SimpleNamespace(success=False, order_id=None)
+        exchange.insert_order = lambda instrument_id, price, volume, side, order_type: (
+            rejected if instrument_id == 'SAN' else _IocExchange.insert_order(exchange, instrument_id, price, volume, side, order_type)
+            )
+        risk = PreTradeRiskEngine(position_limit=100)
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1, risk=risk)
+        gateway.insert('SAN', price=9.1, volume=10, side='bid')
+        ioc = gateway.insert('NVDA', price=25.1, volume=10, side='bid', order_type='ioc')
+        assert (risk.worst_case_position('SAN', 'bid'), risk.worst_case_position('NVDA', 'bid')) == (10, 10)
+        assert risk.allowed_volume('NVDA', 'bid', 100) == 90
+        gateway.flush()
+        gateway.close()
+        assert (risk.worst_case_position('SAN', 'bid'), risk.worst_case_position('NVDA', 'bid')) == (0, 0)
+        assert risk.reserved == {} and risk.orders == {}
+        assert gateway.ioc_fills == {ioc.result().order_id: 3}
+        
+    def test_inserts_wait_for_deletes_of_their_instrument(self):
+        exchange = _SlowDeleteExchange()
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=4)
+        gateway.delete('NVDA', 'old')
+        gateway.insert('NVDA', price=25.1, volume=10, side='bid')
+        gateway.insert('SAN', price=9.1, volume=10, side='bid')
+        gateway.flush()
+        gateway.close()
+        assert exchange.requests == [('insert', 'SAN', 'bid'), ('delete', 'NVDA', 'old'), ('insert', 'NVDA', 'bid')]
+
+
+class TestArbitrageur:
+    def test_hedges_only_the_filled_volume(self):
+        exchange = _IocExchange({'NVDA_DUAL': 3, 'NVDA': 10})
+        exchange.trades.append(SimpleNamespace(instrument_id='NVDA_DUAL', order_id='older', volume=40))
+        risk = PreTradeRiskEngine(position_limit=100)
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=2, risk=risk)
+        arb = DualListArb(exchange, 'NVDA_DUAL', 'NVDA', risk, gateway)
+        level = lambda price, volume: SimpleNamespace(price=price, volume=volume)
+        arb.bid_primal, arb.ask_primal = level(24.8, 10), level(24.9, 10)
+        arb.bid_hedge, arb.ask_hedge = level(25.1, 10), level(25.2, 10)
+        arb.detect()
+        arb.trade()
+        gateway.close()
+        assert exchange.requests == [('insert', 'NVDA_DUAL', 'bid'), ('insert', 'NVDA', 'ask')]
+        assert [trade.volume for trade in exchange.trades[1:]] == [3, 3]
+        assert (risk.position('NVDA_DUAL'), risk.position('NVDA')) == (3, -3)
+        assert gateway.ioc_fills == {}
+        
+    def test_leaves_queued_requotes_alone(self):
+        exchange = _IocExchange({'NVDA_DUAL': 3, 'NVDA': 10})
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=2)
+        requote = gateway.insert('NVDA', price=25.0, volume=5, side='bid', tag='market_making')
+        arb = DualListArb(exchange, 'NVDA_DUAL', 'NVDA', PreTradeRiskEngine(position_limit=100), gateway)
+        level = lambda price, volume: SimpleNamespace(price=price, volume=volume)
+        arb.bid_primal, arb.ask_primal = level(24.8, 10), level(24.9, 10)
+        arb.bid_hedge, arb.ask_hedge = level(25.1, 10), level(25.2, 10)
+        arb.detect()
+        arb.trade()
+        assert exchange.requests == [('insert', 'NVDA_DUAL', 'bid'), ('insert', 'NVDA', 'ask')]
+        assert not requote.done()
+        assert gateway.flush() == [requote]
+        gateway.close()
+        assert exchange.requests[-1] == ('insert', 'NVDA', 'bid')
+        
+    def test_no_hedge_without_fill(self):
+        exchange = _IocExchange({'NVDA': 10})
+        arb = DualListArb(exchange, 'NVDA_DUAL', 'NVDA', PreTradeRiskEngine(position_limit=100))
+        level = lambda price, volume: SimpleNamespace(price=price, volume=volume)
+        arb.bid_primal, arb.ask_primal = level(25.3, 10), level(25.4, 10)
+        arb.bid_hedge, arb.ask_hedge = level(25.1, 10), level(25.2, 10)
+        arb.detect()
+        arb.trade()
+        assert exchange.requests == [('insert', 'NVDA_DUAL', 'ask')]
+
+
+class TestStateSnapshot:
+    def setup_state(self):
+        instruments = {'NVDA': _fake_instrument('NVDA'), 'NVDA_DUAL': _fake_instrument('NVDA_DUAL')}
+        registry = InstrumentRegistry(instruments)
+        risk = PreTradeRiskEngine(position_limit=100)
+        risk.positions.update({'NVDA': 20, 'NVDA_DUAL': -5})
+        risk.on_order_inserted('NVDA', 'o1', 'bid', 30)
+        market_makers_dict = {instrument_id: StockMarketMaker(instrument) for instrument_id, instrument in instruments.items()}
+        market_makers_dict['NVDA'].set_inventory_parameters(credit=0.05)
+        vol_book = RealizedVolatilityBook(min_observations=1)
+        for i, mid in enumerate([60.0, 60.5, 60.2]):
+            vol_book.update('NVDA', mid, timestamp=i)
+        return registry, risk, market_makers_dict, vol_book
+        
+    def test_save_load_and_reconcile(self, tmp_path):
+        registry, risk, market_makers_dict, vol_book = self.setup_state()
+        snapshotter = StateSnapshotter(str(tmp_path / 'state' / 'engine.snapshot'), interval=30)
+        snapshotter.save(capture_state(registry, risk, market_makers_dict, vol_book))
+        assert not (tmp_path / 'state' / 'engine.snapshot.tmp').exists()
+        
+        state = snapshotter.load()
+        restored_registry = InstrumentRegistry(state['instruments'])
+        assert restored_registry.instrument_ids == registry.instrument_ids
+        # NVDA traded 10 more lots while we were down, and o2 was inserted after the snapshot was taken
+        exchange = _FillingExchange({'NVDA': 30, 'NVDA_DUAL': -5})
+        exchange.outstanding = {'NVDA': {'o1', 'o2'}, 'NVDA_DUAL': {'o3'}}
+        exchange.delete_orders = lambda instrument_id: exchange.outstanding.pop(instrument_id, None)
+        restored_risk = PreTradeRiskEngine(position_limit=100)
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=2, risk=restored_risk)
+        moved = restore_risk(state, restored_risk, exchange, gateway)
+        gateway.close()
+        assert exchange.outstanding == {}
+        assert moved == {'NVDA': (20, 30)}
+        assert restored_risk.position('NVDA') == 30
+        assert restored_risk.orders == {}
+        assert restored_risk.worst_case_position('NVDA', 'bid') == 30
+        
+        restored_market_makers = {instrument_id: StockMarketMaker(instrument) for instrument_id, instrument in zip(registry.instrument_ids, registry.instruments)}
+        restored_vol_book = RealizedVolatilityBook(min_observations=1)
+        restore_market_makers(state, restored_market_makers, restored_vol_book)
+        assert restored_market_makers['NVDA'].c0 == 0.05
+        assert restored_vol_book.volatility('NVDA') == vol_book.volatility('NVDA')
+        
+    def test_periodic_and_rejected_snapshots(self, tmp_path):
+        registry, risk, market_makers_dict, vol_book = self.setup_state()
+        clock = _Clock()
+        snapshotter = StateSnapshotter(str(tmp_path / 'engine.snapshot'), interval=30, max_age=60, clock=clock)
+        assert snapshotter.load() is None
+        assert not snapshotter.maybe_save(registry, risk, market_makers_dict)
+        clock.now += 30
+        assert snapshotter.maybe_save(registry, risk, market_makers_dict)
+        assert snapshotter.load() is not None
+        
+        state = capture_state(registry, risk, market_makers_dict)
+        state['saved_at'] -= 120
+        snapshotter.save(state)
+        assert snapshotter.load() is None
+        (tmp_path / 'engine.snapshot').write_bytes(b'truncated')
+        assert snapshotter.load() is None
+
+
+class TestMetrics:
+    def test_render(self):
+        metrics = MetricsRegistry()
+        metrics.inc('orders_inserted', instrument_id='NVDA')
+        metrics.inc('orders_inserted', 2, instrument_id='NVDA')
+        metrics.set('pnl', -12.5)
+        metrics.observe('exchange_call_seconds', 0.002, method='insert_order')
+        metrics.observe('exchange_call_seconds', 0.004, method='insert_order')
+        text = metrics.render()
+        assert '# TYPE optistrats_orders_inserted_total counter' in text
+        assert 'optistrats_orders_inserted_total{instrument_id="NVDA"} 3' in text
+        assert 'optistrats_pnl -12.5' in text
+        assert 'optistrats_exchange_call_seconds_count{method="insert_order"} 2' in text
+        assert 'optistrats_exchange_call_seconds_max{method="insert_order"} 0.004' in text
+        with pytest.raises(Exception):
+            metrics.set('orders_inserted', 1)
+            
+    def test_instrumented_gateway(self):
+        metrics = MetricsRegistry()
+        exchange = _RecordingExchange()
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1, metrics=metrics)
+        gateway.insert('NVDA', price=25.1, volume=10, side='bid')
+        gateway.insert('NVDA', price=25.3, volume=10, side='ask')
+        gateway.delete('NVDA', 1)
+        gateway.flush()
+        gateway.close()
+        assert metrics.value('orders_inserted', instrument_id='NVDA') == 2
+        assert metrics.value('order_deletes', instrument_id='NVDA') == 1
+        exchange = InstrumentedExchange(_FillingExchange({'NVDA': 0}), metrics)
+        exchange.delete_orders('NVDA')
+        assert metrics.value('order_deletes', instrument_id='NVDA') == 1
+        assert metrics.value('delete_all_calls', instrument_id='NVDA') == 1
+        assert metrics.value('exchange_call_seconds', method='insert_order')[0] == 2
+        
+    def test_server_and_file(self, tmp_path):
+        import json
+        import urllib.request
+        metrics = MetricsRegistry()
+        metrics.set('pnl', 7)
+        server = MetricsServer(metrics, port=0).start()
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+                assert 'optistrats_pnl 7' in response.read().decode()
+        finally:
+            server.stop()
+        metrics_file = RollingMetricsFile(metrics, tmp_path / 'metrics.jsonl', interval=60, max_bytes=100, backups=2)
+        for _ in range(5):
+            metrics_file.write()
+        metrics_file.stop()
+        assert json.loads((tmp_path / 'metrics.jsonl').read_text())['metrics'] == {'optistrats_pnl': 7}
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['metrics.jsonl', 'metrics.jsonl.1', 'metrics.jsonl.2']
+
+
+class TestPnLEngine:
+    def test_realized_unrealized_and_attribution(self):
+        pnl = PnLEngine()
+        pnl.mark('NVDA', 25.0)
+        pnl.on_fill('NVDA', 'bid', 10, 24.9)
+        pnl.on_fill('NVDA', 'bid', 10, 25.1)
+        pnl.mark('NVDA', 25.5)
+        pnl.on_fill('NVDA', 'ask', 15, 25.6)
+        pnl.mark('NVDA', 25.2)
+        row = pnl.report()['NVDA']
+        assert row['position'] == 5
+        # 15 lots bought at an average of 25.0 sold at 25.6, 5 lots left marked at 25.2
+        assert row['realized'] == pytest.approx(9.0)
+        assert row['unrealized'] == pytest.approx(1.0)
+        assert row['spread_capture'] == pytest.approx(1.5)
+        assert row['inventory_drift'] == pytest.approx(8.5)
+        assert row['spread_capture'] + row['inventory_drift'] == pytest.approx(pnl.total())
+        
+    def test_flip_and_carry_in(self):
+        pnl = PnLEngine()
+        pnl.carry_in({'NVDA': -10, 'SAN': 0})
+        pnl.mark('NVDA', 30.0)
+        pnl.on_fill('NVDA', 'bid', 15, 29.0)
+        pnl.mark('NVDA', 31.0)
+        row = pnl.report()['NVDA']
+        assert row['position'] == 5
+        assert row['realized'] == pytest.approx(10.0)
+        assert row['unrealized'] == pytest.approx(10.0)
+        assert pnl.by_strategy()['untagged']['realized'] == pytest.approx(10.0)
+        assert 'SAN' not in pnl.report()
+        
+    def test_strategy_tags(self):
+        exchange = _RecordingExchange()
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1)
+        gateway.insert('NVDA', price=25.1, volume=10, side='bid', tag='hedging')
+        gateway.flush()
+        gateway.close()
+        pnl = PnLEngine(gateway, default_strategy='market_making')
+        pnl.mark('NVDA', 25.0)
+        pnl.on_trade('NVDA', SimpleNamespace(order_id=1, side='bid', volume=10, price=25.1))
+        pnl.on_trade('NVDA', SimpleNamespace(order_id=99, side='ask', volume=4, price=25.2))
+        pnl.mark_books(SimpleNamespace(best_bid_ask=lambda instrument_id: (SimpleNamespace(price=25.2), SimpleNamespace(price=25.4))))
+        strategies = pnl.by_strategy()
+        assert strategies['hedging']['position'] == 10
+        assert strategies['hedging']['total'] == pytest.approx(2.0)
+        assert strategies['market_making']['position'] == -4
+        assert strategies['market_making']['total'] == pytest.approx(-0.4)
+
+
+class _FillingExchange(_RecordingExchange):
+    def __init__(self, positions):
+        super().__init__()
+        self.positions = dict(positions)
+        
+    def get_positions(self):
+        return dict(self.positions)
+        
+    def delete_orders(self, instrument_id):
+        self.requests.append(('delete_all', instrument_id))
+        
+    def insert_order(self, instrument_id, price, volume, side, order_type):
+        # fills at most 10 lots per order
+        filled = min(volume, 10)
+        self.positions[instrument_id] += filled if side == 'bid' else -filled
+        return super().insert_order(instrument_id, price, volume, side, order_type)
+
+
+class TestFlatten:
+    def test_flatten(self):
+        exchange = _FillingExchange({'NVDA': 25, 'OB5X': -5, 'SAN': 0})
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1)
+        assert utils.flatten(exchange, gateway, instrument_ids=list(exchange.positions))
+        gateway.close()
+        assert exchange.positions == {'NVDA': 0, 'OB5X': 0, 'SAN': 0}
+        assert [request for request in exchange.requests if request[0] == 'delete_all'] == [
+            ('delete_all', 'NVDA'), ('delete_all', 'OB5X'), ('delete_all', 'SAN')
+            ]
+
+
+class TestInventoryPolicy:
+    def test_lookup(self):
+        policy = InventoryPolicy(0.03, 80, 100, 'slippery', 'linear-deprecate')
+        assert policy.lookup(0) == (0.03, 0.03, 80, 80)
+        assert policy.lookup(50) == (0.03, utils.slippery_credit('ask', 50, 0.03, .5, 80, 100), 40, 80)
+        assert policy.lookup(100) == policy.lookup(150)
+        
+    def test_evaluate_book(self):
+        policies = [
+            InventoryPolicy(0.03, 80, 100, 'rigid', 'constant'),
+            InventoryPolicy(0.05, 20, 50, 'linear-advocate', 'linear-advocate'),
+            ]
+        book = InventoryPolicyBook(policies)
+        credit_bid, credit_ask, volume_bid, volume_ask = book.evaluate(np.array([100, -25]))
+        assert list(credit_ask) == [0, 0.05]
+        assert list(credit_bid) == [0.03, 0.025]
+        assert list(volume_bid) == [80, 35]
+        assert list(volume_ask) == [80, 20]
+        
+    def test_market_maker_keeps_its_policy(self):
+        risk = PreTradeRiskEngine()
+        risk.on_trade('NVDA', 1, 'bid', 50)
+        market_maker = StockMarketMaker(_fake_instrument('NVDA'), risk=risk)
+        market_maker.select_credits(None, 'slippery')
+        market_maker.select_volumes(None, 'linear-deprecate')
+        policy = market_maker.inventory_policy('slippery', 'linear-deprecate')
+        assert (market_maker.credit_bid, market_maker.credit_ask, market_maker.volume_bid, market_maker.volume_ask) == policy.lookup(50)
+        market_maker.select_credits(None, 'slippery')
+        assert market_maker.inventory_policy('slippery', 'linear-deprecate') is policy
+        market_maker.set_inventory_parameters(volume=40)
+        market_maker.select_volumes(None, 'linear-deprecate')
+        assert market_maker.volume_bid == 20
+
+
+class TestStressSimulation:
+    policy = (0.03, 80, 100, 'slippery', 'linear-deprecate')
+    market = {'n_steps': 200}
+    
+    def test_sessions(self):
+        result = simulate_sessions(self.policy, 500, seed=1, market=self.market)
+        assert result.pnl.shape == result.final_inventory.shape == result.peak_inventory.shape == (500,)
+        assert np.all(np.abs(result.final_inventory) <= result.peak_inventory)
+        assert result.peak_inventory.max() <= 100
+        assert result.traded_volume.mean() > 0
+        
+    def test_deterministic_across_workers(self):
+        policies = {'slippery': self.policy, 'constant': (0.03, 80, 100, 'constant', 'constant')}
+        results = stress_test(policies, n_paths=300, n_workers=1, chunk_paths=128, seed=7, market=self.market)
+        again = stress_test(policies, n_paths=300, n_workers=2, chunk_paths=128, seed=7, market=self.market)
+        for name in policies:
+            assert len(results[name].pnl) == 300
+            assert np.array_equal(results[name].pnl, again[name].pnl)
+        assert not np.array_equal(results['slippery'].pnl, results['constant'].pnl)
+
+
+class TestTheoreticalValueCache:
+    # the options that are priced from their expiry have to expire in the future
+    expiry = dt.datetime.now() + dt.timedelta(days=180)
+    option = _fake_instrument('NVDA_202406_050C', 'NVDA', expiry, 50, OptionKind.CALL)
+    
+    def test_hits_on_spot_grid(self):
+        cache = TheoreticalValueCache(maxsize=2)
+        value = cache.value(self.option, 50.0, 0.5, .03, 3)
+        assert cache.value(self.option, 50.01, 0.5, .03, 3) == value
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert abs(value - call_value(50.0, 50, 0.5, .03, 3)) < 1e-3
+        
+    def test_lru_and_invalidate(self):
+        cache = TheoreticalValueCache(maxsize=2)
+        for stock_value in [49.0, 50.0, 51.0]:
+            cache.value(self.option, stock_value, 0.5, .03, 3)
+        assert len(cache) == 2
+        cache.value(self.option, 49.0, 0.5, .03, 3)
+        assert cache.hits == 0
+        cache.invalidate(self.option.instrument_id)
+        assert len(cache) == 0
+
+
+class TestTaylorPricer:
+    option = TestTheoreticalValueCache.option
+    
+    def test_fast_path_close_to_full_reprice(self):
+        pricer = TaylorPricer(max_spot_move=0.5, max_elapsed_seconds=10)
+        pricer.value(self.option, 50.0, 0.5, .03, 3)
+        value = pricer.value(self.option, 50.3, 0.5, .03, 3)
+        assert pricer.fast_path == 1
+        assert abs(value - call_value(50.3, 50, 0.5, .03, 3)) < 1e-4
+        
+    def test_falls_back_to_full_reprice(self):
+        pricer = TaylorPricer(max_spot_move=0.5, max_elapsed_seconds=10)
+        pricer.value(self.option, 50.0, 0.5, .03, 3)
+        pricer.value(self.option, 51.0, 0.5, .03, 3)
+        pricer.value(self.option, 51.0, 0.5 - 1 / 365, .03, 3)
+        pricer.value(self.option, 51.0, 0.5 - 1 / 365, .03, 2)
+        assert (pricer.fast_path, pricer.full_reprices) == (0, 4)
+
+
+class TestPriceSurface:
+    options = [
+        TestTheoreticalValueCache.option,
+        _fake_instrument('NVDA_202406_075P', 'NVDA', TestTheoreticalValueCache.expiry, 75, OptionKind.PUT),
+        ]
+    
+    def test_interpolation(self):
+        surface = build_price_surface(self.options, 60.0, [0.5, 0.5], .03, 3)
+        assert abs(surface.value('NVDA_202406_050C', 61.23) - call_value(61.23, 50, 0.5, .03, 3)) < 1e-4
+        assert not surface.covers(70.0)
+        
+    def test_background_rebuild(self):
+        pricer = SurfacePricer(refresh_seconds=60)
+        pricer.value(self.options[0], 60.0, 0.5, .03, 3)
+        pricer.close()
+        value = pricer.value(self.options[0], 60.04, 0.5, .03, 3)
+        assert (pricer.direct, pricer.interpolated) == (1, 1)
+        assert abs(value - call_value(60.04, 50, 0.5, .03, 3)) < 1e-4
+        
+    def test_per_option_volatility(self):
+        surface = build_price_surface(self.options, 60.0, [0.5, 0.5], .03, [3, 2])
+        assert abs(surface.value('NVDA_202406_075P', 61.23) - put_value(61.23, 75, 0.5, .03, 2)) < 1e-4
+        assert surface.prices('NVDA_202406_050C', .03, 3) and not surface.prices('NVDA_202406_075P', .03, 3)
+        
+        pricer = SurfacePricer(refresh_seconds=60)
+        san = _fake_instrument('SAN_202406_010C', 'SAN', TestTheoreticalValueCache.expiry, 10, OptionKind.CALL)
+        pricer.value(self.options[0], 60.0, 0.5, .03, 3)
+        pricer.value(self.options[1], 60.0, 0.5, .03, 2)
+        pricer.value(san, 10.0, 0.5, .03, 1)
+        # waits for the rebuilds, a second one if the first was built before the put was registered
+        pricer._builder.submit(lambda: None).result()
+        pricer.value(self.options[1], 60.0, 0.5, .03, 2)
+        pricer._builder.submit(lambda: None).result()
+        surface = pricer._surfaces['NVDA']
+        assert surface.prices('NVDA_202406_050C', .03, 3) and surface.prices('NVDA_202406_075P', .03, 2)
+        pricer.invalidate('NVDA_202406_075P')
+        pricer.close()
+        assert list(pricer._surfaces) == ['SAN']
+
+
+class TestRealizedVolatility:
+    def simulate(self, estimator, sigma, seconds=20000, seed=0):
+        rng = np.random.default_rng(seed)
+        log_returns = sigma * np.sqrt(1 / (365 * 24 * 60 * 60)) * rng.standard_normal(seconds)
+        for t, mid in enumerate(50 * np.exp(np.cumsum(log_returns))):
+            estimator.update(mid, timestamp=float(t))
+            
+    def test_estimates_close_to_true_volatility(self):
+        estimator = RealizedVolatilityEstimator(halflife_seconds=3000, bar_seconds=30, initial_volatility=1)
+        self.simulate(estimator, sigma=3)
+        for method in ['ewma', 'bipower']:
+            assert abs(estimator.estimate(method) - 3) < .3
+        # the range of a discretely sampled bar underestimates the true high/low range
+        assert 2.3 < estimator.estimate('parkinson') < 3
+        assert abs(estimator.volatility - 3) < .3
+        
+    def test_option_market_maker_follows_vol_book(self):
+        vol_book = RealizedVolatilityBook(halflife_seconds=3000, initial_volatility=1, min_observations=10)
+        market_maker = OptionMarketMaker(TestTheoreticalValueCache.option, vol=1, vol_source=vol_book)
+        assert np.isfinite(market_maker.compute_fair_quotes(49.9, 50.1)).all()
+        assert market_maker.volatility == 1
+        self.simulate(vol_book.estimator('NVDA'), sigma=3)
+        assert np.isfinite(market_maker.compute_fair_quotes(49.9, 50.1)).all()
+        assert market_maker.volatility == vol_book.volatility('NVDA') != 1
+        
+    def test_volatility_floor(self):
+        estimator = RealizedVolatilityEstimator(halflife_seconds=10, initial_volatility=1, min_observations=10)
+        # a flat mid has no realized volatility, which must not round down to zero
+        for t in range(1000):
+            estimator.update(50.0, timestamp=float(t))
+        assert estimator.estimate() < estimator.resolution / 2
+        assert estimator.volatility == estimator.resolution
+
+
+class TestVolatilitySurface:
+    options = [
+        _fake_instrument(f'NVDA_202406_{strike:03d}{kind.name[0]}', 'NVDA', TestTheoreticalValueCache.expiry, strike, kind)
+        for strike, kind in [(50, OptionKind.PUT), (75, OptionKind.PUT), (100, OptionKind.CALL), (120, OptionKind.CALL)]
+        ]
+    strikes = np.array([50., 75., 100., 120.])
+    is_call = np.array([False, False, True, True])
+    
+    def smile_prices(self, stock_value=90., T=0.5, r=.03):
+        moneyness = np.log(self.strikes / (stock_value * np.exp(r * T)))
+        sigma = 0.8 - 0.3 * moneyness + 1.5 * moneyness ** 2
+        prices = np.where(
+            self.is_call,
+            call_value(stock_value, self.strikes, T, r, sigma),
+            put_value(stock_value, self.strikes, T, r, sigma),
+            )
+        return prices, sigma
+        
+    def test_implied_volatility_round_trip(self):
+        prices, sigma = self.smile_prices()
+        implied, converged = implied_volatility(prices, 90., self.strikes, 0.5, .03, self.is_call, 1.0, iterations=20)
+        assert converged.all()
+        assert np.abs(implied - sigma).max() < 1e-6
+        implied, converged = implied_volatility([0.0], 90., [50.], 0.5, .03, [True], 1.0)
+        assert np.isnan(implied[0]) and not converged[0]
+        
+    def test_warm_started_fit_recovers_smile(self):
+        prices, sigma = self.smile_prices()
+        vol_surface = VolatilitySurface(interest_rate=.03, smoothing=0, newton_iterations=4, resolution=0.001)
+        for _ in range(3):
+            vol_surface.fit(self.options, prices, 90., [0.5] * 4)
+        fitted = [vol_surface.option_volatility(option) for option in self.options]
+        assert np.abs(np.array(fitted) - sigma).max() < 2e-3
+        market_maker = OptionMarketMaker(self.options[0], vol_source=vol_surface)
+        market_maker.refresh_volatility()
+        assert market_maker.volatility == fitted[0]
+
+
+class TestOrderBookCache:
+    def book(self, bids, asks):
+        return SimpleNamespace(
+            bids=[SimpleNamespace(price=price, volume=volume) for price, volume in bids],
+            asks=[SimpleNamespace(price=price, volume=volume) for price, volume in asks],
+            )
+        
+    def test_publishes_only_touch_changes(self):
+        book_cache = OrderBookCache(['NVDA', 'SAN'], depth=2)
+        events = []
+        book_cache.subscribe(lambda instrument_id, bid, ask: events.append((instrument_id, bid and bid.price, ask and ask.price)))
+        assert book_cache.apply('NVDA', self.book([(25.0, 10), (24.9, 5)], [(25.2, 3)]))
+        # a deeper level moving leaves the touch alone
+        assert not book_cache.apply('NVDA', self.book([(25.0, 10), (24.8, 7), (24.7, 1)], [(25.2, 3)]))
+        assert book_cache.apply('NVDA', self.book([(25.0, 10)], [(25.1, 3)]))
+        assert not book_cache.apply('SAN', None)
+        assert book_cache.apply('SAN', self.book([(9.0, 1)], []))
+        assert events == [('NVDA', 25.0, 25.2), ('NVDA', 25.0, 25.1), ('SAN', 9.0, None)]
+        assert book_cache.version('NVDA') == 2
+        assert book_cache.midpoint('NVDA') == 25.05
+        assert book_cache.best_bid_ask('SAN') is None
+        assert book_cache.check_and_get_best_bid_ask('NVDA')[0]
+        assert book_cache.ticks[book_cache.index['NVDA'], 0].tolist() == [250, 0]
+        assert book_cache.n_levels[book_cache.index['NVDA']].tolist() == [1, 1]
+
+
+class TestMarketMakingBook:
+    expiry = dt.datetime.now() + dt.timedelta(days=180)
+    
+    def test_matches_market_makers(self):
+        risk = PreTradeRiskEngine()
+        risk.positions.update({'NVDA': 30, 'NVDA_F': -100, 'NVDA_C': 5, 'NVDA_P': -70})
+        market_makers_dict = {
+            'NVDA': StockMarketMaker(_fake_instrument('NVDA'), risk=risk),
+            'NVDA_F': FutureMarketMaker(_fake_instrument('NVDA_F', 'NVDA', self.expiry), risk=risk),
+            'NVDA_C': OptionMarketMaker(_fake_instrument('NVDA_C', 'NVDA', self.expiry, 50, OptionKind.CALL), risk=risk),
+            'NVDA_P': OptionMarketMaker(_fake_instrument('NVDA_P', 'NVDA', self.expiry, 75, OptionKind.PUT), vol=2, risk=risk),
+            }
+        underlying_dict = {instrument_id: 'NVDA' for instrument_id in market_makers_dict}
+        book = MarketMakingBook(market_makers_dict, underlying_dict, 'slippery', 'linear-deprecate')
+        bid, ask = SimpleNamespace(price=60.0, volume=1), SimpleNamespace(price=60.4, volume=1)
+        book.compute_quotes(SimpleNamespace(best_bid_ask=lambda instrument_id: (bid, ask)), risk.positions, risk)
+        
+        assert book.quotable.all()
+        for row, (instrument_id, market_maker) in enumerate(market_makers_dict.items()):
+            fair_bid, fair_ask = market_maker.compute_fair_quotes(bid.price, ask.price)
+            market_maker.select_credits(None, 'slippery')
+            market_maker.select_volumes(None, 'linear-deprecate')
+            assert abs(book.fair_bid[row] - fair_bid) < 1e-6 and abs(book.fair_ask[row] - fair_ask) < 1e-6
+            assert utils.from_ticks(book.bid_ticks[row]) == utils.round_down_to_tick(fair_bid - market_maker.credit_bid, 0.1)
+            assert utils.from_ticks(book.ask_ticks[row]) == utils.round_up_to_tick(fair_ask + market_maker.credit_ask, 0.1)
+            assert book.bid_volume[row] == risk.allowed_volume(instrument_id, 'bid', market_maker.volume_bid, 100)
+            assert book.ask_volume[row] == risk.allowed_volume(instrument_id, 'ask', market_maker.volume_ask, 100)
+            
+    def test_sizes_volumes_through_risk(self):
+        instruments = {'NVDA': _fake_instrument('NVDA'), 'SAN': _fake_instrument('SAN')}
+        registry = InstrumentRegistry(instruments)
+        shared = SharedRiskBlock(registry, create=True)
+        try:
+            risk = PreTradeRiskEngine(shared=shared, gross_position_limit=150)
+            risk.positions.update({'NVDA': 30, 'SAN': -20})
+            # replaced by the requote
+            risk.on_order_inserted('NVDA', 'o1', 'bid', 50)
+            # sent but not answered yet, still counts
+            risk.reserve('SAN', 'ask', 40)
+            # another shard holds 100 lots of SAN
+            shared.publish(registry.id_of('SAN'), 100, 1)
+            market_makers_dict = {
+                instrument_id: StockMarketMaker(instrument, volume=80, risk=risk) for instrument_id, instrument in instruments.items()
+                }
+            book = MarketMakingBook(market_makers_dict, {'NVDA': 'NVDA', 'SAN': 'SAN'}, 'constant', 'constant')
+            bid, ask = SimpleNamespace(price=60.0, volume=1), SimpleNamespace(price=60.4, volume=1)
+            book.compute_quotes(SimpleNamespace(best_bid_ask=lambda instrument_id: (bid, ask)), risk.positions, risk)
+            # NVDA: 50 lots of gross room left next to the other shard's SAN
+            assert (book.bid_volume[0], book.ask_volume[0]) == (20, 80)
+            # SAN: 40 pending on the ask side, 20 short already
+            assert (book.bid_volume[1], book.ask_volume[1]) == (80, 40)
+        finally:
+            shared.close()
+            shared.unlink()
+
+
+class _QueueingGateway:
+    def __init__(self):
+        self.orders = []
+        
+    def insert(self, instrument_id, price, volume, side, order_type='limit', tag=None):
+        self.orders.append((instrument_id, price, volume, side, order_type))
+
+
+class TestDeltaHedger:
+    expiry = TestMarketMakingBook.expiry
+    instruments = {
+        'NVDA': _fake_instrument('NVDA'),
+        'NVDA_DUAL': _fake_instrument('NVDA_DUAL'),
+        'NVDA_F': _fake_instrument('NVDA_F', 'NVDA', expiry),
+        'NVDA_C': _fake_instrument('NVDA_C', 'NVDA', expiry, 50, OptionKind.CALL),
+        }
+    
+    def quotes(self, bid, ask, volume=100):
+        return SimpleNamespace(price=bid, volume=volume), SimpleNamespace(price=ask, volume=volume)
+    
+    def test_hedges_outside_band_with_cheapest_instrument(self):
+        registry = InstrumentRegistry(self.instruments)
+        risk = PreTradeRiskEngine()
+        risk.positions.update({'NVDA_C': 60, 'NVDA': 10})
+        # the future's fair value is about 60.9, selling it at 60.5 costs more than selling the dual at 59.9
+        books = {'NVDA': self.quotes(59.0, 61.0), 'NVDA_DUAL': self.quotes(59.9, 60.2), 'NVDA_F': self.quotes(60.5, 61.3)}
+        snapshot = SimpleNamespace(best_bid_ask=books.get)
+        engine = SimpleNamespace(risk=risk, gateway=_QueueingGateway())
+        hedger = DeltaHedger(registry, band=20, max_volume=100, volatility=1)
+        assert hedger.book_ids == ['NVDA', 'NVDA_DUAL', 'NVDA_F']
+        
+        mids = np.full(len(registry), np.nan)
+        mids[registry.id_of('NVDA')] = 60.0
+        deltas = hedger.deltas(mids)
+        option_delta = deltas[registry.id_of('NVDA_C')]
+        assert 0.5 < option_delta < 1
+        net_delta = hedger.net_deltas(registry.to_array(risk.positions), deltas)[registry.id_of('NVDA')]
+        assert abs(net_delta - (60 * option_delta + 10)) < 1e-9
+        
+        hedger.on_tick(engine, snapshot)
+        assert engine.gateway.orders == [('NVDA_DUAL', 59.9, int(round(net_delta)), 'ask', 'ioc')]
+        
+        risk.positions['NVDA_DUAL'] = -int(round(net_delta))
+        hedger.on_tick(engine, snapshot)
+        assert len(engine.gateway.orders) == 1
+        
+        # a future bid above its carried value is the cheapest hedge
+        books['NVDA_F'] = self.quotes(62.0, 64.0)
+        risk.positions['NVDA_DUAL'] = 0
+        hedger.on_tick(engine, snapshot)
+        assert engine.gateway.orders[-1][:2] == ('NVDA_F', 62.0)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+        
+    def __call__(self):
+        return self.now
+
+
+class TestRequoteScheduler:
+    def test_token_bucket(self):
+        clock = _Clock()
+        bucket = TokenBucket(rate=10, capacity=20, clock=clock)
+        assert bucket.try_consume(15) and not bucket.try_consume(6)
+        clock.now = 0.5
+        assert bucket.try_consume(10) and not bucket.try_consume(1)
+        
+    def test_spends_budget_on_largest_edges(self):
+        clock = _Clock()
+        scheduler = RequoteScheduler(TokenBucket(rate=1, capacity=8, clock=clock), staleness_seconds=2.0, clock=clock)
+        for instrument_id in ['ATM', 'OTM', 'WING']:
+            scheduler.mark_requoted(instrument_id, 10, 12, 80, 80)
+        clock.now = 1.0
+        candidates = {
+            'ATM': (13, 15, 80, 80, 4, False),
+            'OTM': (11, 13, 80, 80, 4, False),
+            'WING': (10, 12, 80, 80, 4, False),
+            'NEW': (50, 52, 80, 80, 4, False),
+            }
+        assert scheduler.plan(candidates) == ['NEW', 'ATM']
+        assert scheduler.deferred == 1
+        scheduler.mark_requoted('NEW', 50, 52, 80, 80)
+        scheduler.mark_requoted('ATM', 13, 15, 80, 80)
+        # the deferred quote has aged and the budget partly refilled
+        clock.now = 5.0
+        assert scheduler.plan(candidates) == ['OTM']
+        scheduler.mark_requoted('OTM', 11, 13, 80, 80)
+        # everything is stale, the oldest quotes go first
+        clock.now = 20.0
+        assert scheduler.plan(candidates) == ['WING', 'ATM']
+        
+    def test_credit_and_volume_changes_raise_priority(self):
+        clock = _Clock()
+        scheduler = RequoteScheduler(TokenBucket(rate=1, capacity=8, clock=clock), clock=clock)
+        market_maker = StockMarketMaker(_fake_instrument('NVDA'), credit=0.1, risk=PreTradeRiskEngine())
+        market_maker.select_credits(None, 'constant')
+        scheduler.mark_requoted('NVDA', *market_maker.quote_ticks(25.0, 25.0), 80, 80)
+        assert scheduler.priority('NVDA', *market_maker.quote_ticks(25.0, 25.0), 80, 80) == 0
+        # same fair value, wider credit
+        market_maker.set_inventory_parameters(credit=0.3)
+        market_maker.select_credits(None, 'constant')
+        assert scheduler.priority('NVDA', *market_maker.quote_ticks(25.0, 25.0), 80, 80) == 2
+        # same prices, half the volume on the bid
+        assert scheduler.priority('NVDA', 249, 251, 40, 80) == 0.5
+
+
+class _BookExchange(_RecordingExchange):
+    def __init__(self, books):
+        super().__init__()
+        self.books = books
+        
+    def get_last_price_book(self, instrument_id):
+        self.requests.append(('book', instrument_id))
+        return self.books.get(instrument_id)
+        
+    def poll_new_trades(self, instrument_id):
+        self.requests.append(('trades', instrument_id))
+        if instrument_id == 'NVDA':
+            return [SimpleNamespace(order_id=1, price=25.0, volume=5, side='bid')]
+        return []
+
+
+class _QuotingStrategy:
+    def __init__(self, book_ids, traded_ids):
+        self.book_ids = book_ids
+        self.traded_ids = traded_ids
+        self.quotes = []
+        
+    def on_tick(self, engine, snapshot):
+        self.quotes.append(snapshot.best_bid_ask('NVDA'))
+        engine.gateway.insert('NVDA', price=24.9, volume=1, side='bid')
+
+
+class _WarmingUpExchange(_BookExchange):
+    # books only become two-sided after <polls> requests
+    def __init__(self, books, polls):
+        super().__init__(books)
+        self.polls = polls
+        
+    def get_last_price_book(self, instrument_id):
+        order_book = super().get_last_price_book(instrument_id)
+        if self.requests.count(('book', instrument_id)) < self.polls:
+            return SimpleNamespace(bids=order_book.bids, asks=[])
+        return order_book
+
+
+def _order_book(bid, ask, bid_volume=10, ask_volume=10):
+    return SimpleNamespace(
+        bids=[SimpleNamespace(price=bid, volume=bid_volume)] if bid is not None else [],
+        asks=[SimpleNamespace(price=ask, volume=ask_volume)] if ask is not None else [],
+        )
+
+
+class TestMarketDataBus:
+    def test_publish_and_attach(self):
+        bus = MarketDataBus.create(['NVDA', 'NVDA_DUAL'], slots=4)
+        try:
+            reader = MarketDataBus.attach(bus.name)
+            assert reader.instrument_ids == ['NVDA', 'NVDA_DUAL'] and reader.slots == 4
+            assert reader.get_last_price_book('NVDA') is None
+            assert bus.publish('NVDA', _order_book(24.9, 25.1))
+            assert not bus.publish('NVDA', _order_book(24.9, 25.1))
+            bid, ask = reader.best_bid_ask('NVDA')
+            assert (bid.price, bid.volume, ask.price, ask.volume) == (24.9, 10, 25.1, 10)
+            bus.publish('NVDA_DUAL', _order_book(None, 25.3))
+            assert reader.check_and_get_best_bid_ask('NVDA_DUAL') == (False, None, None)
+            assert reader.get_last_price_book('NVDA_DUAL').asks[0].price == 25.3
+            
+            # the cache and the engine read books from the bus like from the exchange
+            book_cache = OrderBookCache(['NVDA'])
+            assert book_cache.refresh(reader) == ['NVDA']
+            assert book_cache.midpoint('NVDA') == 25.0
+            reader.close()
+        finally:
+            bus.close()
+            bus.unlink()
+            
+    def test_ring_overrun(self):
+        bus = MarketDataBus.create(['NVDA'], slots=4)
+        try:
+            for i in range(3):
+                bus.publish('NVDA', _order_book(24.0 + i, 26.0))
+            books, cursor = bus.updates('NVDA', 0)
+            assert [book.bids[0].price for book in books] == [24.0, 25.0, 26.0] and cursor == 3
+            for i in range(3, 10):
+                bus.publish('NVDA', _order_book(24.0 + i, 36.0))
+            # only the last 4 updates are still in the ring
+            books, cursor = bus.updates('NVDA', cursor)
+            assert [book.bids[0].price for book in books] == [30.0, 31.0, 32.0, 33.0] and cursor == 10
+            assert bus.updates('NVDA', cursor) == ([], 10)
+        finally:
+            bus.close()
+            bus.unlink()
+            
+    def test_stale_feed_and_stuck_writer(self):
+        bus = MarketDataBus.create(['NVDA'], slots=4)
+        try:
+            reader = MarketDataBus.attach(bus.name, max_age=1.0)
+            bus.publish('NVDA', _order_book(24.9, 25.1))
+            assert reader.best_bid_ask('NVDA') is not None
+            # the feed handler stopped polling two seconds ago
+            bus.heartbeat(time.time_ns() - 2 * 10**9)
+            assert reader.best_bid_ask('NVDA') is None and reader.stale_reads == 1
+            bus.heartbeat()
+            # the writer died between the two increments of the sequence number
+            bus.records[0, 0, 0] += 1
+            assert reader.get_last_price_book('NVDA') is None
+            reader.close()
+        finally:
+            bus.close()
+            bus.unlink()
+            
+    def test_concurrent_reads_are_consistent(self):
+        import threading
+        bus = MarketDataBus.create(['NVDA'], slots=2)
+        reader = MarketDataBus.attach(bus.name)
+        done = threading.Event()
+        
+        def write():
+            for i in range(1, 20000):
+                # the ask volume always matches the bid, a torn read would break that
+                bus.publish('NVDA', _order_book(i * 0.1, i * 0.1 + 0.1, i, i))
+            done.set()
+        
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            while not done.is_set():
+                order_book = reader.get_last_price_book('NVDA')
+                if order_book is not None:
+                    assert order_book.bids[0].volume == order_book.asks[0].volume
+                    assert abs(order_book.asks[0].price - order_book.bids[0].price - 0.1) < 1e-9
+        finally:
+            writer.join()
+            reader.close()
+            bus.close()
+            bus.unlink()
+
+
+class TestWaitForBestQuotes:
+    def test_waits_with_backoff_and_times_out(self):
+        level = SimpleNamespace(price=25.0, volume=10)
+        exchange = _WarmingUpExchange(
+            {'NVDA': SimpleNamespace(bids=[level], asks=[level]), 'SAN': SimpleNamespace(bids=[level], asks=[])}, polls=3
+            )
+        book_cache = OrderBookCache(['NVDA', 'SAN'])
+        quotes = utils.wait_for_best_quotes(exchange, ['NVDA', 'SAN'], timeout=0.2, book_cache=book_cache)
+        assert quotes == {'NVDA': (level, level)}
+        assert exchange.requests.count(('book', 'NVDA')) == 3
+        # backing off from 5 ms up to 100 ms gives few polls of the stuck book in 200 ms
+        assert exchange.requests.count(('book', 'SAN')) < 10
+        assert book_cache.best_bid_ask('NVDA') == (level, level)
+        assert utils.wait_for_best_quotes(exchange, ['SAN'], timeout=0.01) == {}
+
+
+class TestTradingEngine:
+    def test_one_snapshot_for_all_strategies(self):
+        level = SimpleNamespace(price=25.0, volume=10)
+        exchange = _BookExchange({'NVDA': SimpleNamespace(bids=[level], asks=[level]), 'SAN': None})
+        risk = PreTradeRiskEngine()
+        gateway = OrderGateway(exchange_factory=lambda: exchange, pool_size=1, risk=risk)
+        engine = TradingEngine(exchange, risk, gateway)
+        first = _QuotingStrategy(['NVDA'], ['NVDA'])
+        second = _QuotingStrategy(['NVDA', 'SAN'], ['NVDA'])
+        engine.add_strategy(first)
+        engine.add_strategy(second)
+        snapshot = engine.run_once()
+        gateway.close()
+        assert exchange.requests.count(('book', 'NVDA')) == 1
+        assert exchange.requests.count(('trades', 'NVDA')) == 1
+        assert first.quotes == second.quotes == [(level, level)]
+        assert snapshot.best_bid_ask('SAN') is None
+        assert risk.position('NVDA') == 5
+        assert risk.worst_case_position('NVDA', 'bid') == 7
+        assert snapshot.changed == {'NVDA'}
+        assert not engine.take_snapshot().touch_changed('NVDA')
+
+
+class _Stage:
+    def busy(self, seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+
+class TestProfiling:
+    def test_control_file_starts_and_stops_session(self, tmp_path):
+        control_file = tmp_path / 'profile'
+        profiler = ProfilingController(report_dir=tmp_path, duration=0.2, mode='cprofile', control_file=str(control_file))
+        profiler.poll()
+        assert not profiler.active
+        control_file.write_text('0.1')
+        profiler.poll()
+        assert profiler.active and not control_file.exists()
+        _Stage().busy(0.15)
+        path = profiler.poll()
+        assert not profiler.active and profiler.reports == [path]
+        assert 'busy' in open(f'{path}.txt').read()
+        
+    def test_stage_only(self, tmp_path):
+        profiler = ProfilingController(report_dir=tmp_path, duration=10, mode='sampling', interval=0.001)
+        stage = _Stage()
+        profiler.wrap_stage([stage], 'busy')
+        profiler.request()
+        profiler.poll()
+        time.sleep(0.05)
+        stage.busy(0.05)
+        profiler.request()
+        path = profiler.poll()
+        folded = open(f'{path}.folded').read()
+        assert folded and all('busy' in line for line in folded.splitlines())
+
+
+class TestImportTime:
+    # almost all of it is numpy, our own modules take a few milliseconds
+    budget_seconds = 0.5
+
+    def test_import_is_fast_and_side_effect_free(self):
+        code = (
+            'import sys, time\n'
+            't = time.perf_counter()\n'
+            'import optistrats.utils, optistrats.strats.arbitrage\n'
+            'import optistrats.hyperparam.hyperparameter_search_all\n'
+            'print(time.perf_counter() - t)\n'
+            'print(" ".join(m for m in ("scipy", "wandb", "optibook.synchronous_client") if m in sys.modules))\n'
+            )
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        elapsed, heavy_modules = output.split('\n')[:2]
+        assert heavy_modules == ''
+        assert float(elapsed) < self.budget_seconds
+
+
+class _QuotedBookExchange(_BookExchange):
+    # neither get_pnl nor get_positions exist, so any remote PnL or position lookup fails
+    def get_outstanding_orders(self, instrument_id):
+        self.requests.append(('outstanding', instrument_id))
+        return {}
+
+
 class TestHyperparameterSearch:
-    def test_trade_one_iteration(self):
+    def test_trade_one_iteration(self, exchange):
         iteration = 1
-        market_maker = OptionMarketMaker(exchange.get_instruments()['NVDA_202306_050P'])
+        risk = PreTradeRiskEngine()
+        risk.sync(exchange, ['NVDA_202306_050P'])
+        market_maker = OptionMarketMaker(exchange.get_instruments()['NVDA_202306_050P'], risk=risk)
+        pnl = PnLEngine()
+        pnl.carry_in(risk.positions)
         underlying_id = 'NVDA'
         wait_time = .2
         credit_ic_mode = 'constant'
         volume_ic_mode = 'linear-deprecate'
-        pnl = trade_one_iteration(
+        pnl, pos = trade_one_iteration(
             iteration, 
             market_maker, 
             exchange, 
             underlying_id, 
             wait_time, 
             credit_ic_mode, 
-            volume_ic_mode
+            volume_ic_mode,
+            pnl
             )
-        print(f'\n - The current PnL is {pnl}.')
\ No newline at end of file
+        print(f'\n - The current PnL is {pnl}, position {pos}.')
+        
+    def test_trade_one_iteration_is_local(self):
+        exchange = _QuotedBookExchange({'NVDA': _order_book(24.9, 25.3)})
+        market_maker = StockMarketMaker(_fake_instrument('NVDA'), risk=PreTradeRiskEngine())
+        pnl = PnLEngine()
+        total, position = trade_one_iteration(1, market_maker, exchange, 'NVDA', 0, 'constant', 'constant', pnl)
+        # bought 5 lots at 25.0, marked to the 25.1 mid
+        assert position == 5
+        assert total == pytest.approx(0.5)
+        assert pnl.report()['NVDA']['position'] == 5
\ No newline at end of file
@@ -3,10 +3,9 @@ import time
 import random
 import math
 import logging
-from optibook.synchronous_client import Exchange
-from optibook.common_types import OptionKind
 from math import floor, ceil
 from optistrats.math.black_scholes import call_value, put_value, call_delta, put_delta
+from optistrats.gateway import OrderGateway
 
 MIN_SELLING_PRICE = 0.10
 MAX_BUYING_PRICE = 100000.00
@@ -14,6 +13,8 @@ INTEREST_RATE = .03
 VOLATILITY = 3
 POSITION_LIMIT = 100
 TICK_SIZE = 0.10
+# prices within this many ticks of a tick count as on it, absorbing the error of the float division
+TICK_EPSILON = 1e-9
 
 
 option_ids = [
@@ -129,6 +130,63 @@ def clear_orders(exchange):
         exchange.delete_orders(id)
 
 
+def flatten(exchange, gateway=None, timeout=5.0, instrument_ids=None):
+    """
+    Deletes all our outstanding orders and trades out of all positions as fast as possible, returning True once the
+    book is flat or False if positions are still open after <timeout> seconds.
+
+    All deletes are sent concurrently without first asking which orders are outstanding, followed by IOC orders for
+    every open position. An IOC order is done once it is acknowledged, so positions read after the acknowledgements
+    are final and only what did not trade is sent again, backing off while nothing trades.
+
+    Arguments:
+        exchange: Exchange        -  An exchange client, used to read positions
+        gateway: OrderGateway     -  Gateway to send orders through, a temporary one is created if not given
+        timeout: float            -  Maximum number of seconds to keep trying to trade out of positions
+        instrument_ids: list      -  Instruments to flatten, all instruments if not given
+    """
+    own_gateway = gateway is None
+    if own_gateway:
+        gateway = OrderGateway(pool_size=8)
+    if instrument_ids is None:
+        instrument_ids = list(exchange.get_instruments())
+        
+    try:
+        for instrument_id in instrument_ids:
+            gateway.delete_all(instrument_id)
+        gateway.flush()
+        
+        deadline = time.monotonic() + timeout
+        backoff = 0.01
+        last_open_positions = None
+        while True:
+            positions = exchange.get_positions()
+            open_positions = {iid: positions[iid] for iid in instrument_ids if positions.get(iid, 0) != 0}
+            if not open_positions:
+                print(f'-- Book is flat.')
+                return True
+            if time.monotonic() > deadline:
+                print(f'-- Unable to trade out of {open_positions} within {timeout} seconds.')
+                return False
+            if open_positions == last_open_positions:
+                # nothing traded in the last round, give the books time to refill
+                time.sleep(backoff)
+                backoff = min(2 * backoff, 0.2)
+            last_open_positions = open_positions
+            
+            for iid, pos in open_positions.items():
+                if pos > 0:
+                    print(f'-- Inserting sell order for {pos} lots of {iid}, with limit price {MIN_SELLING_PRICE:.2f}')
+                    gateway.insert(iid, price=MIN_SELLING_PRICE, volume=pos, side='ask', order_type='ioc')
+                else:
+                    print(f'-- Inserting buy order for {-pos} lots of {iid}, with limit price {MAX_BUYING_PRICE:.2f}')
+                    gateway.insert(iid, price=MAX_BUYING_PRICE, volume=-pos, side='bid', order_type='ioc')
+            gateway.flush()
+    finally:
+        if own_gateway:
+            gateway.close()
+
+
 def trade_would_breach_position_limit(exchange, instrument_id, volume, side, position_limit=100):
     positions = exchange.get_positions()
     position_instrument = positions[instrument_id]
@@ -160,11 +218,37 @@ def check_and_get_best_bid_ask(exchange, stock_id):
     else:
         return True, stock_order_book.bids[0], stock_order_book.asks[0]
         
-def retrieve_best_quotes(exchange, instrument_id):
+def wait_for_best_quotes(exchange, instrument_ids, timeout=1.0, initial_backoff=0.005, max_backoff=0.1, book_cache=None):
+    """
+    Waits until the books of <instrument_ids> are two-sided, for at most <timeout> seconds. Only the books that are
+    still one-sided are polled again, with a pause that doubles from <initial_backoff> up to <max_backoff> seconds,
+    so a stuck book neither spins the CPU nor floods the exchange. With an OrderBookCache the books are polled
+    through it, so it stays up to date and publishes its change events.
+
+    Returns a dict from instrument id to (best bid, best ask) of the instruments that became two-sided; the others
+    are missing from it.
+    """
+    deadline = time.monotonic() + timeout
+    backoff = initial_backoff
+    quotes = {}
+    waiting = list(instrument_ids)
     while True:
-        exists, bid, ask = check_and_get_best_bid_ask(exchange, instrument_id)
-        if exists:
-            return bid, ask
+        if book_cache is not None:
+            book_cache.refresh(exchange, waiting)
+        for instrument_id in waiting:
+            if book_cache is not None:
+                best_quotes = book_cache.best_bid_ask(instrument_id)
+            else:
+                best_quotes = get_bid_ask(exchange, instrument_id)
+            if best_quotes is not None:
+                quotes[instrument_id] = best_quotes
+        waiting = [instrument_id for instrument_id in waiting if instrument_id not in quotes]
+
+        remaining = deadline - time.monotonic()
+        if not waiting or remaining <= 0:
+            return quotes
+        time.sleep(min(backoff, remaining))
+        backoff = min(2 * backoff, max_backoff)
 
 
 def expiry_in_years(exchange, instrument_id):
@@ -198,18 +282,48 @@ def get_bid_ask(exchange, instrument_id):
         return order_book.bids[0], order_book.asks[0]
 
 
+def to_ticks(price, tick_size=TICK_SIZE):
+    """
+    Converts a price on the tick grid, e.g. from an order book, to an integer number of ticks.
+    """
+    return int(round(price / tick_size))
+
+
+def ticks_down(price, tick_size=TICK_SIZE):
+    """
+    Returns the number of ticks of the highest tick at or below <price>.
+    """
+    return floor(price / tick_size + TICK_EPSILON)
+
+
+def ticks_up(price, tick_size=TICK_SIZE):
+    """
+    Returns the number of ticks of the lowest tick at or above <price>.
+    """
+    return ceil(price / tick_size - TICK_EPSILON)
+
+
+def from_ticks(ticks, tick_size=TICK_SIZE):
+    """
+    Converts a number of ticks to a price, e.g. 3 ticks of 0.10 to 0.3 rather than 0.30000000000000004. Only orders
+    sent to the exchange and printed prices should need this.
+    """
+    decimals = max(0, -floor(math.log10(tick_size) + TICK_EPSILON)) + 1
+    return round(ticks * tick_size, decimals)
+
+
 def round_down_to_tick(price, tick_size):
     """
     Rounds a price down to the nearest tick, e.g. if the tick size is 0.10, a price of 0.97 will get rounded to 0.90.
     """
-    return floor(price / tick_size) * tick_size
+    return from_ticks(ticks_down(price, tick_size), tick_size)
 
 
 def round_up_to_tick(price, tick_size):
     """
     Rounds a price up to the nearest tick, e.g. if the tick size is 0.10, a price of 1.34 will get rounded to 1.40.
     """
-    return ceil(price / tick_size) * tick_size
+    return from_ticks(ticks_up(price, tick_size), tick_size)
 
 
 def get_midpoint_value(exchange, instrument_id):
@@ -238,6 +352,8 @@ def calculate_theoretical_option_value(expiry, strike, option_kind, stock_value,
     interest_rate:           -  Assumed interest rate when calculating the Black-Scholes value
     volatility:              -  Assumed volatility of when calculating the Black-Scholes value
     """
+    from optibook.common_types import OptionKind
+
     time_to_expiry = calculate_current_time_to_date(expiry)
 
     if option_kind == OptionKind.CALL:
@@ -259,6 +375,8 @@ def calculate_option_delta(expiry_date, strike, option_kind, stock_value, intere
     interest_rate:           -  Assumed interest rate when calculating the Black-Scholes value
     volatility:              -  Assumed volatility of when calculating the Black-Scholes value
     """
+    from optibook.common_types import OptionKind
+
     time_to_expiry = calculate_current_time_to_date(expiry_date)
 
     if option_kind == OptionKind.CALL:
@@ -299,10 +417,17 @@ def get_valid_volume(volume, position, position_limit, side):
         return min(volume, max_volume_to_sell)
         
         
-def detect_arbitrage(best_bid_price, best_ask_price, theoretical_bid_price, theoretical_ask_price):
-    if best_bid_price > theoretical_ask_price:
+def detect_arbitrage(best_bid_price, best_ask_price, theoretical_bid_price, theoretical_ask_price, tick_size=TICK_SIZE):
+    """
+    Returns the side to trade on the book, 'ask' if its best bid is above our theoretical ask, 'bid' if its best ask
+    is below our theoretical bid, or None. The book prices are compared in ticks, so the comparison is exact.
+    Theoretical prices that are not finite, e.g. NaN from a failed pricing, never signal an arbitrage.
+    """
+    if not (math.isfinite(theoretical_bid_price) and math.isfinite(theoretical_ask_price)):
+        return None
+    if to_ticks(best_bid_price, tick_size) > ticks_down(theoretical_ask_price, tick_size):
         primal_side = "ask"
-    elif best_ask_price < theoretical_bid_price:
+    elif to_ticks(best_ask_price, tick_size) < ticks_up(theoretical_bid_price, tick_size):
         primal_side = "bid"
     else:
         primal_side = None
@@ -310,6 +435,8 @@ def detect_arbitrage(best_bid_price, best_ask_price, theoretical_bid_price, theo
     
     
 def exponential_credit(cmin, cmax, pmax, pmin, position_size):
+    if pmax == pmin:
+        return cmax
     k = (math.log(cmax) - math.log(cmin)) / (pmax - pmin)
     b = math.log(cmin) - k * pmin
     return math.exp(k * position_size + b)